@@ -0,0 +1,83 @@
+'''
+	Benchmarks chan_comment.cleanComment against the lxml path it replaces, and checks that
+	both give the same text for every comment.
+
+	python bench_chan_comment.py [thread.json ...]
+
+	With no arguments it uses a synthetic set of typical 4chan comments. Saved thread
+	JSON (from https://a.4cdn.org/{board}/thread/{no}.json) gives more realistic numbers.
+	Exits with status 1 if any comment comes out differently.
+'''
+import json
+import sys
+from random import Random
+from time import perf_counter
+from chan_comment import cleanComment, lxmlClean, _fastClean
+
+SYNTHETIC_COMMENTS = [
+	'<a href="#p451234567" class="quotelink">&gt;&gt;451234567</a><br>Skill issue',
+	'<span class="quote">&gt;be me</span><br><span class="quote">&gt;play ranked</span><br><span class="quote">&gt;lose</span>',
+	'based',
+	'<a href="#p1" class="quotelink">&gt;&gt;1</a><br><a href="#p2" class="quotelink">&gt;&gt;2</a><br>both of you are wrong &amp; you know it',
+	'it&#039;s over<br><br>we&#039;re so back',
+	'<s>spoiler</s> text with &quot;quotes&quot; and &lt;brackets&gt;',
+	'https://www.youtube.com/watch?v=dQw4w9<wbr>WgXcQ',
+	'<a href="/vg/thread/123#p456" class="quotelink">&gt;&gt;&gt;/vg/456</a> cross-board link',
+	'<b>bold</b> <u>underlined</u> and <i>italic</i>', # whitespace-only text between tags: lxml path
+	'<span class="deadlink">&gt;&gt;123</span> (dead)',
+	'code on /g/: <pre class="prettyprint">int main() {<br>  return 0;<br>}</pre>', # unusual tag: lxml path
+	'<!-- comment --> hidden', # lxml path
+	'&nbsp;&eacute;&#x1F600; &amp;amp',
+	'a&ampb without the semicolon',
+	'',
+	'   ',
+	'emoji \U0001F602<br>' * 20,
+]
+
+def loadComments(paths: list) -> list:
+	comments = []
+	for path in paths:
+		with open(path) as file:
+			thread = json.load(file)
+		comments.extend(post.get('com', '') for post in thread['posts'])
+	return comments
+
+def timeIt(function, comments: list, repeat: int) -> float:
+	'''
+		returns: float (best seconds per comment over `repeat` runs)
+	'''
+	best = float('inf')
+	for _ in range(repeat):
+		started = perf_counter()
+		for comment in comments:
+			function(comment)
+		best = min(best, perf_counter() - started)
+	return best / len(comments)
+
+def main(paths: list) -> int:
+	if paths:
+		comments = loadComments(paths)
+	else:
+		# a mix weighted like a real board: mostly short quotelink/greentext posts
+		rng = Random(415)
+		comments = [rng.choice(SYNTHETIC_COMMENTS[:8]) for _ in range(20000)] + SYNTHETIC_COMMENTS
+	comments = [comment for comment in comments if comment]
+
+	mismatches = 0
+	for comment in set(comments):
+		fast, slow = cleanComment(comment), lxmlClean(comment)
+		if fast != slow:
+			mismatches += 1
+			print(f"MISMATCH {comment!r}\n  cleanComment: {fast!r}\n  lxml:         {slow!r}")
+	fast_path = sum(1 for comment in comments if _fastClean(comment) is not None)
+
+	repeat = 5
+	fast_seconds = timeIt(cleanComment, comments, repeat)
+	slow_seconds = timeIt(lxmlClean, comments, repeat)
+	print(f"{len(comments)} comments, {fast_path / len(comments):.1%} on the fast path, {mismatches} mismatches")
+	print(f"cleanComment: {fast_seconds * 1e6:.2f} us/comment")
+	print(f"lxml:         {slow_seconds * 1e6:.2f} us/comment ({slow_seconds / fast_seconds:.1f}x slower)")
+	return 1 if mismatches else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,398 @@
+'''
+	Local stand-in for a.4cdn.org, oauth.reddit.com and the MHS API, for bench_pipeline.py.
+
+	python bench_fake_api.py [port]          serve until Ctrl-C (point CHAN_BASE_URL,
+	                                         REDDIT_BASE_URL, REDDIT_TOKEN_URL and MHS_BASE_URL at it)
+	python bench_fake_api.py record [dir]    save real 4chan threads and reddit listings of
+	                                         BOARDS/SUBREDDITS to `dir` (BENCH_FIXTURES)
+
+	Boards and subreddits are simulated live: posts arrive at the BENCH_*_PER_SECOND rates,
+	4chan threads hit the bump limit and are archived (then 404), and every endpoint honors
+	If-Modified-Since/after= like the real one. Post text is replayed from the recorded
+	fixtures, or bench_chan_comment's synthetic comments if there are none. Every response
+	can be delayed (BENCH_LATENCY_MS) or fail (BENCH_ERROR_RATE).
+'''
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qs
+from dotenv import load_dotenv
+import os
+import sys
+import json
+import glob
+import threading
+import logging
+from random import Random
+from time import time, sleep
+import requests
+from bench_chan_comment import SYNTHETIC_COMMENTS
+from score_cache import MHS_FAILING_TEXTS
+
+load_dotenv()
+BENCH_SEED = int(os.environ.get('BENCH_SEED', 1))
+BENCH_FIXTURES = os.environ.get('BENCH_FIXTURES', 'bench_fixtures')
+BENCH_CHAN_POSTS_PER_SECOND = float(os.environ.get('BENCH_CHAN_POSTS_PER_SECOND', 5)) # per board
+BENCH_CHAN_THREADS = int(os.environ.get('BENCH_CHAN_THREADS', 150)) # live threads per board (a real board has 150-200)
+BENCH_REDDIT_POSTS_PER_SECOND = float(os.environ.get('BENCH_REDDIT_POSTS_PER_SECOND', 0.5)) # per subreddit
+BENCH_REDDIT_COMMENTS_PER_SECOND = float(os.environ.get('BENCH_REDDIT_COMMENTS_PER_SECOND', 5)) # per subreddit
+BENCH_LATENCY_MS = float(os.environ.get('BENCH_LATENCY_MS', 50)) # mean added response time (exponentially distributed)
+BENCH_MHS_LATENCY_MS = float(os.environ.get('BENCH_MHS_LATENCY_MS', 300))
+BENCH_ERROR_RATE = float(os.environ.get('BENCH_ERROR_RATE', 0.01)) # fraction of requests answered with a 503 (429 for MHS)
+BENCH_MHS_FLAG_RATE = 0.2 # fraction of texts MHS flags
+BUMP_LIMIT = 300 # posts before a 4chan thread is archived
+ARCHIVE_SECONDS = 120 # how long an archived thread can be fetched before it 404s
+THREADS_PER_PAGE = 15
+LISTING_LENGTH = 1000 # reddit listings stop at ~1000 items
+
+def loadCorpus(fixtures: str) -> tuple:
+	'''
+		params: `fixtures` (directory written by `record`)
+
+		returns: tuple (4chan comments (html), reddit (title, selftext) pairs, reddit comment bodies)
+	'''
+	chan_comments = []
+	for path in glob.glob(os.path.join(fixtures, '4chan', '*', '*.json')):
+		with open(path) as file:
+			chan_comments.extend(post.get('com', '') for post in json.load(file)['posts'])
+	reddit_posts = []
+	reddit_comments = []
+	for path in glob.glob(os.path.join(fixtures, 'reddit', '*', '*.json')):
+		with open(path) as file:
+			for child in json.load(file)['data']['children']:
+				if child['kind'] == 't3':
+					reddit_posts.append((child['data']['title'], child['data']['selftext']))
+				else:
+					reddit_comments.append(child['data']['body'])
+	if not chan_comments:
+		chan_comments = SYNTHETIC_COMMENTS
+	if not reddit_posts:
+		reddit_posts = [(comment[:80], comment) for comment in SYNTHETIC_COMMENTS]
+	if not reddit_comments:
+		reddit_comments = [comment for comment in SYNTHETIC_COMMENTS if comment.strip()]
+	return chan_comments, reddit_posts, reddit_comments
+
+class FakeBoard:
+	'''
+		A 4chan board with `threads` live threads, getting `posts_per_second` posts spread
+		over them. Not thread safe (`FakeApi` holds a lock around it).
+	'''
+	def __init__(self, name: str, threads: int, posts_per_second: float, comments: list, rng: Random, now: float):
+		self.name = name
+		self.posts_per_second = posts_per_second
+		self.comments = comments
+		self.rng = rng
+		self.next_no = 100000000
+		self.threads = {} # no -> list of posts, OP first
+		self.archived = {} # no -> time it was archived
+		self.last_modified = int(now)
+		self.updated = now
+		self.owed = 0.0 # fractional posts carried over to the next `advance`
+		self.sticky = self._newThread(int(now) - 86400)
+		self.threads[self.sticky][0].update(sticky=1, closed=1)
+		for _ in range(threads):
+			no = self._newThread(int(now) - rng.randrange(3600))
+			for _ in range(rng.randrange(50)):
+				self._reply(no, int(now) - rng.randrange(60))
+
+	def _post(self, resto: int, timestamp: int) -> dict:
+		post = {'no': self.next_no, 'resto': resto, 'time': timestamp}
+		self.next_no += 1
+		comment = self.rng.choice(self.comments)
+		if comment:
+			post['com'] = comment
+		return post
+
+	def _newThread(self, timestamp: int) -> int:
+		op = self._post(0, timestamp)
+		op['replies'] = 0
+		op['last_modified'] = timestamp
+		self.threads[op['no']] = [op]
+		return op['no']
+
+	def _reply(self, no: int, timestamp: int):
+		posts = self.threads[no]
+		posts.append(self._post(no, timestamp))
+		posts[0]['replies'] += 1
+		posts[0]['last_modified'] = timestamp
+
+	def advance(self, now: float):
+		'''
+			Adds the posts made since the last call, archiving threads that hit `BUMP_LIMIT`
+			(each replaced by a new thread) and dropping threads archived long ago.
+		'''
+		self.owed += (now - self.updated) * self.posts_per_second
+		self.updated = now
+		timestamp = int(now)
+		live = [no for no in self.threads if no not in self.archived and no != self.sticky]
+		while self.owed >= 1:
+			self.owed -= 1
+			no = self.rng.choice(live)
+			self._reply(no, timestamp)
+			if len(self.threads[no]) >= BUMP_LIMIT:
+				self.threads[no][0]['archived'] = 1
+				self.threads[no][0]['last_modified'] = timestamp
+				self.archived[no] = now
+				live.remove(no)
+				live.append(self._newThread(timestamp))
+			self.last_modified = timestamp
+		for no, archived_at in list(self.archived.items()):
+			if now - archived_at > ARCHIVE_SECONDS:
+				del self.archived[no]
+				del self.threads[no]
+
+	def pages(self, catalog: bool) -> list:
+		'''
+			returns: threads.json (or catalog.json, if `catalog`) as a list of pages
+		'''
+		ops = [posts[0] for no, posts in self.threads.items() if no not in self.archived]
+		ops.sort(key=lambda op: (op.get('sticky', 0), op['last_modified']), reverse=True)
+		if catalog:
+			threads = [dict(op) for op in ops]
+		else:
+			threads = [{'no': op['no'], 'last_modified': op['last_modified'], 'replies': op['replies']} for op in ops]
+		return [{'page': i // THREADS_PER_PAGE + 1, 'threads': threads[i:i + THREADS_PER_PAGE]}
+				for i in range(0, len(threads), THREADS_PER_PAGE)]
+
+class FakeSubreddit:
+	'''
+		A subreddit's /new and /comments listings, getting `posts_per_second` posts and
+		`comments_per_second` comments (replies to recent posts and comments).
+	'''
+	def __init__(self, name: str, posts_per_second: float, comments_per_second: float, corpus: tuple, rng: Random, now: float):
+		self.name = name
+		self.rates = {'t3': posts_per_second, 't1': comments_per_second}
+		_, self.titles, self.bodies = corpus
+		self.rng = rng
+		self.next_id = 36 ** 6
+		self.items = {'t3': [], 't1': []} # newest last
+		self.owed = {'t3': 0.0, 't1': 0.0}
+		self.updated = now
+		self._add('t3', now - 60)
+
+	def _add(self, kind: str, created: float):
+		name = f"{kind}_{self._base36(self.next_id)}"
+		self.next_id += 1
+		data = {'name': name, 'created_utc': float(int(created)), 'subreddit': self.name}
+		if kind == 't3':
+			data['title'], data['selftext'] = self.rng.choice(self.titles)
+		else:
+			data['link_id'] = self.rng.choice(self.items['t3'][-50:])['data']['name']
+			replies = self.items['t1'][-50:]
+			data['parent_id'] = self.rng.choice(replies)['data']['name'] if replies and self.rng.random() < 0.5 else data['link_id']
+			data['body'] = self.rng.choice(self.bodies)
+		self.items[kind].append({'kind': kind, 'data': data})
+		del self.items[kind][:-LISTING_LENGTH]
+
+	@staticmethod
+	def _base36(number: int) -> str:
+		digits = ''
+		while number:
+			number, digit = divmod(number, 36)
+			digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+		return digits
+
+	def advance(self, now: float):
+		for kind, rate in self.rates.items():
+			self.owed[kind] += (now - self.updated) * rate
+			while self.owed[kind] >= 1:
+				self.owed[kind] -= 1
+				self._add(kind, now)
+		self.updated = now
+
+	def listing(self, kind: str, after: str, limit: int) -> dict:
+		'''
+			returns: the listing's json, newest first, starting after the item named `after`
+		'''
+		items = self.items[kind][::-1]
+		start = 0
+		if after:
+			start = next((i + 1 for i, item in enumerate(items) if item['data']['name'] == after), len(items))
+		children = items[start:start + limit]
+		more = start + limit < len(items)
+		return {'kind': 'Listing', 'data': {'after': children[-1]['data']['name'] if children and more else None,
+											'children': children}}
+
+class FakeApi:
+	'''
+		State shared by every request handler thread: the boards, subreddits and counters.
+	'''
+	def __init__(self, boards: list, subreddits: list, fixtures: str = BENCH_FIXTURES, seed: int = BENCH_SEED):
+		self.rng = Random(seed)
+		self.lock = threading.Lock()
+		corpus = loadCorpus(fixtures)
+		now = time()
+		self.boards = {board: FakeBoard(board, BENCH_CHAN_THREADS, BENCH_CHAN_POSTS_PER_SECOND, corpus[0], self.rng, now)
+						for board in boards}
+		self.subreddits = {subreddit: FakeSubreddit(subreddit, BENCH_REDDIT_POSTS_PER_SECOND, BENCH_REDDIT_COMMENTS_PER_SECOND,
+													corpus, self.rng, now)
+							for subreddit in subreddits}
+		self.requests = {} # endpoint -> requests served
+
+	def count(self, endpoint: str):
+		with self.lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+class Handler(BaseHTTPRequestHandler):
+	'''
+		Routes /4chan/..., /reddit/... and /mhs/ to `self.server.api`.
+	'''
+	protocol_version = 'HTTP/1.1' # keep-alive, like the real APIs
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		path = urlsplit(self.path)
+		parts = path.path.strip('/').split('/')
+		if parts[0] == '4chan' and len(parts) >= 3:
+			self.chan(parts[1], parts[2:])
+		elif parts[0] == 'reddit' and len(parts) == 4 and parts[1] == 'r':
+			self.reddit(parts[2], parts[3], parse_qs(path.query))
+		else:
+			self.reply(404, {})
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		parts = urlsplit(self.path).path.strip('/').split('/')
+		if parts[0] == 'mhs':
+			self.mhs(body)
+		elif parts[0] == 'reddit' and parts[-1] == 'access_token':
+			self.delay('reddit', 'access_token', BENCH_LATENCY_MS)
+			self.reply(200, {'access_token': 'bench', 'token_type': 'bearer', 'expires_in': 86400})
+		else:
+			self.reply(404, {})
+
+	def delay(self, site: str, endpoint: str, latency_ms: float) -> bool:
+		'''
+			returns: bool (whether to fail this request)
+		'''
+		api = self.server.api
+		api.count(f"{site} {endpoint}")
+		with api.lock:
+			wait = api.rng.expovariate(1000 / latency_ms) if latency_ms > 0 else 0
+			fail = api.rng.random() < BENCH_ERROR_RATE
+		sleep(wait)
+		return fail
+
+	def chan(self, board: str, parts: list):
+		api = self.server.api
+		endpoint = 'thread' if parts[0] == 'thread' else parts[0]
+		if self.delay('4chan', endpoint, BENCH_LATENCY_MS):
+			return self.reply(503, {})
+		if board not in api.boards:
+			return self.reply(404, {})
+		fake = api.boards[board]
+		body = None
+		with api.lock:
+			fake.advance(time())
+			if endpoint in ('threads.json', 'catalog.json'):
+				last_modified = fake.last_modified
+				body = fake.pages(catalog=(endpoint == 'catalog.json'))
+			elif endpoint == 'thread' and len(parts) == 2 and parts[1].removesuffix('.json').isdigit():
+				posts = fake.threads.get(int(parts[1].removesuffix('.json')))
+				if posts is not None:
+					last_modified = posts[0]['last_modified']
+					body = {'posts': [dict(post) for post in posts]}
+		if body is None:
+			return self.reply(404, {})
+		try:
+			if last_modified <= parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp():
+				return self.reply(304, None, {'Last-Modified': formatdate(last_modified, usegmt=True)})
+		except (TypeError, ValueError): # no/unparseable header
+			pass
+		self.reply(200, body, {'Last-Modified': formatdate(last_modified, usegmt=True)})
+
+	def reddit(self, subreddit: str, listing: str, query: dict):
+		api = self.server.api
+		listing = listing.removesuffix('.json')
+		headers = {'X-Ratelimit-Remaining': '100000', 'X-Ratelimit-Reset': '600', 'X-Ratelimit-Used': '0'} # never the bottleneck
+		if self.delay('reddit', listing, BENCH_LATENCY_MS):
+			return self.reply(503, {}, headers)
+		if subreddit not in api.subreddits or listing not in ('new', 'comments'):
+			return self.reply(404, {}, headers)
+		with api.lock:
+			fake = api.subreddits[subreddit]
+			fake.advance(time())
+			body = fake.listing('t3' if listing == 'new' else 't1', query.get('after', [None])[0],
+								int(query.get('limit', [25])[0]))
+		self.reply(200, body, headers)
+
+	def mhs(self, body: bytes):
+		api = self.server.api
+		if self.delay('mhs', 'moderate', BENCH_MHS_LATENCY_MS):
+			return self.reply(429, {'error': 'rate limited'})
+		try:
+			text = json.loads(body)['text']
+		except (ValueError, KeyError):
+			return self.reply(400, {'error': 'bad request'})
+		if text in MHS_FAILING_TEXTS:
+			return self.reply(200, {'error': 'Text could not be analyzed'}) # like MHS, fails on these exact texts
+		with api.lock:
+			flagged = api.rng.random() < BENCH_MHS_FLAG_RATE
+			confidence = 0.5 + api.rng.random() / 2
+		self.reply(200, {'response': 'Success', 'class': 'flag' if flagged else 'normal', 'confidence': f"{confidence:.6f}"})
+
+	def reply(self, status: int, body, headers: dict = {}):
+		data = b'' if body is None else json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+def serve(boards: list, subreddits: list, port: int = 0) -> ThreadingHTTPServer:
+	'''
+		params: `boards`/`subreddits` (names to simulate), `port` (0 for any free port)
+
+		returns: the server, already serving from a daemon thread. Its base URL is
+		http://127.0.0.1:{server.server_port}
+	'''
+	server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+	server.daemon_threads = True
+	server.api = FakeApi(boards, subreddits)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def record(fixtures: str, threads_per_board: int = 5):
+	'''
+		Saves a few threads of every board in BOARDS, and the /new and /comments listings of
+		every subreddit in SUBREDDITS (public .json endpoints, no OAuth needed), to `fixtures`.
+	'''
+	headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/118.0"}
+	for board in os.environ.get('BOARDS').split(','):
+		os.makedirs(os.path.join(fixtures, '4chan', board), exist_ok=True)
+		pages = requests.get(f"https://a.4cdn.org/{board}/threads.json", headers=headers).json()
+		threads = [thread['no'] for page in pages for thread in page['threads']]
+		for no in threads[1:threads_per_board + 1]: # skip the (probably sticky) first thread
+			sleep(1) # 4chan's API rules: at most one request per second
+			response = requests.get(f"https://a.4cdn.org/{board}/thread/{no}.json", headers=headers)
+			if response.status_code == 200:
+				with open(os.path.join(fixtures, '4chan', board, f"{no}.json"), 'w') as file:
+					file.write(response.text)
+		logging.info(f"Recorded {threads_per_board} /{board}/ threads")
+	for subreddit in os.environ.get('SUBREDDITS').split(','):
+		os.makedirs(os.path.join(fixtures, 'reddit', subreddit), exist_ok=True)
+		for listing in ('new', 'comments'):
+			sleep(2)
+			response = requests.get(f"https://www.reddit.com/r/{subreddit}/{listing}.json?limit=100", headers=headers)
+			if response.status_code == 200:
+				with open(os.path.join(fixtures, 'reddit', subreddit, f"{listing}.json"), 'w') as file:
+					file.write(response.text)
+		logging.info(f"Recorded r/{subreddit}")
+
+if __name__ == '__main__':
+	logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+	if len(sys.argv) > 1 and sys.argv[1] == 'record':
+		record(sys.argv[2] if len(sys.argv) > 2 else BENCH_FIXTURES)
+	else:
+		server = serve(os.environ.get('BOARDS').split(','), os.environ.get('SUBREDDITS').split(','),
+						int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
+		base = f"http://127.0.0.1:{server.server_port}"
+		logging.info(f"Serving CHAN_BASE_URL={base}/4chan REDDIT_BASE_URL={base}/reddit "
+					f"REDDIT_TOKEN_URL={base}/reddit/api/v1/access_token MHS_BASE_URL={base}/mhs/")
+		try:
+			threading.Event().wait()
+		except KeyboardInterrupt:
+			server.shutdown()
@@ -0,0 +1,440 @@
+'''
+	Replay benchmark of the crawlers and analyzers, against bench_fake_api.py's stand-in
+	for 4chan, Reddit and MHS and a throwaway PostgreSQL database.
+
+	python bench_pipeline.py [chan] [reddit] [toxicity] [mhs]    (default: all four, in that order)
+
+	Each scenario runs the real entry point in its own process for BENCH_SECONDS (the
+	analyzers stop early once they've caught up with what the crawlers stored) and reports
+	posts/s, p50/p99 latency (crawlers: from a post being made to it being committed;
+	analyzers: per batch), database round trips (statements + commits) per post and the
+	process's peak RSS. faktory isn't needed: jobs run on in-process worker threads.
+
+	The database is a temporary cluster made with initdb (BENCH_PG_BIN, or found on PATH or
+	with pg_config; initdb won't run as root), unless BENCH_DB_NAME is set, in which case
+	that database (BENCH_DB_HOST/PORT/USER/PASS) is migrated and EMPTIED. Run
+	`python bench_fake_api.py record` first to replay real posts instead of synthetic ones.
+'''
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from dotenv import load_dotenv, dotenv_values
+import os
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import resource
+import logging
+from contextlib import contextmanager
+from functools import partial
+from math import ceil
+from queue import Queue
+from time import time, sleep, perf_counter
+import bench_fake_api
+
+load_dotenv()
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+BENCH_SECONDS = float(os.environ.get('BENCH_SECONDS', 60)) # per scenario
+BENCH_BOARDS = os.environ.get('BENCH_BOARDS', 'v,vg')
+BENCH_SUBREDDITS = os.environ.get('BENCH_SUBREDDITS', 'gaming,games')
+BENCH_CATALOG_SECONDS = float(os.environ.get('BENCH_CATALOG_SECONDS', 30)) # like faktory_chan_client: every board every ~30s
+BENCH_PG_BIN = os.environ.get('BENCH_PG_BIN') # directory with initdb/pg_ctl
+BENCH_DB_HOST = os.environ.get('BENCH_DB_HOST')
+BENCH_DB_PORT = os.environ.get('BENCH_DB_PORT')
+BENCH_DB_NAME = os.environ.get('BENCH_DB_NAME')
+BENCH_DB_USER = os.environ.get('BENCH_DB_USER')
+BENCH_DB_PASS = os.environ.get('BENCH_DB_PASS')
+SCENARIOS = ('chan', 'reddit', 'toxicity', 'mhs')
+RESULT_PREFIX = 'BENCH_RESULT '
+
+# --- parent: database, stand-in API, one child process per scenario ---
+
+def findPgBin() -> str:
+	if BENCH_PG_BIN:
+		return BENCH_PG_BIN
+	initdb = shutil.which('initdb')
+	if initdb:
+		return os.path.dirname(initdb)
+	try: # debian/ubuntu keep initdb out of PATH
+		return subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		sys.exit("initdb not found: set BENCH_PG_BIN, or BENCH_DB_* to use an existing (throwaway) database")
+
+def freePort() -> int:
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def startPostgres(workdir: str) -> tuple:
+	'''
+		params: `workdir` (directory for the cluster and its socket)
+
+		returns: tuple (DB_* settings for the new cluster's `bench` database, function that
+		stops the cluster)
+	'''
+	if os.geteuid() == 0:
+		sys.exit("initdb won't run as root: run as another user, or set BENCH_DB_* to use an existing (throwaway) database")
+	bin_dir = findPgBin()
+	data = os.path.join(workdir, 'pgdata')
+	port = str(freePort())
+	subprocess.run([os.path.join(bin_dir, 'initdb'), '-D', data, '-U', 'bench', '--auth=trust', '-E', 'UTF8', '--no-sync'],
+					check=True, stdout=subprocess.DEVNULL)
+	subprocess.run([os.path.join(bin_dir, 'pg_ctl'), '-D', data, '-l', os.path.join(workdir, 'postgres.log'), '-w',
+					'-o', f"-p {port} -k {workdir} -c listen_addresses=''", 'start'], check=True, stdout=subprocess.DEVNULL)
+	conn = psycopg2.connect(host=workdir, port=port, dbname='postgres', user='bench')
+	conn.autocommit = True
+	with conn.cursor() as cur:
+		cur.execute("CREATE DATABASE bench")
+	conn.close()
+	stop = lambda: subprocess.run([os.path.join(bin_dir, 'pg_ctl'), '-D', data, '-m', 'fast', 'stop'],
+									check=True, stdout=subprocess.DEVNULL)
+	return {'DB_HOST': workdir, 'DB_PORT': port, 'DB_NAME': 'bench', 'DB_USER': 'bench', 'DB_PASS': ''}, stop
+
+def emptyDatabase(settings: dict):
+	'''
+		Truncates every table but schema_migrations, so an existing BENCH_DB_NAME database
+		starts like a new one.
+	'''
+	conn = connect(settings)
+	with conn.cursor() as cur:
+		cur.execute("""SELECT relname FROM pg_class
+					JOIN pg_namespace ON pg_namespace.oid = relnamespace
+					WHERE
+						nspname = 'public' AND
+						relkind IN ('r', 'p') AND
+						NOT relispartition AND
+						relname <> 'schema_migrations'""")
+		tables = [row[0] for row in cur.fetchall()]
+		if tables:
+			cur.execute(f"TRUNCATE {', '.join(tables)}")
+	conn.commit()
+	conn.close()
+
+def connect(settings: dict):
+	return psycopg2.connect(host=settings['DB_HOST'], port=settings['DB_PORT'] or None, dbname=settings['DB_NAME'],
+							user=settings['DB_USER'], password=settings['DB_PASS'])
+
+def benchEnvironment(settings: dict, base_url: str, workdir: str) -> dict:
+	'''
+		returns: the environment the scenarios run in: the bench database, the stand-in API,
+		a fresh local state file and no metrics servers
+	'''
+	env = dict(settings)
+	if settings['DB_PORT']:
+		env['PGPORT'] = settings['DB_PORT'] # for the crawlers that don't read DB_PORT
+	env.update({
+		'BOARDS': BENCH_BOARDS,
+		'SUBREDDITS': BENCH_SUBREDDITS,
+		'CHAN_BASE_URL': f"{base_url}/4chan",
+		'REDDIT_BASE_URL': f"{base_url}/reddit",
+		'REDDIT_TOKEN_URL': f"{base_url}/reddit/api/v1/access_token",
+		'MHS_BASE_URL': f"{base_url}/mhs/",
+		'REDDIT_API_KEY': 'bench',
+		'MHS_API_KEY': 'bench',
+		'LOCAL_STATE_DB': os.path.join(workdir, 'crawl_state.sqlite3'),
+	})
+	for service in ('chan_catalog', 'chan_thread', 'reddit', 'toxicity', 'mhs'):
+		env[f"METRICS_PORT_{service.upper()}"] = '0'
+	return env
+
+def runScenario(name: str, workdir: str, api) -> dict:
+	'''
+		returns: the scenario's results, plus the requests it made to `api`
+	'''
+	requests_before = dict(api.requests)
+	log_path = os.path.join(workdir, f"{name}.log")
+	logging.info(f"Running {name} for up to {BENCH_SECONDS:.0f}s (log: {log_path})")
+	with open(log_path, 'w') as log:
+		child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name],
+								stdout=subprocess.PIPE, stderr=log, text=True)
+	lines = [line for line in child.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+	if child.returncode != 0 or not lines:
+		return {'scenario': name, 'error': f"exit status {child.returncode}, see {log_path}"}
+	result = json.loads(lines[-1][len(RESULT_PREFIX):])
+	result['requests'] = sum(api.requests.get(endpoint, 0) - requests_before.get(endpoint, 0) for endpoint in api.requests)
+	return result
+
+def printResults(results: list):
+	print(f"{'scenario':<10}{'posts':>9}{'posts/s':>10}{'p50 s':>9}{'p99 s':>9}{'db trips/post':>15}{'requests':>10}{'peak RSS MB':>13}")
+	for result in results:
+		if 'error' in result:
+			print(f"{result['scenario']:<10}  failed: {result['error']}")
+			continue
+		p50, p99 = (f"{value:.3f}" if value is not None else '-' for value in (result['p50'], result['p99']))
+		per_post = f"{result['round_trips'] / result['posts']:.3f}" if result['posts'] else '-'
+		print(f"{result['scenario']:<10}{result['posts']:>9}{result['posts_per_second']:>10.1f}{p50:>9}{p99:>9}"
+			f"{per_post:>15}{result['requests']:>10}{result['peak_rss_mb']:>13.0f}")
+
+def main(scenarios: list) -> int:
+	workdir = tempfile.mkdtemp(prefix='bench-')
+	stop = None
+	if BENCH_DB_NAME:
+		production = dotenv_values()
+		if BENCH_DB_NAME == production.get('DB_NAME') and (BENCH_DB_HOST or '') == (production.get('DB_HOST') or ''):
+			sys.exit("BENCH_DB_* points at the DB_* database, which the benchmark would empty")
+		settings = {'DB_HOST': BENCH_DB_HOST or '', 'DB_PORT': BENCH_DB_PORT or '', 'DB_NAME': BENCH_DB_NAME,
+					'DB_USER': BENCH_DB_USER or '', 'DB_PASS': BENCH_DB_PASS or ''}
+	else:
+		settings, stop = startPostgres(workdir)
+	try:
+		server = bench_fake_api.serve(BENCH_BOARDS.split(','), BENCH_SUBREDDITS.split(','))
+		os.environ.update(benchEnvironment(settings, f"http://127.0.0.1:{server.server_port}", workdir))
+		subprocess.run([sys.executable, 'migrations.py'], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+		emptyDatabase(settings)
+		results = [runScenario(name, workdir, server.api) for name in scenarios]
+		server.shutdown()
+	finally:
+		if stop is not None:
+			stop()
+	printResults(results)
+	logging.info(f"Scenario logs are in {workdir}")
+	return 1 if any('error' in result for result in results) else 0
+
+# --- child: one scenario, instrumented ---
+
+class RoundTrips:
+	'''
+		Counts statements, COPYs and commits/rollbacks of an open transaction: every call
+		that waits on the server.
+	'''
+	count = 0
+	lock = threading.Lock()
+
+	@classmethod
+	def add(cls):
+		with cls.lock:
+			cls.count += 1
+
+class CountingCursor(psycopg2.extensions.cursor):
+	def execute(self, query, vars=None):
+		RoundTrips.add()
+		return super().execute(query, vars)
+
+	def executemany(self, query, vars_list):
+		RoundTrips.add()
+		return super().executemany(query, vars_list)
+
+	def copy_expert(self, sql, file, size=8192):
+		RoundTrips.add()
+		return super().copy_expert(sql, file, size)
+
+class CountingConnection(psycopg2.extensions.connection):
+	def cursor(self, *args, **kwargs):
+		kwargs.setdefault('cursor_factory', CountingCursor)
+		return super().cursor(*args, **kwargs)
+
+	def commit(self):
+		if self.info.transaction_status != TRANSACTION_STATUS_IDLE:
+			RoundTrips.add()
+		return super().commit()
+
+	def rollback(self):
+		if self.info.transaction_status != TRANSACTION_STATUS_IDLE:
+			RoundTrips.add()
+		return super().rollback()
+
+class RecordingHistogram:
+	'''
+		Wraps a labelled prometheus Histogram, keeping every observed value.
+	'''
+	def __init__(self, histogram):
+		self.histogram = histogram
+		self.values = []
+
+	def labels(self, *labels):
+		return RecordedChild(self.histogram.labels(*labels), self.values)
+
+class RecordedChild:
+	def __init__(self, child, values: list):
+		self.child = child
+		self.values = values
+
+	def observe(self, value: float):
+		self.values.append(value)
+		self.child.observe(value)
+
+class InProcessFaktory:
+	'''
+		Stands in for the faktory server and its workers: each `register`ed worker is a thread
+		running its jobs one at a time, in the order they were queued. Replaces the
+		`connection` the crawler modules imported from faktory.
+	'''
+	def __init__(self):
+		self.jobs = {} # task -> (worker's queue, function)
+
+	def register(self, functions: dict):
+		jobs = Queue()
+		for task, function in functions.items():
+			self.jobs[task] = (jobs, function)
+		def run():
+			while True:
+				function, args = jobs.get()
+				try:
+					function(*args)
+				except Exception:
+					logging.exception(f"Job {function.__name__}{args} failed")
+				jobs.task_done()
+		threading.Thread(target=run, daemon=True).start()
+
+	@contextmanager
+	def connection(self):
+		yield self
+
+	def queue(self, task: str, queue: str = None, args: tuple = (), **kwargs):
+		jobs, function = self.jobs[task]
+		jobs.put((function, args))
+
+def recordLatencies(ingester, started: float, latencies: list):
+	'''
+		Wraps `ingester`'s on_flush to record how long each committed post (made since
+		`started`) took to get there. Rows start with the post's timestamp.
+	'''
+	on_flush = ingester.on_flush
+	def recording(rows):
+		now = time()
+		latencies.extend(now - row[0] for row in rows if row[0] >= started)
+		on_flush(rows)
+	ingester.on_flush = recording
+
+def benchChan(seconds: float, latencies: list) -> int:
+	import chan_crawler_catalog as catalog
+	import chan_crawler_thread as crawler
+	from db_pool import createPool
+	faktory = InProcessFaktory()
+	faktory.register({'chan_crawl_catalog': catalog.crawlCatalog, 'chan_remove_crawl': catalog.removeThread})
+	faktory.register({'chan_crawl_thread': crawler.newCrawlThreads})
+	catalog.connection = crawler.connection = faktory.connection
+	catalog.connection_pool = createPool(1, 2)
+	catalog.restoreBoards()
+	crawler.start()
+	started = time()
+	recordLatencies(crawler.chan_ingester, int(started), latencies)
+	boards = BENCH_BOARDS.split(',')
+	polls = 0
+	while time() - started < seconds: # like faktory_chan_client
+		faktory.queue('chan_crawl_catalog', args=(boards[polls % len(boards)],))
+		polls += 1
+		sleep(min(ceil(BENCH_CATALOG_SECONDS / len(boards)), max(0, seconds - (time() - started))))
+	crawler.stop()
+	return int(rowsInserted('chan_posts'))
+
+def benchReddit(seconds: float, latencies: list) -> int:
+	import reddit_crawler as crawler
+	crawler.setUp()
+	started = time()
+	recordLatencies(crawler.reddit_ingester, int(started), latencies)
+	subreddits = BENCH_SUBREDDITS.split(',')
+	crawls = 0
+	while time() - started < seconds: # back to back: as fast as the crawler (and its rate limiter) goes
+		crawler.main(subreddits[crawls % len(subreddits)], True, True)
+		crawls += 1
+	crawler.reddit_ingester.flush()
+	return int(rowsInserted('reddit_posts'))
+
+def waitForBacklog(seconds: float, pending: dict, started: float):
+	'''
+		Returns when nothing matches `pending` (see the analyzers' PENDING) or after `seconds`.
+		Counts on a connection of its own, which isn't counted in `RoundTrips`.
+	'''
+	conn = psycopg2.connect(host=os.environ['DB_HOST'], dbname=os.environ['DB_NAME'], user=os.environ['DB_USER'],
+							password=os.environ['DB_PASS'], connection_factory=psycopg2.extensions.connection)
+	try:
+		while time() - started < seconds:
+			sleep(1)
+			with conn.cursor() as cur:
+				waiting = 0
+				for table, predicate in pending.items():
+					cur.execute(f"SELECT count(*) FROM {table} WHERE {predicate}")
+					waiting += cur.fetchone()[0]
+			conn.rollback()
+			if not waiting:
+				return
+	finally:
+		conn.close()
+
+def benchToxicity(seconds: float) -> int:
+	import toxicity_analyzer as analyzer
+	from tox_block.prediction import make_predictions
+	from db_pool import createPool
+	# runWorker without the metrics server and backlog thread, and with the model loaded before the clock starts
+	analyzer.connection_pool = createPool(1, 2 * analyzer.PREFETCH_BATCHES + 4)
+	make_predictions(["warming up"])
+	started = time()
+	threading.Thread(target=analyzer.main, daemon=True).start()
+	waitForBacklog(seconds, analyzer.PENDING, started)
+	return analyzer.scored
+
+def benchMhs(seconds: float) -> int:
+	import mhs_analyzer as analyzer
+	from mhs_client import MHSClient
+	from psycopg2.pool import ThreadedConnectionPool
+	analyzer.connection_pool = ThreadedConnectionPool(1, 3, host=analyzer.DB_HOST, dbname=analyzer.DB_NAME,
+													user=analyzer.DB_USER, password=analyzer.DB_PASS)
+	analyzer.mhs_client = MHSClient()
+	started = time()
+	threading.Thread(target=analyzer.main, args=(True,), daemon=True).start()
+	threading.Thread(target=analyzer.main, args=(False,), daemon=True).start()
+	waitForBacklog(seconds, analyzer.PENDING, started)
+	return int(sum(analyzedPosts('mhs', source) for source in ('cache', 'api')))
+
+def rowsInserted(table: str) -> float:
+	from prometheus_client import REGISTRY
+	return REGISTRY.get_sample_value('db_rows_inserted_total', {'table': table}) or 0
+
+def analyzedPosts(analyzer: str, source: str) -> float:
+	from prometheus_client import REGISTRY
+	return REGISTRY.get_sample_value('analyzer_posts_total', {'analyzer': analyzer, 'source': source}) or 0
+
+def percentile(values: list, fraction: float):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[max(0, ceil(fraction * len(values)) - 1)] # nearest rank
+
+def runChild(name: str):
+	'''
+		Runs scenario `name` in this process and prints its results as one json line.
+	'''
+	psycopg2.connect = partial(psycopg2.connect, connection_factory=CountingConnection) # before anything connects
+	import metrics
+	batch_seconds = RecordingHistogram(metrics.BATCH_SECONDS)
+	metrics.BATCH_SECONDS = batch_seconds
+
+	latencies = []
+	started = perf_counter()
+	if name == 'chan':
+		posts = benchChan(BENCH_SECONDS, latencies)
+	elif name == 'reddit':
+		posts = benchReddit(BENCH_SECONDS, latencies)
+	elif name == 'toxicity':
+		posts = benchToxicity(BENCH_SECONDS)
+		latencies = batch_seconds.values
+	else:
+		posts = benchMhs(BENCH_SECONDS)
+		latencies = batch_seconds.values
+	elapsed = perf_counter() - started
+
+	result = {
+		'scenario': name,
+		'posts': posts,
+		'seconds': elapsed,
+		'posts_per_second': posts / elapsed,
+		'p50': percentile(latencies, 0.5),
+		'p99': percentile(latencies, 0.99),
+		'round_trips': RoundTrips.count,
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # KiB on linux
+	}
+	print(RESULT_PREFIX + json.dumps(result), flush=True)
+	os._exit(0) # don't wait for the scenario's (daemon/worker) threads
+
+if __name__ == '__main__':
+	if len(sys.argv) == 3 and sys.argv[1] == '--child':
+		runChild(sys.argv[2])
+	unknown = [name for name in sys.argv[1:] if name not in SCENARIOS]
+	if unknown:
+		sys.exit(f"Unknown scenario(s) {', '.join(unknown)}, expected some of {', '.join(SCENARIOS)}")
+	sys.exit(main(sys.argv[1:] or list(SCENARIOS)))
@@ -0,0 +1,263 @@
+from dotenv import load_dotenv
+import os
+import io
+import json
+import logging
+import psycopg2
+import threading
+from time import time
+import metrics
+
+load_dotenv()
+INGEST_MAX_ROWS = int(os.environ.get('INGEST_MAX_ROWS', 1000)) # flush once this many rows are staged
+INGEST_MAX_SECONDS = float(os.environ.get('INGEST_MAX_SECONDS', 5)) # or once the oldest staged row is this old
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 3)) # failed flushes before the rows are written in smaller batches to find the bad ones
+INGEST_DEAD_LETTER_FILE = os.environ.get('INGEST_DEAD_LETTER_FILE', 'ingest_dead_letter.jsonl') # rows the database refused on their own, as json lines
+
+# set if the post tables were created partitioned by month (see migrations.py). A partitioned
+# table's unique keys have to include the partition key, so its ON CONFLICT targets do too
+DB_PARTITION_POSTS = os.environ.get('DB_PARTITION_POSTS', '0').lower() in ('1', 'true', 'yes')
+
+CHAN_POSTS_COLUMNS = ('timestamp', 'board', 'thread_id', 'post_id', 'post')
+REDDIT_POSTS_COLUMNS = ('timestamp', 'subreddit', 'post_id', 'comment_id', 'comment')
+CHAN_POSTS_CONFLICT = ('board', 'post_id', 'timestamp') if DB_PARTITION_POSTS else ('board', 'post_id')
+REDDIT_POSTS_CONFLICT = ('comment_id', 'timestamp') if DB_PARTITION_POSTS else ('comment_id',)
+# side tables (see migrations.py), filled from the same API responses as the posts
+CHAN_POST_META_COLUMNS = ('board', 'post_id', 'greentext_lines', 'original_length')
+CHAN_POST_LINKS_COLUMNS = ('board', 'post_id', 'quoted_board', 'quoted_post_id')
+REDDIT_POST_META_COLUMNS = ('comment_id', 'parent_id', 'original_length')
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\x00": ""})
+
+def copyValue(value) -> str:
+	'''
+		params: `value` (column value)
+
+		returns: str (`value` as a field of PostgreSQL's COPY text format)
+	'''
+	if value is None:
+		return "\\N"
+	return str(value).translate(_COPY_ESCAPES)
+
+class BulkIngester:
+	'''
+		Stages rows for `table` in memory and writes them in one go: COPY into a temporary
+		staging table, then a single INSERT ... SELECT ... ON CONFLICT DO NOTHING into
+		`table`. That's a handful of round trips per flush instead of one per row.
+
+		Rows are flushed when `flush`/`flushIfDue` is called and there are `max_rows` staged
+		rows or the oldest is `max_seconds` old. `add`/`flush` are thread safe. If a flush
+		fails, its rows are kept and retried on the next flush. After `INGEST_MAX_ATTEMPTS`
+		failures in a row they're written by halves instead (see `_isolate`), so one row the
+		database refuses can't hold up every other row forever. `on_flush`, if given, is
+		called with the flushed rows after every successful commit.
+
+		`companions` are BulkIngesters for side tables whose rows are staged along with
+		this one's (their getconn/putconn aren't used). They're written in the same
+		transaction whenever this one flushes.
+	'''
+	def __init__(self, table: str, columns: tuple, conflict_columns: tuple, getconn, putconn,
+				max_rows: int = INGEST_MAX_ROWS, max_seconds: float = INGEST_MAX_SECONDS, on_flush=None,
+				companions: tuple = ()):
+		self.table = table
+		self.columns = columns
+		self.conflict_columns = conflict_columns
+		self.getconn = getconn # callable returning a psycopg2 connection
+		self.putconn = putconn # callable taking the connection back
+		self.max_rows = max_rows
+		self.max_seconds = max_seconds
+		self.on_flush = on_flush
+		self.companions = companions
+		self._rows = []
+		self._oldest = None # time() of the oldest staged row
+		self._lock = threading.Lock() # guards _rows/_oldest
+		self._flush_lock = threading.Lock() # one flush at a time
+		self._failures = 0 # flushes in a row that failed
+
+		staging = f"{table}_staging"
+		column_list = ", ".join(columns)
+		# the staging table only lives for the flush's transaction, since through pgbouncer
+		# (transaction pooling) the next transaction may run in another server session. one
+		# left in this session by an older version of this code is dropped first
+		self._create_sql = f"""DROP TABLE IF EXISTS pg_temp.{staging};
+								CREATE TEMP TABLE {staging}
+								(LIKE {table} INCLUDING DEFAULTS)
+								ON COMMIT DROP"""
+		self._copy_sql = f"""COPY {staging} ({column_list}) FROM STDIN"""
+		self._merge_sql = f"""INSERT INTO {table} ({column_list})
+								SELECT {column_list} FROM {staging}
+								ON CONFLICT ({", ".join(conflict_columns)}) DO NOTHING"""
+
+	def __len__(self) -> int:
+		return len(self._rows)
+
+	def add(self, row: tuple):
+		with self._lock:
+			if self._oldest is None:
+				self._oldest = time()
+			self._rows.append(row)
+
+	def addMany(self, rows: list):
+		if not rows:
+			return
+		with self._lock:
+			if self._oldest is None:
+				self._oldest = time()
+			self._rows.extend(rows)
+
+	def isDue(self) -> bool:
+		oldest = self._oldest
+		return len(self._rows) >= self.max_rows or (oldest is not None and time() - oldest >= self.max_seconds)
+
+	def flushIfDue(self) -> int:
+		return self.flush() if self.isDue() else 0
+
+	def flush(self) -> int:
+		'''
+			returns: int (number of staged rows that were new to `table`)
+
+			Writes every staged row to `table` (and the companions' tables) in one transaction.
+		'''
+		with self._flush_lock:
+			taken = [(ingester,) + ingester._take() for ingester in (self,) + tuple(self.companions)]
+			if not any(rows for _, rows, _ in taken):
+				return 0
+			if self._failures >= INGEST_MAX_ATTEMPTS:
+				return self._isolate(taken)
+
+			conn = self.getconn()
+			counts = {}
+			try:
+				with metrics.timeDb(f"flush_{self.table}"), conn.cursor() as cur:
+					for ingester, rows, _ in taken:
+						if rows:
+							counts[ingester] = ingester._write(cur, rows)
+					conn.commit()
+			except Exception:
+				self._failures += 1
+				logging.exception(f"Failed to flush {len(taken[0][1])} rows to {self.table} "
+								f"({self._failures}/{INGEST_MAX_ATTEMPTS} attempts), will retry")
+				_rollback(conn)
+				for ingester, rows, oldest in taken:
+					ingester._requeue(rows, oldest)
+				return 0
+			finally:
+				self.putconn(conn)
+			self._failures = 0
+			for ingester, count in counts.items():
+				metrics.ROWS_INSERTED.labels(ingester.table).inc(count)
+			rows = taken[0][1]
+			if rows and self.on_flush is not None:
+				self.on_flush(rows)
+			return counts.get(self, 0)
+
+	def _isolate(self, taken: list) -> int:
+		'''
+			params: `taken` (list of (ingester, rows, time() of the oldest) for this ingester
+			and its companions)
+
+			returns: int (number of this ingester's rows that were new to `table`)
+
+			Writes each ingester's rows in its own transactions, halving any batch the database
+			refuses until the rows it refuses are on their own. Those are logged and appended
+			to `INGEST_DEAD_LETTER_FILE` instead of being retried. Connection errors say nothing
+			about the rows, so on one everything not yet written is requeued as usual.
+		'''
+		conn = self.getconn()
+		counts = {}
+		committed = []
+		try:
+			for position, (ingester, rows, oldest) in enumerate(taken):
+				count, written, leftover = ingester._writeByHalves(conn, rows)
+				counts[ingester] = count
+				if ingester is self:
+					committed = written
+				if leftover:
+					logging.warning(f"Lost the database connection while isolating bad {ingester.table} rows, will retry")
+					ingester._requeue(leftover, oldest)
+					for later, later_rows, later_oldest in taken[position + 1:]:
+						later._requeue(later_rows, later_oldest)
+					break
+			else:
+				self._failures = 0
+		finally:
+			self.putconn(conn)
+		for ingester, count in counts.items():
+			metrics.ROWS_INSERTED.labels(ingester.table).inc(count)
+		if committed and self.on_flush is not None:
+			self.on_flush(committed)
+		return counts.get(self, 0)
+
+	def _writeByHalves(self, conn, rows: list) -> tuple:
+		'''
+			returns: tuple (number of rows new to `table`, rows written, rows not attempted
+			because the connection failed)
+		'''
+		count = 0
+		written = []
+		batches = [rows] if rows else [] # a stack; the first half of a split batch is on top
+		while batches:
+			batch = batches.pop()
+			try:
+				with metrics.timeDb(f"flush_{self.table}"), conn.cursor() as cur:
+					batch_count = self._write(cur, batch)
+					conn.commit()
+			except (psycopg2.OperationalError, psycopg2.InterfaceError):
+				_rollback(conn)
+				return count, written, [row for pending in [batch] + batches[::-1] for row in pending]
+			except Exception as e:
+				_rollback(conn)
+				if len(batch) == 1:
+					self._deadLetter(batch[0], e)
+				else:
+					half = len(batch) // 2
+					batches += [batch[half:], batch[:half]]
+				continue
+			count += batch_count
+			written.extend(batch)
+		return count, written, []
+
+	def _deadLetter(self, row: tuple, error: Exception):
+		logging.error(f"Dropping a {self.table} row the database refuses ({error!r}): {row!r}")
+		metrics.ROWS_DEAD_LETTERED.labels(self.table).inc()
+		try:
+			with open(INGEST_DEAD_LETTER_FILE, 'a') as file:
+				file.write(json.dumps({'table': self.table, 'columns': self.columns, 'row': row,
+										'error': str(error), 'time': time()}, default=str) + "\n")
+		except OSError:
+			logging.exception(f"Failed to write a dead-lettered row to {INGEST_DEAD_LETTER_FILE}")
+
+	def _take(self) -> tuple:
+		'''
+			returns: tuple (staged rows, time() of the oldest), leaving nothing staged
+		'''
+		with self._lock:
+			rows, self._rows = self._rows, []
+			oldest, self._oldest = self._oldest, None
+		return rows, oldest
+
+	def _requeue(self, rows: list, oldest):
+		with self._lock:
+			self._rows[:0] = rows
+			if oldest is not None and (self._oldest is None or oldest < self._oldest):
+				self._oldest = oldest
+
+	def _write(self, cur, rows: list) -> int:
+		'''
+			returns: int (number of `rows` that were new to `table`)
+		'''
+		buf = io.StringIO()
+		for row in rows:
+			buf.write("\t".join([copyValue(value) for value in row]))
+			buf.write("\n")
+		buf.seek(0)
+		cur.execute(self._create_sql)
+		cur.copy_expert(self._copy_sql, buf)
+		cur.execute(self._merge_sql)
+		return cur.rowcount
+
+def _rollback(conn):
+	try:
+		conn.rollback()
+	except Exception:
+		pass # connection is broken
@@ -0,0 +1,106 @@
+import re
+from html.entities import name2codepoint
+from lxml.html.clean import Cleaner
+from lxml.html import document_fromstring
+from lxml.etree import ParserError
+
+# what 4chan puts in comments: <br>, <wbr> (in long words/links), <a class="quotelink">,
+# <span class="quote"> (greentext), <s> (spoilers) and a few formatting tags on some boards
+FAST_TAGS = frozenset(('br', 'wbr', 'a', 'span', 's', 'b', 'i', 'u', 'strong', 'em'))
+MAX_CODEPOINT = 0x10FFFF
+
+_TAG = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)(?:\s[^<>]*)?/?>")
+_ENTITY = re.compile(r"&(?:#([0-9]{1,7})|#[xX]([0-9a-fA-F]{1,6})|([a-zA-Z][a-zA-Z0-9]*));")
+# characters libxml2 doesn't pass through as-is (control characters, CR, non-characters)
+_UNUSUAL_CHARS = re.compile("[\x00-\x08\x0b-\x1f\r￾￿]")
+
+# replies. same-thread/same-board quotes are href="#p123" or href="/board/thread/456#p123"
+_QUOTELINK = re.compile(r'<a href="(?:/([a-z0-9]+)/thread/[0-9]+)?#p([0-9]+)" class="quotelink">')
+_DEADLINK = re.compile(r'<span class="deadlink">&gt;&gt;([0-9]+)</span>') # quoted post was deleted
+_GREENTEXT = '<span class="quote">'
+
+_cleaner = Cleaner(allow_tags=['br'], page_structure=False) # only used by the fallback; clean_html doesn't change it
+
+class _Unusual(Exception):
+	pass
+
+def cleanComment(comment: str) -> str:
+	'''
+		params: `comment` (a post's `com` field from the 4chan API, HTML)
+
+		returns: str (the comment's text, the same as lxml's Cleaner + text_content() gives)
+
+		Most comments only use 4chan's handful of tags, which are stripped with a regex and
+		the entities decoded directly. Anything unusual (other tags, HTML comments, odd
+		characters, whitespace-only text between tags, which libxml2 sometimes drops) goes
+		through lxml instead, so the output doesn't depend on which path was taken.
+	'''
+	if not comment:
+		return ""
+	text = _fastClean(comment)
+	if text is None:
+		text = lxmlClean(comment)
+	return text
+
+def parseComment(comment: str) -> tuple:
+	'''
+		params: `comment` (a post's `com` field from the 4chan API, HTML)
+
+		returns: tuple (text (see `cleanComment`), list of the quoted posts as (board, post
+		number) tuples with board None for the post's own board, number of greentext lines)
+	'''
+	if not comment:
+		return ("", [], 0)
+	quoted = [(board or None, int(post)) for board, post in _QUOTELINK.findall(comment)]
+	quoted += [(None, int(post)) for post in _DEADLINK.findall(comment)]
+	return (cleanComment(comment), list(dict.fromkeys(quoted)), comment.count(_GREENTEXT))
+
+def lxmlClean(comment: str) -> str:
+	'''
+		The slow path (and what the fast path has to match): lxml's HTML parser and Cleaner.
+	'''
+	try:
+		return str(_cleaner.clean_html(document_fromstring(comment)).text_content())
+	except ParserError: # e.g. "Document is empty" for whitespace-only comments
+		return ""
+
+def _fastClean(comment: str):
+	'''
+		returns: str, or None if `comment` needs the slow path
+	'''
+	# libxml2 drops a leading BOM along with any whitespace after it
+	if comment[0].isspace() or comment[0] == '\ufeff' or _UNUSUAL_CHARS.search(comment):
+		return None
+	parts = []
+	position = 0
+	for tag in _TAG.finditer(comment):
+		if tag.group(2).lower() not in FAST_TAGS:
+			return None
+		parts.append(comment[position:tag.start()])
+		position = tag.end()
+	parts.append(comment[position:])
+	for part in parts:
+		if part and part.isspace():
+			return None
+	text = "".join(parts)
+	if "<" in text or ">" in text: # a tag the regex didn't understand, or a comment (<!-- -->)
+		return None
+	if "&" in text:
+		if text.count("&") != len(_ENTITY.findall(text)): # an entity without its ;, or a bare &
+			return None
+		try:
+			text = _ENTITY.sub(_decodeEntity, text)
+		except _Unusual:
+			return None
+	return text
+
+def _decodeEntity(match) -> str:
+	decimal, hexadecimal, name = match.groups()
+	if name is not None:
+		if name not in name2codepoint: # the HTML 4 entities, which is what libxml2 knows
+			raise _Unusual()
+		return chr(name2codepoint[name])
+	codepoint = int(decimal) if decimal is not None else int(hexadecimal, 16)
+	if codepoint > MAX_CODEPOINT or _UNUSUAL_CHARS.match(chr(codepoint)) or 0xD800 <= codepoint <= 0xDFFF:
+		raise _Unusual()
+	return chr(codepoint)
@@ -2,12 +2,13 @@ import requests
 from dotenv import load_dotenv
 import os
 from datetime import datetime
-import psycopg2
 from psycopg2.pool import ThreadedConnectionPool
-from time import time
+from time import time, perf_counter
 from faktory import Worker, connection
 import logging 
 from chan_crawler_functions import *
+from local_state import saveChanBoard, loadChanBoard
+import metrics
 
 load_dotenv()
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
@@ -17,17 +18,23 @@ DB_NAME = os.environ.get('DB_NAME')
 DB_USER = os.environ.get('DB_USER')
 DB_PASS = os.environ.get('DB_PASS')
 
-CHAN_BASE_URL = """https://a.4cdn.org"""
+CHAN_BASE_URL = os.environ.get('CHAN_BASE_URL', "https://a.4cdn.org") # overridden by bench_pipeline.py's stand-in API
 DEFAULT_UNIX_TIME = 1696118400 # 2023-10-01 12:00:00 AM UTC
+# 'diff': poll threads.json and only send threads whose last_modified/replies changed
+# 'full': poll catalog.json and only send threads we haven't seen before
+CATALOG_MODE = os.environ.get('CHAN_CATALOG_MODE', 'diff')
 
-crawled_threads = {}
+crawled_threads = {} # board -> {thread no: (last_modified, replies)} of threads being crawled
+ignored_threads = {} # board -> set of sticky/closed thread nos (diff mode)
 board_last_modified = {}
 
 for board in os.environ.get('BOARDS').split(','):
-	crawled_threads[board] = set()
+	crawled_threads[board] = {}
+	ignored_threads[board] = set()
 	board_last_modified[board] = ""
 
 def crawlCatalog(board: str):
+	metrics.startMetricsServer('chan_catalog') # jobs run in a forked worker process, so start it there
 	headers = {"If-Modified-Since": board_last_modified[board], "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/118.0"}
 	
 	# thread_id = 0 for the OP of a thread
@@ -47,7 +54,7 @@ def crawlCatalog(board: str):
 	new_threads_to_crawl = set()
 	if headers["If-Modified-Since"] == "":
 		conn = connection_pool.getconn()
-		with conn.cursor() as cur:
+		with metrics.timeDb("chan_catalog_restart"), conn.cursor() as cur:
 			# get the maximum timestamp thread in our db (want to get threads newer than that if we restarted program)
 			cur.execute(timestamp_sql, (board,))
 			timestamp = cur.fetchone()
@@ -59,13 +66,50 @@ def crawlCatalog(board: str):
 			# get (formerly) living/unarchived threads to crawl them if we restarted the program
 			cur.execute(get_alive_threads_sql, (board,))
 			for tup in cur.fetchall():
-				crawled_threads[board].add(tup[0])
+				crawled_threads[board][tup[0]] = None # unknown, so it'll look changed to diffThreadList
 				new_threads_to_crawl.add(tup[0])
 		connection_pool.putconn(conn)
 		headers["If-Modified-Since"] = convertDate(dt)
 	
 	
+	if CATALOG_MODE == 'diff':
+		diffThreadList(board, headers, new_threads_to_crawl)
+	else:
+		crawlFullCatalog(board, headers, new_threads_to_crawl)
+
+	if new_threads_to_crawl:
+		with connection() as client: # faktory connection
+			client.queue('chan_crawl_thread', queue='chan', args=(board, list(new_threads_to_crawl)))
+	if board_last_modified[board] != "":
+		# checkpoint after the threads were sent, so a restart never forgets to send one
+		saveChanBoard(board, board_last_modified[board], crawled_threads[board], ignored_threads[board])
+
+def restoreBoards():
+	'''
+		Loads each board's Last-Modified and thread list saved by the last run (see
+		local_state.py), so a restart resumes with conditional requests instead of asking
+		the database for every living thread and re-sending all of them to the thread crawler.
+	'''
+	for board in crawled_threads:
+		saved = loadChanBoard(board)
+		if saved is None:
+			continue
+		board_last_modified[board], crawled_threads[board], ignored_threads[board] = saved
+		logging.info(f"Restored /{board}/: {len(crawled_threads[board])} threads, modified since {board_last_modified[board]}")
+
+def crawlFullCatalog(board: str, headers: dict, new_threads_to_crawl: set):
+	'''
+		params: `board` (name of 4chan board (in url)), `headers` (request headers),
+		`new_threads_to_crawl` (set that new thread ids are added to)
+
+		returns: none
+
+		Gets /`board`/catalog.json and adds every thread that isn't already being
+		crawled (and isn't sticky/closed) to `new_threads_to_crawl`.
+	'''
+	started = perf_counter()
 	response = requests.get(f"{CHAN_BASE_URL}/{board}/catalog.json", headers=headers)
+	metrics.observeRequest('4chan', 'catalog.json', response.status_code, started)
 	if response.status_code == 200:
 		board_last_modified[board] = convertDate(datetime.fromtimestamp(int(time())))
 		catalog = response.json()
@@ -80,23 +124,102 @@ def crawlCatalog(board: str):
 						closed = thread['closed']
 					except:
 						closed = 0
-					crawled_threads[board].add(thread['no'])
+					crawled_threads[board][thread['no']] = (thread['last_modified'], thread['replies'])
 					if not (closed or sticky):
 						new_threads_to_crawl.add(thread['no'])
-		
-		with connection() as client: # faktory connection
-			client.queue('chan_crawl_thread', queue='chan', args=(board, list(new_threads_to_crawl)))
 	elif response.status_code == 304:
 		logging.info(f"/{board}/catalog.json not modified since {headers['If-Modified-Since']}")
 	else: 
 		logging.info(f"Error {response.status_code} getting {board}/catalog.json")
 
+def diffThreadList(board: str, headers: dict, threads_to_crawl: set):
+	'''
+		params: `board` (name of 4chan board (in url)), `headers` (request headers),
+		`threads_to_crawl` (set that changed thread ids are added to)
+
+		returns: none
+
+		Gets /`board`/threads.json and compares each thread's `last_modified` and `replies`
+		to what they were last poll. Only threads that changed, are new, or have dropped off
+		the board (so the thread crawler sees them die) are added to `threads_to_crawl`, so
+		unchanged threads are never requested. catalog.json is only downloaded when
+		threads.json has threads we haven't seen, to check whether they're sticky/closed.
+	'''
+	started = perf_counter()
+	response = requests.get(f"{CHAN_BASE_URL}/{board}/threads.json", headers=headers)
+	metrics.observeRequest('4chan', 'threads.json', response.status_code, started)
+	if response.status_code == 200:
+		index = crawled_threads[board]
+		ignored = ignored_threads[board]
+		live = {}
+		for page in response.json():
+			for thread in page['threads']:
+				live[thread['no']] = (thread['last_modified'], thread['replies'])
+
+		unseen = [no for no in live if no not in index and no not in ignored]
+		if unseen:
+			skip = getStickyOrClosedThreads(board)
+			if skip is None:
+				# try again next poll instead of crawling threads that might be stickies
+				logging.info(f"Couldn't check {len(unseen)} new /{board}/ threads, will retry")
+				for no in unseen:
+					del live[no]
+			else:
+				ignored.update(no for no in unseen if no in skip)
+
+		new = changed = 0
+		for no, values in live.items():
+			if no in ignored:
+				continue
+			if no not in index:
+				new += 1
+			elif index[no] != values:
+				changed += 1
+			else:
+				continue
+			index[no] = values
+			threads_to_crawl.add(no)
+		gone = [no for no in index if no not in live]
+		for no in gone:
+			del index[no]
+			threads_to_crawl.add(no)
+		ignored.intersection_update(live)
+
+		if not unseen or skip is not None:
+			board_last_modified[board] = response.headers.get('Last-Modified', convertDate(datetime.fromtimestamp(int(time()))))
+		logging.info(f"/{board}/threads.json: {new} new, {changed} changed, {len(gone)} gone, {len(index) - new - changed} unchanged")
+	elif response.status_code == 304:
+		logging.info(f"/{board}/threads.json not modified since {headers['If-Modified-Since']}")
+	else:
+		logging.info(f"Error {response.status_code} getting {board}/threads.json")
+
+def getStickyOrClosedThreads(board: str):
+	'''
+		params: `board` (name of 4chan board (in url))
+
+		returns: set of sticky/closed thread ids in /`board`/catalog.json, or None on error
+	'''
+	headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/118.0"}
+	started = perf_counter()
+	response = requests.get(f"{CHAN_BASE_URL}/{board}/catalog.json", headers=headers)
+	metrics.observeRequest('4chan', 'catalog.json', response.status_code, started)
+	if response.status_code != 200:
+		logging.info(f"Error {response.status_code} getting {board}/catalog.json")
+		return None
+	skip = set()
+	for page in response.json():
+		for thread in page['threads']:
+			if thread.get('sticky', 0) or thread.get('closed', 0):
+				skip.add(thread['no'])
+	return skip
+
 def removeThread(board: str, thread: int):
-	crawled_threads[board].discard(thread)
+	crawled_threads[board].pop(thread, None)
 
 if __name__ == '__main__':
 	# connection_pool in global scope. thread safe just in case
 	connection_pool = ThreadedConnectionPool(1, 2, host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+	restoreBoards()
 	w = Worker(faktory=FAKTORY_URL, queues=['chan'], concurrency=1)
 	w.register('chan_crawl_catalog', crawlCatalog)
 	w.register('chan_remove_crawl', removeThread)
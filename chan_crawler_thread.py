@@ -1,161 +1,316 @@
-import requests
+import asyncio
+import aiohttp
 from dotenv import load_dotenv
 import os
 from datetime import datetime
-import psycopg2
-from psycopg2 import OperationalError
-from psycopg2.pool import ThreadedConnectionPool
-from lxml.html.clean import Cleaner
-from lxml.html import document_fromstring
-from time import sleep, time
+from time import time, perf_counter
 from faktory import Worker, connection
-import logging 
+import logging
 from random import randrange
-from concurrent.futures import ProcessPoolExecutor
-from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from chan_crawler_functions import *
+from chan_thread_scheduler import ThreadScheduler
+from bulk_ingest import BulkIngester, CHAN_POSTS_COLUMNS, CHAN_POSTS_CONFLICT, CHAN_POST_META_COLUMNS, CHAN_POST_LINKS_COLUMNS
+from db_pool import createPool
+from chan_comment import parseComment
+from high_water_marks import HighWaterMarks
+from local_state import saveChanThreads, loadChanThreads
+import metrics
 
 load_dotenv()
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 FAKTORY_URL = os.environ.get('FAKTORY_URL')
-DB_HOST = os.environ.get('DB_HOST')
-DB_NAME = os.environ.get('DB_NAME')
-DB_USER = os.environ.get('DB_USER')
-DB_PASS = os.environ.get('DB_PASS')
 
-CHAN_BASE_URL = """https://a.4cdn.org"""
+CHAN_BASE_URL = os.environ.get('CHAN_BASE_URL', "https://a.4cdn.org") # overridden by bench_pipeline.py's stand-in API
 DEFAULT_UNIX_TIME = 1696118400 # 2023-10-01 12:00:00 AM UTC
+MIN_REVISIT_SECONDS = float(os.environ.get('CHAN_MIN_REVISIT_SECONDS', 10)) # busiest threads
+MAX_REVISIT_SECONDS = float(os.environ.get('CHAN_MAX_REVISIT_SECONDS', 300)) # quietest threads
+TARGET_POSTS_PER_VISIT = float(os.environ.get('CHAN_TARGET_POSTS_PER_VISIT', 3))
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get('CHAN_MAX_CONNECTIONS', 8)) # in-flight requests to a.4cdn.org
+DB_WORKERS = int(os.environ.get('CHAN_DB_WORKERS', 4)) # threads doing blocking db/faktory work for the event loop
+HWM_SEED_DAYS = float(os.environ.get('CHAN_HWM_SEED_DAYS', 7)) # load high-water marks for threads with posts this recent
+CHECKPOINT_SECONDS = float(os.environ.get('CHAN_CHECKPOINT_SECONDS', 30)) # how often the scheduler's state is saved to LOCAL_STATE_DB
+# in 'diff' mode the catalog crawler tells us which threads changed, so threads aren't revisited on a timer
+CATALOG_MODE = os.environ.get('CHAN_CATALOG_MODE', 'diff')
 
-def crawlThreads(board: str, threads: list, startSize: int = 50):
-	dt = datetime.fromtimestamp(DEFAULT_UNIX_TIME)
-	headers = {"If-Modified-Since": convertDate(dt), "User-Agent": f"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/{randrange(111, 120)}.0"}
-	insert_sql = """INSERT INTO 
-					chan_posts(timestamp, board, thread_id, post_id, post) 
-					VALUES (%s, %s, %s, %s, %s) 
-					ON CONFLICT (board, post_id) DO NOTHING"""
-	update_sql = """UPDATE chan_posts 
-					SET is_dead = '1' 
-					WHERE 
-						chan_posts.post_id = %s AND 
-						chan_posts.board = %s AND 
+# every watched (board, thread), ordered by when it's next due. only touched from the event loop's thread
+scheduler = ThreadScheduler(MIN_REVISIT_SECONDS, MAX_REVISIT_SECONDS, TARGET_POSTS_PER_VISIT, push_only=(CATALOG_MODE == 'diff'))
+visiting = set() # in-flight visitThread tasks
+high_water_marks = HighWaterMarks() # newest stored post per thread, updated whenever chan_ingester commits
+
+def stageThreadPosts(board: str, thread_obj: list, high_water: int) -> int:
+	'''
+		params: `board` (name of 4chan board (in url)), `thread_obj` (list of posts from
+		/`board`/thread/`thread`.json), `high_water` (newest post number already stored)
+
+		returns: int (the thread's new high-water post number: the newest post staged, or
+		`high_water` if there were none. Posts that are never stored, like image-only replies,
+		don't move it, so it can always catch up with what's committed (see
+		ThreadScheduler.snapshot); they're just skipped again on the next visit)
+
+		Cleans the thread's posts newer than `high_water` and stages them in `chan_ingester`,
+		which writes them to the database in bulk, along with their quotelinks and stats for
+		the chan_post_links/chan_post_meta side tables. CPU heavy, so the event loop runs it in
+		`db_executor`.
+	'''
+	rows = []
+	meta_rows = []
+	link_rows = []
+	for post in reversed(thread_obj): # newest first, stop at what we already have
+		if post['no'] <= high_water:
+			break
+		try:
+			comment = post['com']
+		except:
+			comment = ""
+		insert = False
+		quoted = []
+		greentext_lines = 0
+		if comment != "": # clean html (don't want it to affect toxicity analysis)
+			insert = True
+			comment, quoted, greentext_lines = parseComment(comment)
+		elif post['resto'] == 0:
+			# insert an empty comment IFF it is the original post of a thread
+			insert = True
+
+		original_length = len(comment)
+		if len(comment) > 2500:
+			comment = comment[0:2500]
+		if insert:
+			rows.append((post['time'], board, post['resto'], post['no'], comment))
+			meta_rows.append((board, post['no'], greentext_lines, original_length))
+			link_rows.extend((board, post['no'], quoted_board or board, quoted_post) for quoted_board, quoted_post in quoted)
+	# side tables first: they're flushed with chan_ingester, which could flush as soon as it has the posts
+	chan_meta_ingester.addMany(meta_rows)
+	chan_links_ingester.addMany(link_rows)
+	chan_ingester.addMany(rows)
+	return rows[0][3] if rows else high_water # rows are newest first
+
+def isThreadDead(op: dict) -> bool:
+	try:
+		archived = op['archived']
+	except:
+		archived = 0
+	try:
+		closed = op['closed']
+	except:
+		closed = 0
+	return bool(archived or closed)
+
+def markThreadDead(board: str, thread: int):
+	update_sql = """UPDATE chan_posts
+					SET is_dead = '1'
+					WHERE
+						chan_posts.post_id = %s AND
+						chan_posts.board = %s AND
 						chan_posts.thread_id = 0""" # only spend time setting the OP to be dead
-	
-	if startSize < 20: # no start sizes smaller than 20
-		startSize = 20
-	
-	threadHeaders = {}
-	for thread in threads:
-		threadHeaders[thread] = headers
-	
-	while True:
-		for thread in threads[:]: # threads[:] == copy of threads[]
-			url = f"{CHAN_BASE_URL}/{board}/thread/{thread}.json"
-			response = requests.get(url, headers=threadHeaders[thread])
-			if response.status_code == 200:
-				threadHeaders[thread]["If-Modified-Since"] = convertDate(datetime.fromtimestamp(int(time())))
-				thread_obj = response.json()['posts']
-				
-				conn = getDatabaseConnection()
-				with conn.cursor() as cur: # add to db until conflict then stop
-					for i in range(thread_obj[0]['replies'], -1, -1):
-						post = thread_obj[i]
-						try:
-							comment = post['com']
-						except:
-							comment = ""
-						insert = False
-						if comment != "": # clean html (don't want it to affect toxicity analysis)
-							insert = True
-							cleaner = Cleaner(allow_tags=['br'], page_structure=False)
-							comment = cleaner.clean_html(document_fromstring(comment)).text_content()
-						elif post['resto'] == 0:
-							# insert an empty comment IFF it is the original post of a thread
-							insert = True
-						
-						if len(comment) > 2500:
-							comment = comment[0:2500]
-						if insert:
-							cur.execute(insert_sql, (post['time'], board, post['resto'], post['no'], comment))
-						
-						if cur.rowcount is not None and cur.rowcount < 1 and comment != "": 
-							# if comment == "", then we don't add it, 
-							# 	so it's not safe to stop yet 
-							# if cur.rowcount < 1, the row was already in the db, 
-							# 	so anything before that is also in the db already,
-							#	so we're done
-							break
-				try:
-					archived = thread_obj[0]['archived']
-				except:
-					archived = 0
-				try: 
-					closed = thread_obj[0]['closed']
-				except:
-					closed = 0
-				if archived or closed:
-					cur.execute(update_sql, (thread, board))
-					conn.commit()
-					conn.close()
-					with connection() as client: # faktory connection
-						client.queue("chan_remove_crawl", queue='chan', args=(board, thread))
+	chan_ingester.flush() # the OP might still be staged
+	with db_pool.connection() as conn:
+		with metrics.timeDb("chan_mark_dead"):
+			with conn.cursor() as cur:
+				cur.execute(update_sql, (thread, board))
+			conn.commit()
+	queueRemoveThread(board, thread)
+
+def queueRemoveThread(board: str, thread: int):
+	with connection() as client: # faktory connection
+		client.queue("chan_remove_crawl", queue='chan', args=(board, thread))
+
+async def visitThread(state):
+	'''
+		params: `state` (ThreadState popped from `scheduler`)
+
+		returns: none
+
+		Requests /`board`/thread/`thread` once, stages any new posts, and either reschedules
+		the thread or stops crawling it if it 404'd or was archived/closed. Blocking db and
+		faktory calls are handed off to `db_executor`. Releases a `fetch_slots` slot when done.
+	'''
+	loop = asyncio.get_running_loop()
+	board, thread = state.board, state.thread
+	url = f"{CHAN_BASE_URL}/{board}/thread/{thread}.json"
+	started = perf_counter()
+	try:
+		async with session.get(url, headers={"If-Modified-Since": state.last_modified}) as response:
+			metrics.observeRequest('4chan', 'thread', response.status, started)
+			if response.status == 200:
+				last_modified = response.headers.get("Last-Modified", convertDate(datetime.fromtimestamp(int(time()))))
+				thread_obj = (await response.json())['posts']
+				state.high_water = await loop.run_in_executor(db_executor, stageThreadPosts, board, thread_obj, state.high_water)
+				state.last_modified = last_modified # only once the posts are staged (see ThreadScheduler.snapshot)
+				if isThreadDead(thread_obj[0]):
+					scheduler.remove(board, thread)
+					high_water_marks.forgetThread(board, thread)
+					await loop.run_in_executor(db_executor, markThreadDead, board, thread)
 					logging.info(f"/{board}/thread/{thread} dead/archived, job complete")
-					threads.remove(thread)
-				conn.commit()
-				conn.close()
-			elif response.status_code == 304:
+				else:
+					scheduler.recordModified(state, thread_obj[0], time())
+			elif response.status == 304:
+				scheduler.recordNotModified(state, time())
 				if not randrange(0, 250): # 1 in 250 odds to log (arbitrary, just don't want it every time)
-					logging.info(f"/{board}/thread/{thread} not modified since {headers['If-Modified-Since']}")
-			elif response.status_code == 404:
+					logging.info(f"/{board}/thread/{thread} not modified since {state.last_modified}, next visit in {state.interval:.0f}s")
+			elif response.status == 404:
 				logging.info(f"{board}/thread/{thread} does not exist, stopping crawl")
-				conn.close()
-				with connection() as client: # faktory connection
-					client.queue("chan_remove_crawl", queue='chan', args=(board, thread))
-				threads.remove(thread)
+				scheduler.remove(board, thread)
+				high_water_marks.forgetThread(board, thread)
+				await loop.run_in_executor(db_executor, queueRemoveThread, board, thread)
 			else:
-				logging.info(f"Error {response.status_code} getting {board}/thread/{thread}")
+				logging.info(f"Error {response.status} getting {board}/thread/{thread}")
+				scheduler.recordError(state, time())
+	except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+		metrics.observeRequest('4chan', 'thread', 'error', started)
+		logging.info(f"Error {e!r} getting {board}/thread/{thread}")
+		scheduler.recordError(state, time())
+	except Exception:
+		logging.exception(f"Error crawling {board}/thread/{thread}")
+		scheduler.recordError(state, time())
+	finally:
+		fetch_slots.release()
 
-		if len(threads) < (startSize / 2): #less than half as many threads as original = reset
-			with connection() as client: # faktory connection
-				# remove threads. if they're still in the catalog, they'll get crawled 
-				# again, but hopefully in a process crawling more threads
-				for thread in threads:
-					client.queue("chan_remove_crawl", queue='chan', args=(board, thread))
-			return
-		sleep( max(1, 50/len(threads)) ) # fewer threads = sleep longer (want to crawl each thread every 50 seconds)
+async def runScheduler():
+	'''
+		Visits threads as they come due, most overdue first, with at most
+		`MAX_CONNECTIONS_PER_HOST` requests in flight. Sleeps until the next thread is due
+		or `watchThreads` adds new ones.
+	'''
+	while True:
+		await fetch_slots.acquire()
+		state = scheduler.popDue(time())
+		while state is None:
+			scheduler_wakeup.clear()
+			try:
+				await asyncio.wait_for(scheduler_wakeup.wait(), scheduler.secondsUntilNextDue(time()))
+			except asyncio.TimeoutError:
+				pass
+			state = scheduler.popDue(time())
+		task = asyncio.create_task(visitThread(state))
+		visiting.add(task) # the event loop only keeps weak references to tasks
+		task.add_done_callback(visiting.discard)
+
+async def flushPeriodically():
+	'''
+		Writes staged posts to the database whenever `chan_ingester` has enough of them
+		or they've been waiting too long.
+	'''
+	loop = asyncio.get_running_loop()
+	while True:
+		await asyncio.sleep(0.5)
+		if chan_ingester.isDue():
+			await loop.run_in_executor(db_executor, chan_ingester.flush)
+
+async def checkpointPeriodically():
+	'''
+		Saves every watched thread's schedule, Last-Modified and (committed) high-water mark
+		to the local state file, so a restart can pick up where this left off.
+	'''
+	loop = asyncio.get_running_loop()
+	while True:
+		await asyncio.sleep(CHECKPOINT_SECONDS)
+		rows = scheduler.snapshot(high_water_marks.chanHighWater)
+		try:
+			await loop.run_in_executor(db_executor, saveChanThreads, rows)
+		except Exception:
+			logging.exception(f"Failed to checkpoint {len(rows)} threads")
+
+def restoreThreads():
+	'''
+		Schedules the threads saved by the last checkpoint. Called before the event loop
+		starts, after `high_water_marks` is seeded (posts committed after the checkpoint
+		are already in the database, so the larger mark wins).
+	'''
+	now = time()
+	default_last_modified = convertDate(datetime.fromtimestamp(DEFAULT_UNIX_TIME))
+	restored = 0
+	for row in loadChanThreads():
+		board, thread = row[0], row[1]
+		if scheduler.restore(row, now, default_last_modified):
+			state = scheduler.states[(board, thread)]
+			state.high_water = max(state.high_water, high_water_marks.chanHighWater(board, thread))
+			restored += 1
+	logging.info(f"Restored {restored} threads from the last checkpoint")
+
+async def watchThreads(board: str, threads: list):
+	dt = datetime.fromtimestamp(DEFAULT_UNIX_TIME)
+	added = 0
+	for thread in threads:
+		if scheduler.add(board, thread, convertDate(dt)):
+			scheduler.states[(board, thread)].high_water = high_water_marks.chanHighWater(board, thread)
+			added += 1
+		else:
+			scheduler.touch(board, thread, time()) # catalog says it changed
+	scheduler_wakeup.set()
+	logging.info(f"watching {added} new /{board}/ threads, {len(scheduler)} total")
 
 def newCrawlThreads(board: str, threads: list):
 	'''
 		params: `board` (name of 4chan board (in url)), `threads` (array of 4chan thread ids (as ints) in `board`)
 
 		returns: none
-		
-		Creates new processes to crawl 30 /`board`/`thread`s, plus one to crawl
-		any remaining threads. A process is ended and (ideally) recreated when there 
-		are half as many threads to crawl as there were when it started.
-	'''
-	#process_pool.map(crawlThread, [board]*len(threads), threads)
-	i = 0
-	while (i+50) <= len(threads): # [x:y] is inclusive on x, exclusive on y 
-		process_pool.submit(crawlThreads, board, threads[i:i+50])
-		i += 50
-	process_pool.submit(crawlThreads, board, threads[i:], len(threads[i:]))
-
-def getDatabaseConnection():
-	conn = None
-	while conn is None:
-		try: 
-			conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
-		except OperationalError:
-			logging.info("Too many active db connections, waiting and trying again")
-			sleep(4)
-			conn = None
-	return conn
 
+		Hands `threads` to the crawler's event loop, which crawls every live thread of
+		every board in one process. New threads are scheduled; threads that are already
+		being crawled are marked as changed, so in 'diff' mode they get visited again.
+		How often each thread is crawled is up to `scheduler`.
+	'''
+	asyncio.run_coroutine_threadsafe(watchThreads(board, threads), event_loop).result()
+
+async def startCrawler() -> aiohttp.ClientSession:
+	global fetch_slots, scheduler_wakeup, scheduler_task, flush_task, checkpoint_task
+	fetch_slots = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+	scheduler_wakeup = asyncio.Event()
+	scheduler_task = asyncio.create_task(runScheduler())
+	flush_task = asyncio.create_task(flushPeriodically())
+	checkpoint_task = asyncio.create_task(checkpointPeriodically())
+	return await createSession()
+
+async def createSession() -> aiohttp.ClientSession:
+	connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST)
+	timeout = aiohttp.ClientTimeout(total=30)
+	headers = {"User-Agent": f"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/{randrange(111, 120)}.0"}
+	return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+
+
+def start():
+	'''
+		Connects to the database, restores the last checkpoint and starts the event loop (in
+		a background thread). Called once before any `newCrawlThreads` job.
+	'''
+	global db_executor, db_pool, chan_meta_ingester, chan_links_ingester, chan_ingester, event_loop, session
+	# one event loop (in a background thread) crawls every thread; the faktory worker feeds it
+	db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS)
+	# every db call is made from db_executor, so one connection per executor thread is enough
+	db_pool = createPool(1, DB_WORKERS)
+	with db_pool.connection() as conn:
+		high_water_marks.seedChan(conn, int(time() - HWM_SEED_DAYS * 24 * 60 * 60))
+	chan_meta_ingester = BulkIngester('chan_post_meta', CHAN_POST_META_COLUMNS, ('board', 'post_id'), None, None)
+	chan_links_ingester = BulkIngester('chan_post_links', CHAN_POST_LINKS_COLUMNS, CHAN_POST_LINKS_COLUMNS, None, None)
+	chan_ingester = BulkIngester('chan_posts', CHAN_POSTS_COLUMNS, CHAN_POSTS_CONFLICT, db_pool.getconn, db_pool.putconn,
+								companions=(chan_meta_ingester, chan_links_ingester),
+								on_flush=high_water_marks.chanRowsCommitted)
+	restoreThreads()
+	metrics.WATCHED_THREADS.set_function(lambda: len(scheduler))
+	metrics.startMetricsServer('chan_thread')
+	event_loop = asyncio.new_event_loop()
+	threading.Thread(target=event_loop.run_forever, daemon=True).start()
+	session = asyncio.run_coroutine_threadsafe(startCrawler(), event_loop).result()
+
+def stop():
+	'''
+		Stops the event loop, writes whatever is still staged and saves a final checkpoint.
+	'''
+	asyncio.run_coroutine_threadsafe(session.close(), event_loop).result()
+	event_loop.call_soon_threadsafe(event_loop.stop)
+	db_executor.shutdown()
+	chan_ingester.flush()
+	saveChanThreads(scheduler.snapshot(high_water_marks.chanHighWater))
+	db_pool.closeall()
 
 if __name__ == '__main__':
-	process_pool = ProcessPoolExecutor(max_workers=25, mp_context=get_context('spawn'))
-	w = Worker(faktory=FAKTORY_URL, queues=['chan'], concurrency=1)
+	start()
+	# use_threads: jobs have to run in this process, where the event loop is (not in a forked child)
+	w = Worker(faktory=FAKTORY_URL, queues=['chan'], concurrency=1, use_threads=True)
 	w.register('chan_crawl_thread', newCrawlThreads)
 	logging.info("running 4chan thread crawler?")
 	w.run()
-	process_pool.shutdown()
+	stop()
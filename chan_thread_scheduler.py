@@ -0,0 +1,259 @@
+import heapq
+from random import uniform
+from time import time
+
+class ThreadState:
+	'''
+		What the scheduler knows about one watched (board, thread): when it is next due, the
+		interval it was given, and the activity observed on previous visits.
+	'''
+	__slots__ = ('board', 'thread', 'due', 'interval', 'last_modified', 'last_visit', 'last_replies',
+				'post_rate', 'not_modified_count', 'bumplimit', 'imagelimit', 'in_flight', 'touched', 'high_water')
+
+	def __init__(self, board: str, thread: int, due: float, last_modified: str):
+		self.board = board
+		self.thread = thread
+		self.due = due # None while parked (push-only mode) until the catalog reports a change
+		self.interval = 0.0
+		self.last_modified = last_modified # If-Modified-Since header value for the next request
+		self.last_visit = None # unix time of the last 200/304 response
+		self.last_replies = None # OP's `replies` at the last 200 response
+		self.post_rate = 0.0 # estimated replies per second
+		self.not_modified_count = 0 # 304s in a row
+		self.bumplimit = 0
+		self.imagelimit = 0
+		self.in_flight = False
+		self.touched = False # the catalog reported a change while the thread was in flight
+		self.high_water = 0 # newest post number already stored
+
+class ThreadScheduler:
+	'''
+		Priority queue of watched 4chan threads ordered by next-due time. A thread's next
+		visit is set from its observed post rate, whether it hit the bump/image limit, and
+		how many 304s in a row it returned, clamped to [`min_interval`, `max_interval`].
+
+		A popped thread is "in flight" and is not in the heap until one of the `record*`
+		methods reschedules it. Not thread safe; only use it from the crawler's event loop.
+
+		In `push_only` mode, threads are not revisited on a timer. After a visit they are
+		parked until `touch` says the catalog saw them change, so unchanged threads are
+		never requested at all.
+	'''
+	RATE_SMOOTHING = 0.5 # weight of the newest post rate sample
+	BUMPLIMIT_FACTOR = 2.0 # threads past the bump limit sink and die soon, poll them less
+	IMAGELIMIT_FACTOR = 1.5 # no more image replies, so fewer replies overall
+	MAX_NOT_MODIFIED_BACKOFF = 4 # interval doubles per 304 in a row, up to 2**4 times
+
+	def __init__(self, min_interval: float, max_interval: float, target_posts_per_visit: float, push_only: bool = False):
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.target_posts_per_visit = target_posts_per_visit
+		self.push_only = push_only
+		self.states = {} # (board, thread) -> ThreadState
+		self._heap = [] # (due, board, thread); stale entries are skipped when popped
+
+	def __len__(self) -> int:
+		return len(self.states)
+
+	def __contains__(self, key) -> bool:
+		return key in self.states
+
+	def add(self, board: str, thread: int, last_modified: str) -> bool:
+		'''
+			params: `board` (name of 4chan board (in url)), `thread` (4chan thread id),
+			`last_modified` (If-Modified-Since header value for the first request)
+
+			returns: bool (False if the thread was already scheduled)
+
+			Schedules a new thread somewhere in the next `min_interval` seconds so a big
+			batch of new threads doesn't all get requested at once.
+		'''
+		if (board, thread) in self.states:
+			return False
+		state = ThreadState(board, thread, time() + uniform(0, self.min_interval), last_modified)
+		self.states[(board, thread)] = state
+		heapq.heappush(self._heap, (state.due, board, thread))
+		return True
+
+	def snapshot(self, high_water_of) -> list:
+		'''
+			params: `high_water_of` (function of (board, thread) returning the newest post number
+			that is committed to the database)
+
+			returns: list of tuples (board, thread, due, interval, last_modified, last_visit,
+			last_replies, post_rate, not_modified_count, bumplimit, imagelimit, high_water),
+			one per watched thread, for `restore` after a restart
+
+			Only committed posts count towards the high-water mark. A thread with posts that
+			are still staged gets an empty `last_modified`, so it is requested unconditionally
+			after a restart instead of 304ing before the lost posts are fetched again.
+		'''
+		rows = []
+		for state in self.states.values():
+			high_water = min(state.high_water, high_water_of(state.board, state.thread))
+			last_modified = state.last_modified if high_water >= state.high_water else ""
+			rows.append((state.board, state.thread, state.due, state.interval, last_modified, state.last_visit,
+						state.last_replies, state.post_rate, state.not_modified_count, state.bumplimit,
+						state.imagelimit, high_water))
+		return rows
+
+	def restore(self, row: tuple, now: float, default_last_modified: str) -> bool:
+		'''
+			params: `row` (tuple from `snapshot`), `now` (unix time), `default_last_modified`
+			(If-Modified-Since header value to use if the row doesn't have one)
+
+			returns: bool (False if the thread was already scheduled)
+
+			Schedules a thread saved before a restart, keeping its post rate, interval and
+			Last-Modified, so its next visit is a conditional request. Threads that were due
+			(or overdue) are spread over the next `min_interval` seconds; parked threads get
+			one visit somewhere in the next `max_interval` seconds, in case the catalog
+			reported a change while nothing was crawling.
+		'''
+		(board, thread, due, interval, last_modified, last_visit, last_replies, post_rate,
+			not_modified_count, bumplimit, imagelimit, high_water) = row
+		if (board, thread) in self.states:
+			return False
+		state = ThreadState(board, thread, None, last_modified or default_last_modified)
+		state.interval = interval
+		state.last_visit = last_visit
+		state.last_replies = last_replies
+		state.post_rate = post_rate
+		state.not_modified_count = not_modified_count
+		state.bumplimit = bumplimit
+		state.imagelimit = imagelimit
+		state.high_water = high_water
+		self.states[(board, thread)] = state
+		if due is None:
+			due = now + uniform(0, self.max_interval)
+		elif due <= now:
+			due = now + uniform(0, self.min_interval)
+		self._push(state, due)
+		return True
+
+	def remove(self, board: str, thread: int):
+		self.states.pop((board, thread), None)
+
+	def touch(self, board: str, thread: int, now: float) -> bool:
+		'''
+			params: `board` (name of 4chan board (in url)), `thread` (4chan thread id), `now` (unix time)
+
+			returns: bool (False if the thread isn't scheduled)
+
+			Marks a thread as changed so it is visited as soon as `min_interval` allows,
+			even if it is parked or not due for a while.
+		'''
+		state = self.states.get((board, thread))
+		if state is None:
+			return False
+		if state.in_flight:
+			state.touched = True
+			return True
+		due = max(now, (state.last_visit or 0) + self.min_interval)
+		if state.due is None or due < state.due:
+			self._push(state, due)
+		return True
+
+	def popDue(self, now: float):
+		'''
+			params: `now` (unix time)
+
+			returns: ThreadState of the most overdue thread, or None if no thread is due yet
+		'''
+		while self._heap and self._heap[0][0] <= now:
+			due, board, thread = heapq.heappop(self._heap)
+			state = self.states.get((board, thread))
+			if state is not None and state.due == due:
+				state.in_flight = True
+				return state
+		return None
+
+	def secondsUntilNextDue(self, now: float):
+		'''
+			returns: seconds until the next thread is due (0 if one is overdue), or None
+			if nothing is scheduled
+		'''
+		while self._heap:
+			due, board, thread = self._heap[0]
+			state = self.states.get((board, thread))
+			if state is not None and state.due == due:
+				return max(0.0, due - now)
+			heapq.heappop(self._heap)
+		return None
+
+	def recordModified(self, state: ThreadState, op: dict, now: float):
+		'''
+			params: `state` (popped ThreadState), `op` (first post of the thread json), `now` (unix time)
+
+			Updates the thread's post rate from the OP's `replies` count and reschedules it.
+		'''
+		replies = op.get('replies', 0)
+		if state.last_replies is None:
+			# first visit, so average over the thread's whole life
+			elapsed = now - op.get('time', now)
+			new_posts = replies
+		else:
+			elapsed = now - state.last_visit
+			new_posts = max(0, replies - state.last_replies)
+		if elapsed > 0:
+			sample = new_posts / elapsed
+			if state.last_replies is None:
+				state.post_rate = sample
+			else:
+				state.post_rate = self.RATE_SMOOTHING * sample + (1 - self.RATE_SMOOTHING) * state.post_rate
+		state.last_replies = replies
+		state.bumplimit = op.get('bumplimit', 0)
+		state.imagelimit = op.get('imagelimit', 0)
+		state.not_modified_count = 0
+		state.last_visit = now
+		self._reschedule(state, now)
+
+	def recordNotModified(self, state: ThreadState, now: float):
+		if state.last_visit is not None:
+			state.post_rate = (1 - self.RATE_SMOOTHING) * state.post_rate # nothing new since the last visit
+		state.not_modified_count += 1
+		state.last_visit = now
+		self._reschedule(state, now)
+
+	def recordError(self, state: ThreadState, now: float):
+		# keep the old interval, but don't hammer a thread that keeps erroring
+		state.interval = min(self.max_interval, max(self.min_interval, state.interval))
+		self._push(state, now + state.interval)
+
+	def nextInterval(self, state: ThreadState) -> float:
+		'''
+			params: `state` (ThreadState)
+
+			returns: float (seconds until the thread should be visited again)
+
+			Aims for about `target_posts_per_visit` new posts per visit at the thread's
+			current post rate, then backs off for the bump/image limits and repeated 304s.
+		'''
+		if state.post_rate > 0:
+			interval = self.target_posts_per_visit / state.post_rate
+		else:
+			interval = self.max_interval
+		if state.bumplimit:
+			interval *= self.BUMPLIMIT_FACTOR
+		if state.imagelimit:
+			interval *= self.IMAGELIMIT_FACTOR
+		interval *= 2 ** min(state.not_modified_count, self.MAX_NOT_MODIFIED_BACKOFF)
+		return min(self.max_interval, max(self.min_interval, interval))
+
+	def _reschedule(self, state: ThreadState, now: float):
+		state.interval = self.nextInterval(state)
+		if not self.push_only:
+			self._push(state, now + state.interval)
+		elif state.touched:
+			self._push(state, now + self.min_interval)
+		else:
+			state.in_flight = False
+			state.due = None # parked until touched
+
+	def _push(self, state: ThreadState, due: float):
+		if self.states.get((state.board, state.thread)) is not state:
+			return # removed while it was in flight
+		state.in_flight = False
+		state.touched = False
+		state.due = due
+		heapq.heappush(self._heap, (due, state.board, state.thread))
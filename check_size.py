@@ -13,7 +13,10 @@ DB_USER = os.environ.get('DB_USER')
 DB_PASS = os.environ.get('DB_PASS')
 
 def main():
-	sql = """SELECT pg_total_relation_size('{}')"""
+	# a partitioned table's own size is 0, so add up its partitions (see migrations.py)
+	sql = """SELECT pg_total_relation_size('{0}') + COALESCE(SUM(pg_total_relation_size(inhrelid)), 0)
+			FROM pg_inherits
+			WHERE inhparent = '{0}'::regclass"""
 	
 	conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
 	cur = conn.cursor()
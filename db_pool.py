@@ -0,0 +1,141 @@
+import psycopg2
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from dotenv import load_dotenv
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from time import sleep, time
+
+load_dotenv()
+DB_HOST = os.environ.get('DB_HOST')
+DB_PORT = os.environ.get('DB_PORT') # e.g. pgbouncer's 6432. libpq default if unset
+DB_NAME = os.environ.get('DB_NAME')
+DB_USER = os.environ.get('DB_USER')
+DB_PASS = os.environ.get('DB_PASS')
+DB_POOL_HEALTH_CHECK_SECONDS = float(os.environ.get('DB_POOL_HEALTH_CHECK_SECONDS', 30)) # re-check connections idle this long
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 60000))
+# pgbouncer (transaction pooling) rejects the `options` startup parameter and doesn't keep
+# session state between transactions, so don't rely on either
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '0').lower() in ('1', 'true', 'yes')
+
+class DatabasePool:
+	'''
+		Bounded, thread safe pool of long-lived psycopg2 connections. Unlike psycopg2's own
+		pools, `getconn` waits for a free connection instead of raising when all `maxconn`
+		are in use, checks connections that sat idle for a while before handing them out,
+		and reconnects (with backoff) instead of failing when the server refuses.
+	'''
+	def __init__(self, minconn: int, maxconn: int, health_check_seconds: float = DB_POOL_HEALTH_CHECK_SECONDS,
+				pgbouncer: bool = DB_PGBOUNCER, **connect_kwargs):
+		self.maxconn = maxconn
+		self.health_check_seconds = health_check_seconds
+		self.pgbouncer = pgbouncer
+		self.connect_kwargs = connect_kwargs
+		self._idle = [] # (connection, time it was returned), most recently used last
+		self._lock = threading.Lock()
+		self._slots = threading.BoundedSemaphore(maxconn)
+		for _ in range(minconn):
+			self._idle.append((self._connect(), time()))
+
+	def _connect(self):
+		kwargs = dict(self.connect_kwargs)
+		kwargs.setdefault('keepalives', 1)
+		kwargs.setdefault('keepalives_idle', 30)
+		if not self.pgbouncer:
+			kwargs.setdefault('options', f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}")
+		wait = 1
+		while True:
+			try:
+				return psycopg2.connect(**kwargs)
+			except OperationalError as e:
+				logging.info(f"Couldn't connect to db ({str(e).strip()}), trying again in {wait}s")
+				sleep(wait)
+				wait = min(wait * 2, 30)
+
+	def _isHealthy(self, conn, idle_since: float) -> bool:
+		if conn.closed:
+			return False
+		if time() - idle_since < self.health_check_seconds:
+			return True
+		try:
+			with conn.cursor() as cur:
+				cur.execute("SELECT 1")
+			conn.rollback()
+			return True
+		except psycopg2.Error:
+			return False
+
+	def getconn(self):
+		'''
+			returns: psycopg2 connection (blocks until one of the pool's `maxconn` is free)
+
+			Give the connection back with `putconn` (or use `connection()`).
+		'''
+		self._slots.acquire()
+		try:
+			while True:
+				with self._lock:
+					if not self._idle:
+						break
+					conn, idle_since = self._idle.pop()
+				if self._isHealthy(conn, idle_since):
+					return conn
+				logging.info("Discarding broken db connection")
+				self._close(conn)
+			return self._connect()
+		except BaseException:
+			self._slots.release()
+			raise
+
+	def putconn(self, conn):
+		'''
+			params: `conn` (connection from `getconn`)
+
+			Returns `conn` to the pool. Any open transaction is rolled back, and broken
+			connections are closed instead of being reused.
+		'''
+		try:
+			if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+				conn.rollback()
+			if conn.closed:
+				self._close(conn)
+			else:
+				with self._lock:
+					self._idle.append((conn, time()))
+		except psycopg2.Error:
+			self._close(conn)
+		finally:
+			self._slots.release()
+
+	@contextmanager
+	def connection(self):
+		conn = self.getconn()
+		try:
+			yield conn
+		finally:
+			self.putconn(conn)
+
+	def closeall(self):
+		with self._lock:
+			idle, self._idle = self._idle, []
+		for conn, _ in idle:
+			self._close(conn)
+
+	def _close(self, conn):
+		try:
+			conn.close()
+		except psycopg2.Error:
+			pass
+
+def createPool(minconn: int, maxconn: int) -> DatabasePool:
+	'''
+		params: `minconn` (connections to open up front), `maxconn` (most connections open at once)
+
+		returns: DatabasePool connected to the DB_* database from .env
+	'''
+	kwargs = {"host": DB_HOST, "dbname": DB_NAME, "user": DB_USER, "password": DB_PASS, "application_name": "data-collection"}
+	if DB_PORT:
+		kwargs["port"] = DB_PORT
+	return DatabasePool(minconn, maxconn, **kwargs)
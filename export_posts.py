@@ -0,0 +1,164 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+import os
+import sys
+import json
+import shutil
+import logging
+from datetime import datetime, timezone
+from time import time
+from db_pool import createPool
+
+load_dotenv()
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'export')
+EXPORT_SETTLE_HOURS = float(os.environ.get('EXPORT_SETTLE_HOURS', 24)) # a day is exported this long after it ends, once its posts are (mostly) analyzed
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 50000)) # rows per fetch from the server-side cursor (and per Parquet row group)
+DAY = 24 * 60 * 60
+
+# table -> (forum column, [(column, arrow type)]). The forum is in the directory name
+# (hive partitioning), not in the files
+TABLES = {
+	'reddit_posts': ('subreddit', [
+		('timestamp', pa.int64()),
+		('post_id', pa.string()),
+		('comment_id', pa.string()),
+		('comment', pa.string()),
+		('toxicity_rating', pa.float32()),
+		('mhs_class', pa.string()),
+		('mhs_confidence', pa.float32()),
+	]),
+	'chan_posts': ('board', [
+		('timestamp', pa.int64()),
+		('thread_id', pa.int64()),
+		('post_id', pa.int64()),
+		('post', pa.string()),
+		('is_dead', pa.string()),
+		('toxicity_rating', pa.float32()),
+		('mhs_class', pa.string()),
+		('mhs_confidence', pa.float32()),
+	]),
+}
+
+def dayName(day_start: int) -> str:
+	return datetime.fromtimestamp(day_start, timezone.utc).strftime('%Y-%m-%d')
+
+def readWatermark(table: str):
+	'''
+		returns: unix time (start of the first day that hasn't been exported), or None if
+		`table` was never exported
+	'''
+	try:
+		with open(os.path.join(EXPORT_DIR, table, '_watermark.json')) as file:
+			return json.load(file)['exported_until']
+	except FileNotFoundError:
+		return None
+
+def writeWatermark(table: str, exported_until: int):
+	path = os.path.join(EXPORT_DIR, table, '_watermark.json')
+	with open(path + '.tmp', 'w') as file:
+		json.dump({'exported_until': exported_until, 'day': dayName(exported_until)}, file)
+	os.replace(path + '.tmp', path)
+
+def exportDay(conn, table: str, day_start: int) -> int:
+	'''
+		params: `conn` (database connection object returned by psycopg2), `table` (key of
+		`TABLES`), `day_start` (unix time, start of a UTC day)
+
+		returns: int (rows exported)
+
+		Streams the day's posts through a server-side cursor into one Parquet file per
+		forum, {EXPORT_DIR}/{table}/date=YYYY-MM-DD/{forum column}={forum}/part-0.parquet.
+		The files are written to a hidden directory and swapped in at the end, so readers
+		never see a half-written day and exporting a day again replaces it.
+		It is the caller's job to properly open/close the database connection.
+	'''
+	forum_column, columns = TABLES[table]
+	schema = pa.schema(columns)
+	day_dir = os.path.join(EXPORT_DIR, table, f"date={dayName(day_start)}")
+	tmp_dir = os.path.join(EXPORT_DIR, table, f".tmp-date={dayName(day_start)}")
+	shutil.rmtree(tmp_dir, ignore_errors=True) # left over from an interrupted export
+	os.makedirs(tmp_dir)
+
+	sql = f"""SELECT {forum_column}, {', '.join(name for name, _ in columns)}
+			FROM {table}
+			WHERE
+				timestamp >= %s AND
+				timestamp < %s"""
+	writers = {} # forum -> ParquetWriter
+	exported = 0
+	try:
+		# named cursor: rows come from the server `EXPORT_BATCH_ROWS` at a time instead of all at once
+		with conn.cursor(name=f"export_{table}") as cur:
+			cur.itersize = EXPORT_BATCH_ROWS
+			cur.execute(sql, (day_start, day_start + DAY))
+			while True:
+				rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+				if not rows:
+					break
+				by_forum = {}
+				for row in rows:
+					by_forum.setdefault(row[0], []).append(row[1:])
+				for forum, forum_rows in by_forum.items():
+					writer = writers.get(forum)
+					if writer is None:
+						forum_dir = os.path.join(tmp_dir, f"{forum_column}={forum}")
+						os.makedirs(forum_dir)
+						writer = pq.ParquetWriter(os.path.join(forum_dir, 'part-0.parquet'), schema, compression='zstd')
+						writers[forum] = writer
+					arrays = [pa.array(values, type=type) for values, (_, type) in zip(zip(*forum_rows), columns)]
+					writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+				exported += len(rows)
+		conn.rollback() # read only, ends the cursor's transaction
+	finally:
+		for writer in writers.values():
+			writer.close()
+
+	old_dir = os.path.join(EXPORT_DIR, table, f".old-date={dayName(day_start)}")
+	if os.path.exists(day_dir):
+		os.replace(day_dir, old_dir)
+	os.replace(tmp_dir, day_dir)
+	shutil.rmtree(old_dir, ignore_errors=True)
+	return exported
+
+def exportTable(conn, table: str, since: int = None):
+	'''
+		params: `conn` (database connection object returned by psycopg2), `table` (key of
+		`TABLES`), `since` (unix time to (re)export from, instead of the watermark)
+
+		Exports every whole UTC day from the watermark (or the oldest post, the first time)
+		up to the last day that ended at least `EXPORT_SETTLE_HOURS` ago, advancing the
+		watermark after each day, so an interrupted export picks up where it stopped.
+		It is the caller's job to properly open/close the database connection.
+	'''
+	os.makedirs(os.path.join(EXPORT_DIR, table), exist_ok=True)
+	start = since if since is not None else readWatermark(table)
+	if start is None:
+		with conn.cursor() as cur:
+			cur.execute(f"SELECT MIN(timestamp) FROM {table}")
+			oldest = cur.fetchone()[0]
+		conn.rollback()
+		if oldest is None:
+			logging.info(f"{table} is empty, nothing to export")
+			return
+		start = oldest
+	start = start // DAY * DAY
+	end = int(time() - EXPORT_SETTLE_HOURS * 60 * 60) // DAY * DAY
+	for day_start in range(start, end, DAY):
+		started = time()
+		exported = exportDay(conn, table, day_start)
+		writeWatermark(table, day_start + DAY)
+		logging.info(f"Exported {exported} {table} rows from {dayName(day_start)} in {time() - started:.1f}s")
+
+if __name__ == '__main__':
+	# python export_posts.py               export the days since the last export
+	# python export_posts.py YYYY-MM-DD    (re)export from that day, e.g. to pick up late analysis results
+	since = None
+	if len(sys.argv) > 1:
+		since = int(datetime.strptime(sys.argv[1], '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+	pool = createPool(1, 1)
+	with pool.connection() as conn:
+		for table in TABLES:
+			exportTable(conn, table, since)
+	pool.closeall()
@@ -1,38 +1,147 @@
-import faktory 
+import faktory
 from dotenv import load_dotenv
-import os 
-from time import sleep
+import os
+from time import sleep, time
 from datetime import datetime, timedelta
+import logging
+from local_state import getRateLimit, takeCrawlStats
+from rate_limiter import REDDIT_DEFAULT_REQUESTS_PER_SECOND, REDDIT_RATE_LIMIT_RESERVE
 
 load_dotenv()
 SUBREDDITS = os.environ.get('SUBREDDITS').split(',')
 FAKTORY_URL = os.environ.get('FAKTORY_URL')
+MIN_INTERVAL = float(os.environ.get('REDDIT_MIN_INTERVAL', 20)) # seconds between crawls of the busiest listings
+MAX_INTERVAL = float(os.environ.get('REDDIT_MAX_INTERVAL', 1800)) # seconds between crawls of the quietest listings
+TARGET_ITEMS_PER_CRAWL = float(os.environ.get('REDDIT_TARGET_ITEMS_PER_CRAWL', 50)) # half a page, so bursts rarely need paging
+RATE_SMOOTHING = 0.3 # weight of the newest items-per-second sample
+
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+
+class ListingScheduler:
+	'''
+		Decides when to crawl each subreddit's posts ("new") and comments ("comments").
+		Each listing is crawled about every `TARGET_ITEMS_PER_CRAWL / rate` seconds, where
+		rate is the items per second it has been producing (learned from the crawler's
+		stats), clamped to [`MIN_INTERVAL`, `MAX_INTERVAL`]. If that adds up to more
+		requests than Reddit's rate limit allows, every listing is slowed down by the same
+		factor, so busy subreddits keep proportionally more of the budget.
+	'''
+	def __init__(self, listings: list):
+		now = time()
+		self.rate = {} # (subreddit, listing) -> items per second
+		self.last_crawl = {} # (subreddit, listing) -> unix time of the last crawl we know of
+		self.queued = {} # (subreddit, listing) -> unix time we queued it
+		for key in listings:
+			self.rate[key] = TARGET_ITEMS_PER_CRAWL / 60 # crawl every minute until we know better
+			self.last_crawl[key] = now - MAX_INTERVAL # everything is due right away
+		self.budget = REDDIT_DEFAULT_REQUESTS_PER_SECOND
+		self.pages_per_crawl = 1.0
+
+	def learn(self):
+		'''
+			Updates listing rates from the crawls the workers finished (failed ones only
+			stop counting as queued), and the request budget from the last rate limit
+			headers reddit sent.
+		'''
+		for subreddit, listing, new_items, pages, crawled_at in takeCrawlStats():
+			key = (subreddit, listing)
+			if key not in self.rate:
+				continue
+			if pages == 0:
+				self.queued.pop(key, None) # the crawl failed: nothing to learn, but it's due again
+				continue
+			elapsed = crawled_at - self.last_crawl[key]
+			if elapsed > 0:
+				sample = new_items / elapsed
+				self.rate[key] = RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rate[key]
+			self.last_crawl[key] = crawled_at
+			self.queued.pop(key, None)
+			self.pages_per_crawl = 0.05 * pages + 0.95 * self.pages_per_crawl
+
+		rate_limit = getRateLimit()
+		if rate_limit is not None:
+			_, remaining, reset_at, _ = rate_limit
+			seconds_left = reset_at - time()
+			if seconds_left > 0:
+				self.budget = max(0.0, remaining * (1 - REDDIT_RATE_LIMIT_RESERVE)) / seconds_left
+			else:
+				self.budget = REDDIT_DEFAULT_REQUESTS_PER_SECOND # new window, reddit hasn't told us about it yet
+
+	def intervals(self) -> dict:
+		'''
+			returns: dict of (subreddit, listing) -> seconds between crawls
+		'''
+		frequencies = {}
+		for key, rate in self.rate.items():
+			frequencies[key] = min(1 / MIN_INTERVAL, max(1 / MAX_INTERVAL, rate / TARGET_ITEMS_PER_CRAWL))
+		requests_per_second = sum(frequencies.values()) * self.pages_per_crawl
+		scale = min(1.0, self.budget / requests_per_second) if requests_per_second > 0 else 1.0
+		return {key: 1 / (frequency * max(scale, 1e-6)) for key, frequency in frequencies.items()}
+
+	def next(self):
+		'''
+			returns: tuple (subreddit, get_posts, get_comments) for the most overdue subreddit,
+			or None if nothing is due. A subreddit's other listing is crawled in the same
+			job if it's at least half due.
+		'''
+		now = time()
+		intervals = self.intervals()
+		overdue = None
+		for key, interval in intervals.items():
+			if self.isQueued(key, now):
+				continue # still waiting for a worker to crawl it
+			lateness = (now - self.last_crawl[key]) / interval
+			if lateness >= 1 and (overdue is None or lateness > overdue[1]):
+				overdue = (key, lateness)
+		if overdue is None:
+			return None
+
+		subreddit = overdue[0][0]
+		crawl = {}
+		for listing in ("new", "comments"):
+			key = (subreddit, listing)
+			crawl[listing] = key in intervals and not self.isQueued(key, now) and \
+							(now - self.last_crawl[key]) / intervals[key] >= 0.5
+		for listing in crawl:
+			if crawl[listing]:
+				self.queued[(subreddit, listing)] = now
+		return (subreddit, crawl["new"], crawl["comments"])
+
+	def isQueued(self, key, now: float) -> bool:
+		# jobs that were never reported back (e.g. the worker crashed) stop counting after a while
+		return key in self.queued and now - self.queued[key] < MAX_INTERVAL
+
+	def secondsPerRequest(self) -> float:
+		return 1 / max(self.budget, 0.05)
 
 if __name__ == '__main__':
-	subreddits_length = len(SUBREDDITS)
-	reddit_counter = 0
-	get_posts = True
+	listings = []
+	for subreddit in SUBREDDITS:
+		listings.append((subreddit, "new"))
+		if subreddit != 'politics': # get only posts for r/politics (part of CS415)
+			listings.append((subreddit, "comments"))
+	scheduler = ListingScheduler(listings)
 	with faktory.connection() as client:
 		client.queue('reddit_newkey', queue='reddit')
 		last_token_update = datetime.utcnow()
+		last_report = time()
 		while True:
 			if last_token_update < datetime.utcnow() + timedelta(hours=-24):
 				client.queue('reddit_newkey', queue='reddit', priority=9)
 				last_token_update = datetime.utcnow()
-			subreddit = SUBREDDITS[reddit_counter % subreddits_length]
-			reddit_counter += 1
-			if subreddit != 'politics':
-				client.queue('reddit_crawler', queue='reddit', args=(subreddit, get_posts, True))
-			else:
-				# get only posts for r/politics (part of CS415)
-				client.queue('reddit_crawler', queue='reddit', args=('politics', True, False))
-
-			# alternate between getting just comments and posts+comments 
-			if (reddit_counter % subreddits_length) == 0:
-				get_posts = not get_posts
 
-			if get_posts:
-				sleep(3)
-			else:
-				sleep(1.5)
+			scheduler.learn()
+			job = scheduler.next()
+			if job is None:
+				sleep(1)
+				continue
+			client.queue('reddit_crawler', queue='reddit', args=job)
 
+			if time() - last_report > 600:
+				intervals = scheduler.intervals()
+				busiest = sorted(intervals, key=intervals.get)[:5]
+				logging.info(f"budget {scheduler.budget:.2f} req/s; shortest intervals: " +
+							", ".join(f"r/{s}/{l} {intervals[(s, l)]:.0f}s" for s, l in busiest))
+				last_report = time()
+			# pace jobs so the workers' requests fit in the budget
+			sleep(scheduler.secondsPerRequest() * (job[1] + job[2]) * scheduler.pages_per_crawl)
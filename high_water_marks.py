@@ -0,0 +1,154 @@
+import threading
+import logging
+from collections import OrderedDict
+
+class HighWaterMarks:
+	'''
+		In-memory record of the newest item already stored, so crawlers can slice new
+		items out of an API response without asking the database:
+
+		- 4chan: the newest post number stored for each (board, thread)
+		- Reddit: the newest `created_utc` stored for each (subreddit, kind), plus the last
+		`recent_size` fullnames stored (kind is the fullname prefix, "t3" for posts and "t1"
+		for comments, since the two listings are crawled separately)
+
+		Seeded from the database once at startup, then kept up to date by passing
+		`chanRowsCommitted`/`redditRowsCommitted` to a BulkIngester as its `on_flush`.
+		Thread safe.
+	'''
+	def __init__(self, recent_size: int = 2000):
+		self.recent_size = recent_size
+		self._chan = {} # (board, thread) -> post number
+		self._reddit = {} # (subreddit, kind) -> newest created_utc
+		self._recent = {} # (subreddit, kind) -> OrderedDict of recently stored fullnames (used as an ordered set)
+		self._lock = threading.Lock()
+
+	def seedChan(self, conn, since: int):
+		'''
+			params: `conn` (database connection object returned by psycopg2), `since` (unix
+			time; only threads with posts newer than this are loaded)
+
+			It is the caller's job to properly open/close the database connection.
+		'''
+		sql = """SELECT board, thread_id, MAX(post_id)
+				FROM chan_posts
+				WHERE
+					thread_id <> 0 AND
+					timestamp > %s
+				GROUP BY board, thread_id
+				UNION ALL
+				SELECT board, post_id, post_id
+				FROM chan_posts
+				WHERE
+					thread_id = 0 AND
+					timestamp > %s"""
+		with conn.cursor() as cur:
+			cur.execute(sql, (since, since))
+			rows = cur.fetchall()
+		conn.rollback()
+		with self._lock:
+			for board, thread, post_id in rows:
+				if post_id > self._chan.get((board, thread), 0):
+					self._chan[(board, thread)] = post_id
+		logging.info(f"Loaded high-water marks for {len(self._chan)} 4chan threads")
+
+	def seedReddit(self, conn):
+		'''
+			params: `conn` (database connection object returned by psycopg2)
+
+			It is the caller's job to properly open/close the database connection.
+		'''
+		sql = """SELECT r.subreddit, r.timestamp, r.comment_id
+				FROM reddit_posts r
+				JOIN (SELECT subreddit, LEFT(comment_id, 2) AS kind, MAX(timestamp) AS max_timestamp
+						FROM reddit_posts
+						GROUP BY subreddit, LEFT(comment_id, 2)) newest
+				ON
+					r.subreddit = newest.subreddit AND
+					LEFT(r.comment_id, 2) = newest.kind AND
+					r.timestamp = newest.max_timestamp"""
+		with conn.cursor() as cur:
+			cur.execute(sql)
+			rows = cur.fetchall()
+		conn.rollback()
+		with self._lock:
+			for subreddit, timestamp, fullname in rows:
+				self._observeReddit(subreddit, timestamp, fullname)
+		logging.info(f"Loaded high-water marks for {len(self._reddit)} subreddit listings")
+
+	def chanHighWater(self, board: str, thread: int) -> int:
+		return self._chan.get((board, thread), 0)
+
+	def forgetThread(self, board: str, thread: int):
+		with self._lock:
+			self._chan.pop((board, thread), None)
+
+	def chanRowsCommitted(self, rows: list):
+		'''
+			params: `rows` (chan_posts rows, in bulk_ingest.CHAN_POSTS_COLUMNS order, that were just committed)
+		'''
+		with self._lock:
+			for _, board, thread_id, post_id, _ in rows:
+				key = (board, thread_id or post_id) # thread_id = 0 for the OP of a thread
+				if post_id > self._chan.get(key, 0):
+					self._chan[key] = post_id
+
+	def hasRedditListing(self, subreddit: str, kind: str) -> bool:
+		'''
+			returns: bool (True if anything of `kind` ("t3"/"t1") from `subreddit` is stored)
+		'''
+		return (subreddit, kind) in self._reddit
+
+	def splitRedditItems(self, subreddit: str, children: list):
+		'''
+			params: `subreddit` (str), `children` (list of posts/comments as dicts, from a
+			new.json/comments.json listing)
+
+			returns: tuple of two lists of `children`: the ones that are definitely new, and
+			the ones that might already be stored (in listing order)
+
+			Anything newer than the listing's high-water mark is new, and anything among
+			the recently stored fullnames is already stored. The rest (older than the mark,
+			but not recent, e.g. right after startup or when Reddit returns something out of
+			`created_utc` order) has to be checked against the database.
+		'''
+		new_items = []
+		unknown_items = []
+		with self._lock:
+			for child in children:
+				item = child['data']
+				key = (subreddit, item['name'][:2])
+				newest = self._reddit.get(key)
+				if newest is None or int(item['created_utc']) > newest:
+					new_items.append(child)
+				elif item['name'] not in self._recent[key]:
+					unknown_items.append(child)
+		return new_items, unknown_items
+
+	def redditRowsCommitted(self, rows: list):
+		'''
+			params: `rows` (reddit_posts rows, in bulk_ingest.REDDIT_POSTS_COLUMNS order, that were just committed)
+		'''
+		with self._lock:
+			for timestamp, subreddit, _, fullname, _ in rows:
+				self._observeReddit(subreddit, timestamp, fullname)
+
+	def markRedditStored(self, subreddit: str, items: list):
+		'''
+			params: `subreddit` (str), `items` (posts/comments as dicts, found in the database)
+
+			Remembers items that turned out to be stored already, so they aren't checked again.
+		'''
+		with self._lock:
+			for item in items:
+				self._observeReddit(subreddit, int(item['created_utc']), item['name'])
+
+	def _observeReddit(self, subreddit: str, timestamp: int, fullname: str):
+		key = (subreddit, fullname[:2])
+		if timestamp > self._reddit.get(key, 0):
+			self._reddit[key] = timestamp
+		recent = self._recent.setdefault(key, OrderedDict())
+		recent[fullname] = None
+		recent.move_to_end(fullname)
+		if len(recent) > self.recent_size:
+			recent.popitem(last=False)
@@ -0,0 +1,204 @@
+import sqlite3
+from dotenv import load_dotenv
+import os
+import threading
+from time import time
+
+load_dotenv()
+LOCAL_STATE_DB = os.environ.get('LOCAL_STATE_DB', 'crawl_state.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reddit_rate_limit (
+	id INTEGER PRIMARY KEY CHECK (id = 0),
+	used REAL,
+	remaining REAL,
+	reset_at REAL, -- unix time the rate limit window resets
+	updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS reddit_token_bucket (
+	id INTEGER PRIMARY KEY CHECK (id = 0),
+	tokens REAL NOT NULL,
+	refill_per_second REAL NOT NULL,
+	refill_until REAL NOT NULL, -- unix time the refill rate stops applying (the rate limit window reset)
+	updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reddit_crawl_stats (
+	subreddit TEXT NOT NULL,
+	listing TEXT NOT NULL, -- "new" (posts) or "comments"
+	new_items INTEGER NOT NULL,
+	pages INTEGER NOT NULL, -- 0 if the crawl failed
+	crawled_at REAL NOT NULL
+);
+-- 4chan catalog crawler: last threads.json/catalog.json Last-Modified, and the threads it has sent to the thread crawler
+CREATE TABLE IF NOT EXISTS chan_board_state (
+	board TEXT PRIMARY KEY,
+	last_modified TEXT NOT NULL, -- If-Modified-Since header value for the next poll
+	saved_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chan_catalog_threads (
+	board TEXT NOT NULL,
+	thread INTEGER NOT NULL,
+	last_modified INTEGER, -- the thread's last_modified/replies in the last threads.json (NULL if unknown)
+	replies INTEGER,
+	ignored INTEGER NOT NULL, -- sticky/closed, never crawled
+	PRIMARY KEY (board, thread)
+);
+-- 4chan thread crawler: its scheduler's state for every watched thread (see chan_thread_scheduler.py)
+CREATE TABLE IF NOT EXISTS chan_thread_state (
+	board TEXT NOT NULL,
+	thread INTEGER NOT NULL,
+	due REAL, -- NULL while parked
+	interval REAL NOT NULL,
+	last_modified TEXT NOT NULL,
+	last_visit REAL,
+	last_replies INTEGER,
+	post_rate REAL NOT NULL,
+	not_modified_count INTEGER NOT NULL,
+	bumplimit INTEGER NOT NULL,
+	imagelimit INTEGER NOT NULL,
+	high_water INTEGER NOT NULL,
+	PRIMARY KEY (board, thread)
+);
+"""
+
+_local = threading.local()
+
+def getLocalState() -> sqlite3.Connection:
+	'''
+		returns: sqlite3 connection to the `LOCAL_STATE_DB` file
+
+		A small on-disk store for state shared between processes on this machine (e.g. the
+		reddit crawler and its job producer). Each thread of each process gets its own
+		connection, so it's safe to call from forked faktory workers. Connections are in
+		autocommit mode; use `BEGIN IMMEDIATE` for read-modify-write transactions.
+	'''
+	conn = getattr(_local, 'conn', None)
+	if conn is None or _local.pid != os.getpid():
+		conn = sqlite3.connect(LOCAL_STATE_DB, timeout=30, isolation_level=None)
+		conn.execute("PRAGMA journal_mode=WAL") # readers don't block the writer
+		conn.execute("PRAGMA synchronous=NORMAL")
+		conn.executescript(SCHEMA)
+		_local.conn = conn
+		_local.pid = os.getpid()
+	return conn
+
+def recordRateLimit(headers):
+	'''
+		params: `headers` (headers of a response from oauth.reddit.com)
+
+		Saves Reddit's X-Ratelimit-Used/Remaining/Reset headers, if the response has them.
+	'''
+	try:
+		used = float(headers['X-Ratelimit-Used'])
+		remaining = float(headers['X-Ratelimit-Remaining'])
+		reset = float(headers['X-Ratelimit-Reset']) # seconds until the window resets
+	except (KeyError, ValueError):
+		return
+	now = time()
+	getLocalState().execute("""INSERT OR REPLACE INTO reddit_rate_limit(id, used, remaining, reset_at, updated_at)
+							VALUES (0, ?, ?, ?, ?)""", (used, remaining, now + reset, now))
+
+def getRateLimit():
+	'''
+		returns: tuple (used, remaining, reset_at, updated_at) from the last reddit response, or None
+	'''
+	return getLocalState().execute("""SELECT used, remaining, reset_at, updated_at
+									FROM reddit_rate_limit WHERE id = 0""").fetchone()
+
+def recordCrawl(subreddit: str, listing: str, new_items: int, pages: int):
+	getLocalState().execute("""INSERT INTO reddit_crawl_stats(subreddit, listing, new_items, pages, crawled_at)
+							VALUES (?, ?, ?, ?, ?)""", (subreddit, listing, new_items, pages, time()))
+
+def recordCrawlFailed(subreddit: str, listing: str):
+	'''
+		Records a crawl that got nothing (e.g. reddit answered 5xx), as one of 0 pages, so
+		the listing can be queued again without it counting as a crawl that found no new items.
+	'''
+	recordCrawl(subreddit, listing, 0, 0)
+
+def takeCrawlStats() -> list:
+	'''
+		returns: list of (subreddit, listing, new_items, pages, crawled_at) recorded since the
+		last call, oldest first. They're deleted, so only one process should take them.
+	'''
+	conn = getLocalState()
+	conn.execute("BEGIN IMMEDIATE")
+	try:
+		rows = conn.execute("""SELECT rowid, subreddit, listing, new_items, pages, crawled_at
+							FROM reddit_crawl_stats ORDER BY rowid""").fetchall()
+		if rows:
+			conn.execute("DELETE FROM reddit_crawl_stats WHERE rowid <= ?", (rows[-1][0],))
+		conn.execute("COMMIT")
+	except BaseException:
+		conn.execute("ROLLBACK")
+		raise
+	return [row[1:] for row in rows]
+
+def saveChanBoard(board: str, last_modified: str, threads: dict, ignored: set):
+	'''
+		params: `board` (name of 4chan board (in url)), `last_modified` (If-Modified-Since
+		header value for the next poll), `threads` (dict of thread no -> (last_modified,
+		replies) or None), `ignored` (set of sticky/closed thread nos)
+
+		Replaces the board's saved catalog state in one transaction.
+	'''
+	rows = [(board, no, *(values or (None, None)), 0) for no, values in threads.items()]
+	rows += [(board, no, None, None, 1) for no in ignored if no not in threads]
+	conn = getLocalState()
+	conn.execute("BEGIN IMMEDIATE")
+	try:
+		conn.execute("""INSERT OR REPLACE INTO chan_board_state(board, last_modified, saved_at)
+						VALUES (?, ?, ?)""", (board, last_modified, time()))
+		conn.execute("DELETE FROM chan_catalog_threads WHERE board = ?", (board,))
+		conn.executemany("""INSERT INTO chan_catalog_threads(board, thread, last_modified, replies, ignored)
+							VALUES (?, ?, ?, ?, ?)""", rows)
+		conn.execute("COMMIT")
+	except BaseException:
+		conn.execute("ROLLBACK")
+		raise
+
+def loadChanBoard(board: str):
+	'''
+		returns: tuple (last_modified, threads, ignored) as given to `saveChanBoard`, or None
+		if nothing is saved for `board`
+	'''
+	conn = getLocalState()
+	row = conn.execute("SELECT last_modified FROM chan_board_state WHERE board = ?", (board,)).fetchone()
+	if row is None:
+		return None
+	threads = {}
+	ignored = set()
+	for no, last_modified, replies, is_ignored in conn.execute("""SELECT thread, last_modified, replies, ignored
+																FROM chan_catalog_threads WHERE board = ?""", (board,)):
+		if is_ignored:
+			ignored.add(no)
+		else:
+			threads[no] = (last_modified, replies) if last_modified is not None else None
+	return row[0], threads, ignored
+
+def saveChanThreads(rows: list):
+	'''
+		params: `rows` (list of tuples in chan_thread_state column order, from
+		`ThreadScheduler.snapshot`)
+
+		Replaces every saved thread in one transaction (a checkpoint).
+	'''
+	conn = getLocalState()
+	conn.execute("BEGIN IMMEDIATE")
+	try:
+		conn.execute("DELETE FROM chan_thread_state")
+		conn.executemany("""INSERT INTO chan_thread_state(board, thread, due, interval, last_modified, last_visit,
+								last_replies, post_rate, not_modified_count, bumplimit, imagelimit, high_water)
+							VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+		conn.execute("COMMIT")
+	except BaseException:
+		conn.execute("ROLLBACK")
+		raise
+
+def loadChanThreads() -> list:
+	'''
+		returns: list of the tuples last given to `saveChanThreads`
+	'''
+	return getLocalState().execute("""SELECT board, thread, due, interval, last_modified, last_visit,
+										last_replies, post_rate, not_modified_count, bumplimit, imagelimit, high_water
+									FROM chan_thread_state""").fetchall()
@@ -0,0 +1,103 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from dotenv import load_dotenv
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter, sleep
+
+load_dotenv()
+# default port of each service's /metrics endpoint, overridden by METRICS_PORT_<SERVICE> (0 turns it off).
+# a process whose port is taken (e.g. the 2nd toxicity worker) uses the next free one
+METRICS_PORTS = {
+	'chan_catalog': 9101,
+	'chan_thread': 9102,
+	'reddit': 9110,
+	'toxicity': 9120, # one per TOXICITY_WORKERS process
+	'mhs': 9130,
+}
+METRICS_PORT_TRIES = 10
+BACKLOG_SECONDS = 60 # how often analyzers count the posts waiting for them
+
+REQUEST_SECONDS = Histogram('crawler_request_seconds', "HTTP request latency, by endpoint and response status ('error' if there was no response)",
+							['site', 'endpoint', 'status'])
+DB_SECONDS = Histogram('db_seconds', "Database round trip time, by operation", ['operation'])
+ROWS_INSERTED = Counter('db_rows_inserted_total', "Rows written by a BulkIngester that weren't in the table yet", ['table'])
+ROWS_DEAD_LETTERED = Counter('db_rows_dead_lettered_total', "Rows a BulkIngester gave up on because the database refused them", ['table'])
+BATCH_SECONDS = Histogram('analyzer_batch_seconds', "Time to score one batch (the model, or the MHS requests)", ['analyzer'],
+						buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160))
+POSTS_ANALYZED = Counter('analyzer_posts_total', "Posts scored, by whether the score came from the cache or was computed", ['analyzer', 'source'])
+BACKLOG = Gauge('analyzer_backlog_posts', "Posts waiting to be analyzed", ['analyzer', 'table'])
+WATCHED_THREADS = Gauge('chan_watched_threads', "4chan threads the thread crawler is watching")
+LISTING_GAPS = Counter('reddit_listing_gaps_total', "Crawls that ran out of pages before reaching stored items (so items were lost)",
+						['subreddit', 'listing'])
+
+_started_pid = None
+
+def startMetricsServer(service: str):
+	'''
+		params: `service` (key of `METRICS_PORTS`)
+
+		Serves this process's metrics at http://localhost:{port}/metrics, from a daemon
+		thread. Safe to call more than once (e.g. at the start of every faktory job, since
+		jobs run in forked worker processes that don't share the parent's metrics).
+	'''
+	global _started_pid
+	if _started_pid == os.getpid():
+		return
+	_started_pid = os.getpid()
+	port = int(os.environ.get(f'METRICS_PORT_{service.upper()}', METRICS_PORTS[service]))
+	if not port:
+		return
+	for offset in range(METRICS_PORT_TRIES):
+		try:
+			start_http_server(port + offset, addr='127.0.0.1')
+		except OSError: # in use, probably by another process of the same service
+			continue
+		logging.info(f"Serving {service} metrics at http://127.0.0.1:{port + offset}/metrics")
+		return
+	logging.warning(f"No free port for {service} metrics in {port}-{port + METRICS_PORT_TRIES - 1}")
+
+def observeRequest(site: str, endpoint: str, status, started: float):
+	'''
+		params: `site`/`endpoint` (labels, e.g. "4chan"/"thread"), `status` (HTTP status
+		code, or "error"), `started` (perf_counter() when the request was sent)
+	'''
+	REQUEST_SECONDS.labels(site, endpoint, str(status)).observe(perf_counter() - started)
+
+@contextmanager
+def timeDb(operation: str):
+	'''
+		Times the block as one `operation` in `DB_SECONDS` (whether or not it raises).
+	'''
+	started = perf_counter()
+	try:
+		yield
+	finally:
+		DB_SECONDS.labels(operation).observe(perf_counter() - started)
+
+def reportBacklog(getconn, putconn, analyzer: str, pending: dict):
+	'''
+		params: `getconn`/`putconn` (connection pool functions), `analyzer` (label),
+		`pending` (dict of table -> WHERE clause matching the posts waiting for `analyzer`,
+		which should match a partial index (see migrations.py) so counting is cheap)
+
+		Starts a daemon thread that sets `BACKLOG` every `BACKLOG_SECONDS`.
+	'''
+	def run():
+		while True:
+			try:
+				conn = getconn()
+				try:
+					with conn.cursor() as cur:
+						for table, predicate in pending.items():
+							with timeDb(f"{analyzer}_backlog"):
+								cur.execute(f"SELECT count(*) FROM {table} WHERE {predicate}")
+							BACKLOG.labels(analyzer, table).set(cur.fetchone()[0])
+					conn.rollback()
+				finally:
+					putconn(conn)
+			except Exception:
+				logging.exception(f"Failed to count the {analyzer} backlog")
+			sleep(BACKLOG_SECONDS)
+	threading.Thread(target=run, name=f"{analyzer}-backlog", daemon=True).start()
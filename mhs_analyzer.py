@@ -1,13 +1,15 @@
-import requests
 from psycopg2.pool import ThreadedConnectionPool
 from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 import os
-from time import sleep
-from json import JSONEncoder
+from time import sleep, time
 import threading
 import logging
 from sys import exit
+from mhs_client import MHSClient
+import score_cache
+import rollups
+import metrics
 
 load_dotenv()
 DB_HOST = os.environ.get('DB_HOST')
@@ -15,28 +17,43 @@ DB_NAME = os.environ.get('DB_NAME')
 DB_USER = os.environ.get('DB_USER')
 DB_PASS = os.environ.get('DB_PASS')
 
-MHS_API_KEY = os.environ.get('MHS_API_KEY')
-HEADERS = {"Content-Type": "application/json"}
-MHS_BASE_URL = "https://api.moderatehatespeech.com/api/v1/moderate/"
-REDDIT_UPDATE_SQL = """UPDATE reddit_posts 
+# also marks the scored posts' hours dirty, for rollups.py. matching `timestamp` too lets
+# postgres skip all but the posts' monthly partitions (see DB_PARTITION_POSTS)
+REDDIT_UPDATE_SQL = rollups.markingDirty("""UPDATE reddit_posts 
 					SET
 						mhs_class = data.class, 
-						mhs_confidence = data.confidence 
+						mhs_confidence = data.confidence::real 
 					FROM (VALUES %s) 
-					AS data (comment_id, comment, class, confidence) 
+					AS data (comment_id, comment, timestamp, class, confidence) 
 					WHERE 
-						reddit_posts.comment_id = data.comment_id"""
-CHAN_UPDATE_SQL = """UPDATE chan_posts 
+						reddit_posts.comment_id = data.comment_id AND
+						reddit_posts.timestamp = data.timestamp""", 'reddit')
+CHAN_UPDATE_SQL = rollups.markingDirty("""UPDATE chan_posts 
 				SET 
 					mhs_class = data.class, 
-					mhs_confidence = data.confidence 
+					mhs_confidence = data.confidence::real 
 				FROM (VALUES %s) 
-				AS data (board, post_id, post, class, confidence) 
+				AS data (board, post_id, post, timestamp, class, confidence) 
 				WHERE 
 					chan_posts.board = data.board AND 
-					chan_posts.post_id = data.post_id"""
+					chan_posts.post_id = data.post_id AND
+					chan_posts.timestamp = data.timestamp""", '4chan')
+
+BATCH_SIZE = 100
+# posts waiting for MHS; match the partial indexes (migrations.py), so counting them is cheap
+PENDING = {
+	'reddit_posts': "mhs_class IS NULL AND comment NOT LIKE ''",
+	'chan_posts': "mhs_class IS NULL AND post NOT LIKE ''",
+}
+MHS_MAX_ATTEMPTS = int(os.environ.get('MHS_MAX_ATTEMPTS', 5)) # tries before a post is given up on (marked 'ERROR')
+MHS_RETRY_SECONDS = int(os.environ.get('MHS_RETRY_SECONDS', 60)) # wait before the first retry, doubled per attempt
+MAX_RETRY_SECONDS = 6 * 60 * 60
+RETRY_SHARE = 25 # most posts of a batch that are retries, while there are new posts waiting
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+REPORT_SECONDS = 600
+
+mhs_cache = score_cache.mhsCache() # results for texts we've seen before, so duplicates aren't sent to MHS
 
 def main(reddit: bool):
 	'''
@@ -44,111 +61,212 @@ def main(reddit: bool):
 
 		returns: none/never (infinite loop)
 
-		Gets newest posts/comments from PostgreSQL database, makes POST requests 
-		to the ModerateHateSpeech (MHS) API, and updates the database with the 
-		analysis done by MHS.
+		Gets newest posts/comments from PostgreSQL database, sends them to the
+		ModerateHateSpeech (MHS) API concurrently through `mhs_client`, and updates
+		the database with the analysis done by MHS. Texts in `mhs_cache`, or repeated
+		within the batch, are only sent once.
+
+		Posts MHS couldn't analyze right now get a row in the site's retry table, and are
+		tried again (as part of a later batch) after a backoff, until they've had
+		`MHS_MAX_ATTEMPTS`. Retries never take more than `RETRY_SHARE` posts of a batch while
+		there are new posts, so a recovering MHS doesn't starve them. While the circuit
+		breaker is open nothing is fetched or sent.
 	'''
 	if reddit:
 		getposts = getUnanalyzedRedditPosts
+		getretries = getRedditRetries
 		update_sql = REDDIT_UPDATE_SQL
+		posts_table, retry_table, key_columns = "reddit_posts", "reddit_mhs_retry", ("comment_id",)
 	else:
 		getposts = getUnanalyzed4chanPosts
+		getretries = get4chanRetries
 		update_sql = CHAN_UPDATE_SQL
+		posts_table, retry_table, key_columns = "chan_posts", "chan_mhs_retry", ("board", "post_id")
+	key_length = len(key_columns) # posts are (*key, text, timestamp)
 	
+	last_report = time()
 	while True:
+		wait = mhs_client.breaker.secondsUntilProbe()
+		if wait > 0:
+			sleep(wait)
+			continue
+
 		conn = connection_pool.getconn()
-		posts = getposts(conn)
+		with metrics.timeDb(f"mhs_fetch_{posts_table}"):
+			retries = getretries(conn, BATCH_SIZE)
+			new_posts = getposts(conn, BATCH_SIZE)
+		retries = retries[:max(RETRY_SHARE, BATCH_SIZE - len(new_posts))]
+		posts = retries + new_posts[:BATCH_SIZE - len(retries)]
+		texts = [post[key_length] for post in posts]
+		with metrics.timeDb("mhs_cache_lookup"):
+			cached = mhs_cache.lookup(conn, texts)
 		connection_pool.putconn(conn)
 
 		if posts:
-			for i in range(len(posts)):
-				# MHS is lame so we have to make it a json string
-				post_data = JSONEncoder().encode({"token": MHS_API_KEY, "text": posts[i][1 if reddit else 2]})
-				
-				try:
-					response = requests.post(MHS_BASE_URL, headers=HEADERS, data=post_data)
-					if response.status_code == 200:
-						response_data = response.json()
-						#print(response_data)
-						if response_data['response'] == 'Success':
-							posts[i] = posts[i] + (response_data['class'], float(response_data['confidence']),)
-						else:
-							# we got a fail response, so assume post can 
-							# never be analyzed and make its mhs_class non-null
-							posts[i] = posts[i] + ('N/A', None)
-					elif response.status_code >= 500:
-						logging.info(f"MHS might be down (HTTP {response.status_code}), sleeping for 3 mins")
-						posts[i] = posts[i] + (None, None)
-						sleep(60*3)
-					else:
-						logging.info(f"MHS returned status code {response.status_code} for \'{posts[i][1 if reddit else 2]}\'")
-						posts[i] = posts[i] + (None, None)
-						
-				except KeyError as e: 
-					try:
-						error_msg = response_data['error']
-						logging.info(f"MHS Error: \'{error_msg}\' for \'{posts[i][1 if reddit else 2]}\'")
-						posts[i] = posts[i] + ('ERROR', None)
-						continue
-					except KeyError:
-						pass
-					logging.info(f"MHS KeyError accessing {e}: {response_data}")
-					posts[i] = posts[i] + (None, None)
-				except Exception as e: # no response (e.g. connection timeout)
-					logging.exception(f"MHS Error!")
-					posts[i] = posts[i] + (None, None)
-			
+			to_send = list(dict.fromkeys(text for text, result in zip(texts, cached) if result is None))
+			started = time()
+			results = dict(zip(to_send, mhs_client.moderateMany(to_send)))
+			if to_send:
+				metrics.BATCH_SECONDS.labels('mhs').observe(time() - started)
+			from_cache = sum(1 for result in cached if result is not None)
+			metrics.POSTS_ANALYZED.labels('mhs', 'cache').inc(from_cache)
+			metrics.POSTS_ANALYZED.labels('mhs', 'api').inc(len(posts) - from_cache)
+
+			analyzed = []
+			failed = []
+			for post, text, result in zip(posts, texts, cached):
+				result = result or results[text]
+				if result is None:
+					continue # not sent (circuit breaker open), it'll be fetched again
+				elif result[0] is None:
+					failed.append(post[:key_length])
+				else:
+					analyzed.append(post + result)
+			retried = {post[:key_length] for post in retries}
+			timestamps = {post[:key_length]: post[-1] for post in posts}
+
 			conn = connection_pool.getconn()
+			write_started = time()
 			with conn.cursor() as cur:
-				execute_values(cur, update_sql, posts)
+				if analyzed:
+					execute_values(cur, update_sql, analyzed)
+				finished = [post[:key_length] for post in analyzed if post[:key_length] in retried]
+				if failed:
+					gave_up = scheduleRetries(cur, retry_table, key_columns, failed)
+					if gave_up:
+						logging.info(f"Giving up on {len(gave_up)} {posts_table} after {MHS_MAX_ATTEMPTS} attempts")
+						execute_values(cur, f"""UPDATE {posts_table} SET mhs_class = 'ERROR'
+											WHERE ({', '.join(key_columns)}, timestamp) IN (VALUES %s)""",
+										[key + (timestamps[key],) for key in gave_up])
+						finished += gave_up
+				if finished:
+					execute_values(cur, f"""DELETE FROM {retry_table}
+										WHERE ({', '.join(key_columns)}) IN (VALUES %s)""", finished)
+			# (None, None) means try again later, so don't remember it
+			mhs_cache.store(conn, {text: result for text, result in results.items() if result is not None and result[0] is not None})
 			
 			conn.commit()
+			metrics.DB_SECONDS.labels(f"mhs_write_{posts_table}").observe(time() - write_started)
 			connection_pool.putconn(conn)
+
+			if time() - last_report >= REPORT_SECONDS:
+				logging.info(f"MHS cache hit rate {mhs_cache.hitRate():.1%} ({mhs_cache.hits} hits, {mhs_cache.db_hits} from the db)")
+				last_report = time()
 		else:
 			# we had no posts to analyze, so wait for a while for some to accumulate
 			sleep(10)
 
+def scheduleRetries(cur, retry_table: str, key_columns: tuple, keys: list) -> list:
+	'''
+		params: `cur` (psycopg2 cursor), `retry_table` (reddit_mhs_retry/chan_mhs_retry),
+		`key_columns` (the posts' key columns), `keys` (keys of posts MHS couldn't analyze)
+
+		returns: list of the `keys` that have had `MHS_MAX_ATTEMPTS` attempts
 
-def getUnanalyzedRedditPosts(conn) -> list:
+		Counts an attempt for each post and sets when it should be tried again.
 	'''
-		params: `conn` (database connection object returned by psycopg2)
+	columns = ", ".join(key_columns)
+	sql = f"""INSERT INTO {retry_table} ({columns}, attempts, next_retry_at)
+			VALUES %s
+			ON CONFLICT ({columns}) DO UPDATE SET
+				attempts = {retry_table}.attempts + 1,
+				next_retry_at = now() + LEAST({MAX_RETRY_SECONDS}, {MHS_RETRY_SECONDS} * 2 ^ {retry_table}.attempts) * interval '1 second'
+			RETURNING {columns}, attempts"""
+	template = "(" + ", ".join(["%s"] * len(key_columns)) + f", 1, now() + {MHS_RETRY_SECONDS} * interval '1 second')"
+	rows = execute_values(cur, sql, keys, template=template, fetch=True)
+	return [tuple(row[:-1]) for row in rows if row[-1] >= MHS_MAX_ATTEMPTS]
 
-		returns: List of tuples of *most recent* unanalyzed reddit posts, containing comment_id and comment
+def getUnanalyzedRedditPosts(conn, limit: int) -> list:
+	'''
+		params: `conn` (database connection object returned by psycopg2), `limit` (max posts)
+
+		returns: List of tuples of *most recent* unanalyzed reddit posts, containing comment_id, comment and timestamp.
+		Posts waiting to be retried aren't included.
 
 		It is the caller's job to properly open/close the database connection.
 	'''
-	sql = """SELECT comment_id, comment 
+	# the WHERE clause has to imply reddit_posts_mhs_pending's predicate (migrations.py)
+	sql = """SELECT comment_id, comment, timestamp 
 			from reddit_posts 
 			WHERE 
 				mhs_class IS NULL 
 				AND comment NOT LIKE ''
+				AND NOT EXISTS (SELECT 1 FROM reddit_mhs_retry r WHERE r.comment_id = reddit_posts.comment_id)
 			ORDER BY timestamp DESC
-			LIMIT 100"""
+			LIMIT %s"""
 	with conn.cursor() as cur:
-		cur.execute(sql)
+		cur.execute(sql, (limit,))
 		return cur.fetchall()
 	
-def getUnanalyzed4chanPosts(conn) -> list:
+def getUnanalyzed4chanPosts(conn, limit: int) -> list:
 	'''
-		params: `conn` (database connection object returned by psycopg2)
+		params: `conn` (database connection object returned by psycopg2), `limit` (max posts)
 
-		returns: List of tuples of *most recent* unanalyzed 4chan posts, containing board, post_id, and post
+		returns: List of tuples of *most recent* unanalyzed 4chan posts, containing board, post_id, post, and timestamp.
+		Posts waiting to be retried aren't included.
 
 		It is the caller's job to properly open/close the database connection.
 	'''
-	sql = """SELECT board, post_id, post 
+	# the WHERE clause has to imply chan_posts_mhs_pending's predicate (migrations.py)
+	sql = """SELECT board, post_id, post, timestamp 
 			from chan_posts 
 			WHERE 
 				mhs_class IS NULL AND
-				post NOT LIKE ''
+				post NOT LIKE '' AND
+				NOT EXISTS (SELECT 1 FROM chan_mhs_retry r WHERE r.board = chan_posts.board AND r.post_id = chan_posts.post_id)
 			ORDER BY timestamp DESC
-			LIMIT 100""" 
+			LIMIT %s""" 
+	with conn.cursor() as cur:
+		cur.execute(sql, (limit,))
+		return cur.fetchall()
+
+def getRedditRetries(conn, limit: int) -> list:
+	'''
+		params: `conn` (database connection object returned by psycopg2), `limit` (max posts)
+
+		returns: List of tuples of reddit posts that are due to be retried (longest overdue first),
+		containing comment_id, comment and timestamp
+
+		It is the caller's job to properly open/close the database connection.
+	'''
+	sql = """SELECT p.comment_id, p.comment, p.timestamp
+			FROM reddit_mhs_retry r
+			JOIN reddit_posts p ON p.comment_id = r.comment_id
+			WHERE
+				r.next_retry_at <= now() AND
+				p.mhs_class IS NULL
+			ORDER BY r.next_retry_at
+			LIMIT %s"""
+	with conn.cursor() as cur:
+		cur.execute(sql, (limit,))
+		return cur.fetchall()
+
+def get4chanRetries(conn, limit: int) -> list:
+	'''
+		params: `conn` (database connection object returned by psycopg2), `limit` (max posts)
+
+		returns: List of tuples of 4chan posts that are due to be retried (longest overdue first),
+		containing board, post_id, post, and timestamp
+
+		It is the caller's job to properly open/close the database connection.
+	'''
+	sql = """SELECT p.board, p.post_id, p.post, p.timestamp
+			FROM chan_mhs_retry r
+			JOIN chan_posts p ON p.board = r.board AND p.post_id = r.post_id
+			WHERE
+				r.next_retry_at <= now() AND
+				p.mhs_class IS NULL
+			ORDER BY r.next_retry_at
+			LIMIT %s"""
 	with conn.cursor() as cur:
-		cur.execute(sql)
+		cur.execute(sql, (limit,))
 		return cur.fetchall()
 
 if __name__ == '__main__':
 	connection_pool = ThreadedConnectionPool(1, 3, host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+	mhs_client = MHSClient() # shared by both threads, so they share its concurrency limit
+	metrics.startMetricsServer('mhs')
+	metrics.reportBacklog(connection_pool.getconn, connection_pool.putconn, 'mhs', PENDING) # uses the pool's third connection
 	reddit_thread = threading.Thread(target=main, args=(True,), daemon=True)
 	chan_thread = threading.Thread(target=main, args=(False,), daemon=True)
 	reddit_thread.start()
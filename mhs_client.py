@@ -0,0 +1,233 @@
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import os
+from time import monotonic, perf_counter
+from json import JSONEncoder
+import threading
+import logging
+import metrics
+
+load_dotenv()
+MHS_API_KEY = os.environ.get('MHS_API_KEY')
+MHS_BASE_URL = os.environ.get('MHS_BASE_URL', "https://api.moderatehatespeech.com/api/v1/moderate/") # overridden by bench_pipeline.py's stand-in API
+MHS_CONCURRENCY = int(os.environ.get('MHS_CONCURRENCY', 16)) # max requests in flight
+MHS_TIMEOUT = float(os.environ.get('MHS_TIMEOUT', 30)) # seconds
+MHS_MAX_RETRIES = int(os.environ.get('MHS_MAX_RETRIES', 2)) # retries of a request that got a 429/5xx or no response
+MIN_BACKOFF = 1 # seconds everyone waits after a 429/5xx, doubled while they keep coming
+MAX_BACKOFF = 60
+MHS_BREAKER_FAILURES = int(os.environ.get('MHS_BREAKER_FAILURES', 5)) # failures in a row that open the circuit breaker
+MHS_BREAKER_OPEN_SECONDS = float(os.environ.get('MHS_BREAKER_OPEN_SECONDS', 30)) # wait before the first probe, doubled per failed probe
+MAX_BREAKER_OPEN_SECONDS = 600
+HEADERS = {"Content-Type": "application/json"}
+
+_encoder = JSONEncoder() # MHS is lame so we have to make it a json string
+
+class CircuitBreaker:
+	'''
+		Stops requests to MHS while it's down. Closed (normal) until `failure_threshold`
+		requests in a row fail, then open: every request is refused without being sent for
+		`open_seconds`. After that it's half-open: one probe request is let through while the
+		rest wait for its outcome. If the probe succeeds the breaker closes and they all go
+		ahead; if it fails the breaker opens again, for twice as long (up to `MAX_BREAKER_OPEN_SECONDS`).
+		If the probe hasn't reported back after `probe_timeout` seconds, it's given up on and
+		the next waiter probes instead. Thread safe.
+	'''
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, failure_threshold: int = MHS_BREAKER_FAILURES, open_seconds: float = MHS_BREAKER_OPEN_SECONDS,
+				probe_timeout: float = MAX_BACKOFF + 2 * MHS_TIMEOUT): # a probe may wait out a backoff, then a connect and a read timeout
+		self.failure_threshold = failure_threshold
+		self.base_open_seconds = open_seconds
+		self.open_seconds = open_seconds
+		self.state = CircuitBreaker.CLOSED
+		self.failures = 0 # in a row
+		self.opened_until = 0.0 # monotonic time
+		self.probing = False
+		self.probe_timeout = probe_timeout
+		self.probe_started = 0.0 # monotonic time
+		self._cond = threading.Condition()
+
+	def allow(self) -> bool:
+		'''
+			returns: bool (True if a request may be sent now; blocks while a probe is in flight)
+		'''
+		with self._cond:
+			while True:
+				if self.state == CircuitBreaker.CLOSED:
+					return True
+				if self.state == CircuitBreaker.OPEN:
+					if monotonic() < self.opened_until:
+						return False
+					self.state = CircuitBreaker.HALF_OPEN
+					self.probing = False
+					logging.info("MHS circuit breaker half-open, probing")
+				probe_deadline = self.probe_started + self.probe_timeout
+				if not self.probing or monotonic() >= probe_deadline:
+					if self.probing:
+						logging.info("MHS probe never reported back, sending another")
+					self.probing = True
+					self.probe_started = monotonic()
+					return True
+				self._cond.wait(probe_deadline - monotonic())
+
+	def secondsUntilProbe(self) -> float:
+		'''
+			returns: seconds until requests are let through again (0 unless the breaker is open)
+		'''
+		with self._cond:
+			if self.state != CircuitBreaker.OPEN:
+				return 0.0
+			return max(0.0, self.opened_until - monotonic())
+
+	def recordSuccess(self):
+		with self._cond:
+			if self.state != CircuitBreaker.CLOSED:
+				logging.info("MHS is back, closing circuit breaker")
+			self.state = CircuitBreaker.CLOSED
+			self.failures = 0
+			self.open_seconds = self.base_open_seconds
+			self.probing = False
+			self._cond.notify_all()
+
+	def recordFailure(self):
+		with self._cond:
+			if self.state == CircuitBreaker.HALF_OPEN:
+				self.open_seconds = min(MAX_BREAKER_OPEN_SECONDS, self.open_seconds * 2)
+				self._open()
+			elif self.state == CircuitBreaker.CLOSED:
+				self.failures += 1
+				if self.failures >= self.failure_threshold:
+					self._open()
+			self._cond.notify_all()
+
+	def _open(self):
+		self.state = CircuitBreaker.OPEN
+		self.opened_until = monotonic() + self.open_seconds
+		self.probing = False
+		logging.info(f"MHS looks down, opening circuit breaker for {self.open_seconds:.0f}s")
+
+class MHSClient:
+	'''
+		Sends posts to the ModerateHatespeech (MHS) API concurrently, over a pool of
+		keep-alive connections. At most `limit` requests are in flight. The limit grows by
+		about one per round trip while requests succeed, and is halved (and everyone waits
+		a growing backoff) whenever MHS answers 429 or 5xx, so we settle near what MHS can
+		take instead of hammering it. While MHS keeps failing, `breaker` stops requests
+		altogether. Thread safe; share one client between threads.
+	'''
+	def __init__(self, max_concurrency: int = MHS_CONCURRENCY):
+		self.max_concurrency = max_concurrency
+		self.limit = float(max_concurrency)
+		self.in_flight = 0
+		self.backoff = 0 # seconds; 0 while MHS is healthy
+		self.paused_until = 0.0 # monotonic time
+		self.paused_at = 0.0 # monotonic time of the last backoff
+		self._cond = threading.Condition()
+		self.breaker = CircuitBreaker()
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+		self.session.headers.update(HEADERS)
+		self.executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="mhs")
+
+	def moderateMany(self, texts: list) -> list:
+		'''
+			params: `texts` (list of str)
+
+			returns: list of (mhs_class, mhs_confidence) tuples (or None), in the same order as
+			`texts` (see `moderate`)
+		'''
+		return list(self.executor.map(self.moderate, texts))
+
+	def moderate(self, text: str) -> tuple:
+		'''
+			params: `text` (str)
+
+			returns: tuple (mhs_class, mhs_confidence): the class ("normal"/"flag") and
+			confidence on success, ('N/A', None) if MHS says the text can never be analyzed,
+			('ERROR', None) if MHS returns an error for it (e.g. "0" or "Skill issue"),
+			(None, None) if it couldn't be analyzed right now and should be tried again later,
+			or None if it wasn't sent at all because the circuit breaker is open
+		'''
+		post_data = _encoder.encode({"token": MHS_API_KEY, "text": text})
+		for attempt in range(MHS_MAX_RETRIES + 1):
+			if not self.breaker.allow():
+				return None if attempt == 0 else (None, None)
+			started = self._acquire()
+			request_started = perf_counter()
+			overloaded = True # until MHS answers, so the breaker and limit hear about every outcome
+			try:
+				response = self.session.post(MHS_BASE_URL, data=post_data, timeout=MHS_TIMEOUT)
+				metrics.observeRequest('mhs', 'moderate', response.status_code, request_started)
+				overloaded = response.status_code == 429 or response.status_code >= 500
+			except requests.RequestException as e: # no response (e.g. connection timeout)
+				metrics.observeRequest('mhs', 'moderate', 'error', request_started)
+				logging.info(f"MHS request failed: {e!r}")
+				continue
+			finally:
+				self._release(started, overloaded)
+
+			if overloaded:
+				logging.info(f"MHS is overloaded or down (HTTP {response.status_code}), backing off")
+				continue
+
+			if response.status_code != 200:
+				logging.info(f"MHS returned status code {response.status_code} for \'{text}\'")
+				return (None, None)
+			try:
+				response_data = response.json()
+			except ValueError:
+				logging.info(f"MHS returned a response that isn't JSON: {response.text[:200]!r}")
+				return (None, None)
+			if 'response' in response_data:
+				if response_data['response'] != 'Success':
+					# we got a fail response, so assume post can
+					# never be analyzed and make its mhs_class non-null
+					return ('N/A', None)
+				try:
+					return (response_data['class'], float(response_data['confidence']))
+				except KeyError as e:
+					logging.info(f"MHS KeyError accessing {e}: {response_data}")
+					return (None, None)
+			if 'error' in response_data:
+				logging.info(f"MHS Error: \'{response_data['error']}\' for \'{text}\'")
+				return ('ERROR', None)
+			logging.info(f"MHS KeyError accessing 'response': {response_data}")
+			return (None, None)
+		return (None, None)
+
+	def _acquire(self) -> float:
+		'''
+			returns: monotonic time the request was let through
+		'''
+		with self._cond:
+			while True:
+				wait = self.paused_until - monotonic()
+				if wait <= 0 and self.in_flight < max(1, int(self.limit)):
+					self.in_flight += 1
+					return monotonic()
+				self._cond.wait(wait if wait > 0 else None)
+
+	def _release(self, started: float, overloaded: bool):
+		if overloaded:
+			self.breaker.recordFailure()
+		else:
+			self.breaker.recordSuccess()
+		with self._cond:
+			self.in_flight -= 1
+			if overloaded:
+				# requests that were already in flight when we backed off don't count again
+				if started >= self.paused_at:
+					self.limit = max(1.0, self.limit / 2)
+					self.backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, self.backoff * 2))
+					self.paused_at = monotonic()
+					self.paused_until = self.paused_at + self.backoff
+			else:
+				self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+				self.backoff = 0
+			self._cond.notify_all()
@@ -0,0 +1,359 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import os
+import sys
+import logging
+from db_pool import createPool
+from bulk_ingest import DB_PARTITION_POSTS
+import rollups
+
+load_dotenv()
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+MIGRATION_LOCK_ID = 415415 # pg_advisory_lock key, so only one `migrate` runs at a time
+PARTITION_LOCK_ID = 415417 # pg_try_advisory_xact_lock key, so only one process creates partitions at a time
+PARTITION_MONTHS_AHEAD = int(os.environ.get('DB_PARTITION_MONTHS_AHEAD', 3)) # future monthly partitions kept ready
+POST_TABLES = ('chan_posts', 'reddit_posts')
+
+# `statements` run in order; each is SQL, or a function taking a cursor. A `transactional`
+# migration runs (and is recorded) in one transaction; the others run one statement at a
+# time, for things like CREATE INDEX CONCURRENTLY that can't be in a transaction block,
+# so their statements have to be safe to run again if the migration is interrupted.
+Migration = namedtuple('Migration', ['version', 'name', 'statements', 'transactional'])
+
+def createPostTables(cur):
+	'''
+		Creates chan_posts and reddit_posts if they don't exist. With `DB_PARTITION_POSTS`
+		they're partitioned by month of `timestamp` (unix time), so their primary keys
+		include it (see bulk_ingest.CHAN_POSTS_CONFLICT/REDDIT_POSTS_CONFLICT). Existing
+		tables are left as they are (indexes included, since building them would block
+		the crawlers).
+	'''
+	partitioned = DB_PARTITION_POSTS
+	cur.execute("SELECT to_regclass('chan_posts') IS NULL, to_regclass('reddit_posts') IS NULL")
+	new_chan, new_reddit = cur.fetchone()
+	cur.execute(f"""CREATE TABLE IF NOT EXISTS chan_posts (
+					timestamp BIGINT NOT NULL,
+					board TEXT NOT NULL,
+					thread_id BIGINT NOT NULL, -- 0 for the OP of a thread
+					post_id BIGINT NOT NULL,
+					post TEXT NOT NULL,
+					is_dead TEXT NOT NULL DEFAULT '0', -- '1' once the thread is archived/closed/404'd (only set on the OP)
+					toxicity_rating REAL,
+					mhs_class TEXT,
+					mhs_confidence REAL,
+					PRIMARY KEY (board, post_id{', timestamp' if partitioned else ''})
+				){' PARTITION BY RANGE (timestamp)' if partitioned else ''}""")
+	cur.execute(f"""CREATE TABLE IF NOT EXISTS reddit_posts (
+					timestamp BIGINT NOT NULL,
+					subreddit TEXT NOT NULL,
+					post_id TEXT NOT NULL, -- t3_ fullname of the post (the post itself, for posts)
+					comment_id TEXT NOT NULL, -- t3_/t1_ fullname
+					comment TEXT NOT NULL,
+					toxicity_rating REAL,
+					mhs_class TEXT,
+					mhs_confidence REAL,
+					PRIMARY KEY (comment_id{', timestamp' if partitioned else ''})
+				){' PARTITION BY RANGE (timestamp)' if partitioned else ''}""")
+	# the catalog crawler's thread queries and high_water_marks.seedChan/seedReddit, and
+	# time-bounded analytics (rows arrive in roughly timestamp order, so a BRIN index is tiny)
+	if new_chan:
+		cur.execute("CREATE INDEX chan_posts_threads ON chan_posts (board, thread_id)")
+		cur.execute("CREATE INDEX chan_posts_timestamp ON chan_posts USING BRIN (timestamp)")
+	if new_reddit:
+		cur.execute("CREATE INDEX reddit_posts_listings ON reddit_posts (subreddit, LEFT(comment_id, 2), timestamp)")
+		cur.execute("CREATE INDEX reddit_posts_timestamp ON reddit_posts USING BRIN (timestamp)")
+	if partitioned:
+		createPartitions(cur)
+
+def createPendingIndexes(cur):
+	'''
+		Partial indexes over just the rows still waiting for analysis, so the analyzers'
+		fetch queries don't scan (or sort) the whole table. The predicates have to match the
+		WHERE clauses in toxicity_analyzer.py/mhs_analyzer.py, or the planner can't use them.
+		Built CONCURRENTLY (without blocking the crawlers), except on partitioned tables,
+		which don't support it.
+	'''
+	indexes = [
+		("reddit_posts_toxicity_pending", "reddit_posts", "comment_id", "toxicity_rating IS NULL AND comment NOT LIKE ''"),
+		("chan_posts_toxicity_pending", "chan_posts", "board, post_id", "toxicity_rating IS NULL AND post NOT LIKE ''"),
+		("reddit_posts_mhs_pending", "reddit_posts", "timestamp DESC", "mhs_class IS NULL AND comment NOT LIKE ''"),
+		("chan_posts_mhs_pending", "chan_posts", "timestamp DESC", "mhs_class IS NULL AND post NOT LIKE ''"),
+	]
+	for name, table, columns, predicate in indexes:
+		if isPartitioned(cur, table):
+			cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns}) WHERE {predicate}")
+		else:
+			cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}") # left INVALID if a previous run was interrupted
+			cur.execute(f"CREATE INDEX CONCURRENTLY {name} ON {table} ({columns}) WHERE {predicate}")
+
+MIGRATIONS = [
+	Migration(0, "post tables", [createPostTables], True),
+	Migration(1, "score cache", [
+		"""CREATE TABLE IF NOT EXISTS score_cache (
+			text_hash BYTEA PRIMARY KEY,
+			toxicity_rating REAL,
+			mhs_class TEXT,
+			mhs_confidence REAL,
+			stored_at TIMESTAMPTZ NOT NULL DEFAULT now()
+		)""",
+		"CREATE INDEX IF NOT EXISTS score_cache_stored_at ON score_cache (stored_at)",
+	], True),
+	Migration(2, "mhs retry tables", [
+		"""CREATE TABLE IF NOT EXISTS reddit_mhs_retry (
+			comment_id TEXT PRIMARY KEY,
+			attempts INTEGER NOT NULL,
+			next_retry_at TIMESTAMPTZ NOT NULL
+		)""",
+		"CREATE INDEX IF NOT EXISTS reddit_mhs_retry_next_retry_at ON reddit_mhs_retry (next_retry_at)",
+		"""CREATE TABLE IF NOT EXISTS chan_mhs_retry (
+			board TEXT NOT NULL,
+			post_id BIGINT NOT NULL,
+			attempts INTEGER NOT NULL,
+			next_retry_at TIMESTAMPTZ NOT NULL,
+			PRIMARY KEY (board, post_id)
+		)""",
+		"CREATE INDEX IF NOT EXISTS chan_mhs_retry_next_retry_at ON chan_mhs_retry (next_retry_at)",
+	], True),
+	Migration(3, "pending analysis indexes", [createPendingIndexes], False),
+	Migration(4, "post side tables", [
+		"""CREATE TABLE IF NOT EXISTS chan_post_meta (
+			board TEXT NOT NULL,
+			post_id BIGINT NOT NULL,
+			greentext_lines SMALLINT NOT NULL,
+			original_length INTEGER NOT NULL,
+			PRIMARY KEY (board, post_id)
+		)""",
+		# reply graph: which posts each post quotes (quoted_board is the post's own board for same-board quotes)
+		"""CREATE TABLE IF NOT EXISTS chan_post_links (
+			board TEXT NOT NULL,
+			post_id BIGINT NOT NULL,
+			quoted_board TEXT NOT NULL,
+			quoted_post_id BIGINT NOT NULL,
+			PRIMARY KEY (board, post_id, quoted_board, quoted_post_id)
+		)""",
+		"CREATE INDEX IF NOT EXISTS chan_post_links_quoted ON chan_post_links (quoted_board, quoted_post_id)",
+		"""CREATE TABLE IF NOT EXISTS reddit_post_meta (
+			comment_id TEXT PRIMARY KEY,
+			parent_id TEXT,
+			original_length INTEGER NOT NULL
+		)""",
+		"CREATE INDEX IF NOT EXISTS reddit_post_meta_parent_id ON reddit_post_meta (parent_id)",
+	], True),
+	Migration(5, "toxicity rollups", [
+		"""CREATE TABLE IF NOT EXISTS toxicity_rollup_hourly (
+			site TEXT NOT NULL, -- 'reddit' or '4chan'
+			forum TEXT NOT NULL, -- subreddit or board
+			bucket_start BIGINT NOT NULL, -- unix time (UTC)
+			posts INTEGER NOT NULL,
+			toxicity_count INTEGER NOT NULL, -- posts with a toxicity_rating
+			toxicity_sum DOUBLE PRECISION,
+			toxicity_histogram INTEGER[] NOT NULL, -- toxicity_count by rating, see rollups.HISTOGRAM_BINS
+			mhs_count INTEGER NOT NULL, -- posts MHS classified as normal/flag
+			mhs_flagged INTEGER NOT NULL,
+			mhs_confidence_sum DOUBLE PRECISION,
+			PRIMARY KEY (site, forum, bucket_start)
+		)""",
+		"""CREATE TABLE IF NOT EXISTS toxicity_rollup_daily (
+			site TEXT NOT NULL, -- 'reddit' or '4chan'
+			forum TEXT NOT NULL, -- subreddit or board
+			bucket_start BIGINT NOT NULL, -- unix time (UTC)
+			posts INTEGER NOT NULL,
+			toxicity_count INTEGER NOT NULL, -- posts with a toxicity_rating
+			toxicity_sum DOUBLE PRECISION,
+			toxicity_histogram INTEGER[] NOT NULL, -- toxicity_count by rating, see rollups.HISTOGRAM_BINS
+			mhs_count INTEGER NOT NULL, -- posts MHS classified as normal/flag
+			mhs_flagged INTEGER NOT NULL,
+			mhs_confidence_sum DOUBLE PRECISION,
+			PRIMARY KEY (site, forum, bucket_start)
+		)""",
+		# (forum, hour) buckets whose posts were scored since their rollup was last refreshed
+		"""CREATE TABLE IF NOT EXISTS rollup_dirty (
+			id BIGSERIAL PRIMARY KEY,
+			site TEXT NOT NULL,
+			forum TEXT NOT NULL,
+			hour_start BIGINT NOT NULL
+		)""",
+		# so the first refreshes build rollups for everything scored before this migration
+		lambda cur: rollups.markAllDirty(cur, 'reddit'),
+		lambda cur: rollups.markAllDirty(cur, '4chan'),
+	], True),
+	# one mark per bucket, so the queue doesn't grow by a row per scored post
+	Migration(6, "unique rollup marks", [
+		"""DELETE FROM rollup_dirty d
+			USING rollup_dirty e
+			WHERE
+				d.site = e.site AND
+				d.forum = e.forum AND
+				d.hour_start = e.hour_start AND
+				d.id > e.id""",
+		"ALTER TABLE rollup_dirty ADD CONSTRAINT rollup_dirty_bucket UNIQUE (site, forum, hour_start)",
+	], True),
+]
+
+def migrate(conn, migrations: list = MIGRATIONS):
+	'''
+		params: `conn` (database connection object returned by psycopg2), `migrations` (list of Migration)
+
+		Applies the `migrations` that aren't recorded in `schema_migrations` yet, in version
+		order. Changes `conn`'s autocommit setting, and turns its statement timeout off,
+		since building indexes on big tables takes a while.
+		It is the caller's job to properly open/close the database connection.
+	'''
+	conn.autocommit = True
+	with conn.cursor() as cur:
+		cur.execute("SET statement_timeout = 0")
+		cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+						version INTEGER PRIMARY KEY,
+						name TEXT NOT NULL,
+						applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+					)""")
+		cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+		try:
+			cur.execute("SELECT version FROM schema_migrations")
+			applied = {row[0] for row in cur.fetchall()}
+			pending = sorted((m for m in migrations if m.version not in applied), key=lambda m: m.version)
+			if not pending:
+				logging.info("Database schema is up to date")
+			for migration in pending:
+				logging.info(f"Applying migration {migration.version} ({migration.name})")
+				if migration.transactional:
+					cur.execute("BEGIN")
+				try:
+					for statement in migration.statements:
+						if callable(statement):
+							statement(cur)
+						else:
+							cur.execute(statement)
+					cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+								(migration.version, migration.name))
+					if migration.transactional:
+						cur.execute("COMMIT")
+				except BaseException:
+					if migration.transactional:
+						cur.execute("ROLLBACK")
+					raise
+		finally:
+			cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+
+def tableExists(cur, table: str) -> bool:
+	cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+	return cur.fetchone()[0]
+
+def isPartitioned(cur, table: str) -> bool:
+	cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+	return cur.fetchone() is not None
+
+def monthStart(year: int, month: int) -> int:
+	'''
+		returns: unix time of the start of the month (UTC). `month` can be out of 1-12
+	'''
+	year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+	return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp())
+
+def partitionName(table: str, year: int, month: int) -> str:
+	return f"{table}_{year:04d}_{month:02d}"
+
+def createPartitions(cur, months_ahead: int = PARTITION_MONTHS_AHEAD):
+	'''
+		params: `cur` (psycopg2 cursor), `months_ahead` (months after this one to create)
+
+		Creates this month's and the next `months_ahead` months' partitions of each
+		partitioned post table, plus a default partition that catches anything outside them
+		(e.g. backfilled old posts), so an insert never fails for lack of a partition.
+		If a month's rows already went into the default partition (its partition wasn't
+		created in time), they're moved into the new partition.
+	'''
+	now = datetime.now(timezone.utc)
+	for table in POST_TABLES:
+		if not isPartitioned(cur, table):
+			continue
+		cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+		for offset in range(months_ahead + 1):
+			year, month = now.year + (now.month - 1 + offset) // 12, (now.month - 1 + offset) % 12 + 1
+			start, end = monthStart(year, month), monthStart(year, month + 1)
+			name = partitionName(table, year, month)
+			if tableExists(cur, name):
+				continue
+			cur.execute(f"SELECT 1 FROM {table}_default WHERE timestamp >= %s AND timestamp < %s LIMIT 1", (start, end))
+			if cur.fetchone() is None:
+				cur.execute(f"""CREATE TABLE {name}
+								PARTITION OF {table}
+								FOR VALUES FROM ({start}) TO ({end})""")
+				continue
+			# postgres won't create a partition for rows that are already in the default one,
+			# so the partition is filled with them first and then attached
+			logging.warning(f"Moving {table}_default's rows from {year:04d}-{month:02d} into {name}")
+			cur.execute(f"LOCK TABLE {table}_default IN ACCESS EXCLUSIVE MODE") # no more rows for the month land there meanwhile
+			cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+			cur.execute(f"""WITH moved AS (DELETE FROM {table}_default
+										WHERE timestamp >= %s AND timestamp < %s
+										RETURNING *)
+							INSERT INTO {name} SELECT * FROM moved""", (start, end))
+			cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ({start}) TO ({end})")
+
+def maintainPartitions(conn) -> bool:
+	'''
+		params: `conn` (database connection object returned by psycopg2)
+
+		returns: bool (False if another process was already creating partitions)
+
+		Runs `createPartitions` in its own transaction. Called regularly by the rollup
+		refresher, so partitions stay ahead of the crawlers without a cron job.
+		It is the caller's job to properly open/close the database connection.
+	'''
+	with conn.cursor() as cur:
+		cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+		if not cur.fetchone()[0]:
+			conn.rollback()
+			return False
+		createPartitions(cur)
+	conn.commit()
+	return True
+
+def detachPartitionsBefore(cur, year: int, month: int) -> list:
+	'''
+		params: `cur` (psycopg2 cursor), `year`/`month` (first month to keep attached)
+
+		returns: list of the detached partitions' names
+
+		Detaches the monthly partitions of the post tables from before `year`-`month`. They
+		stay in the database as ordinary tables, to be archived (e.g. `pg_dump -t`) and dropped.
+	'''
+	detached = []
+	for table in POST_TABLES:
+		if not isPartitioned(cur, table):
+			continue
+		cur.execute("""SELECT c.relname
+						FROM pg_inherits i
+						JOIN pg_class c ON c.oid = i.inhrelid
+						WHERE i.inhparent = to_regclass(%s)
+						ORDER BY c.relname""", (table,))
+		for (name,) in cur.fetchall():
+			suffix = name[len(table) + 1:] # YYYY_MM, or "default"
+			if suffix != "default" and suffix < f"{year:04d}_{month:02d}":
+				cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+				detached.append(name)
+	return detached
+
+if __name__ == '__main__':
+	# python migrations.py                   apply migrations and create upcoming partitions
+	# python migrations.py partitions        just create upcoming partitions (`python rollups.py` also does, every hour)
+	# python migrations.py detach YYYY-MM    detach partitions from before that month
+	pool = createPool(1, 1)
+	with pool.connection() as conn:
+		command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+		if command == "migrate":
+			migrate(conn)
+		if command in ("migrate", "partitions"):
+			if not maintainPartitions(conn):
+				logging.info("Another process is creating partitions")
+		elif command == "detach":
+			year, month = (int(part) for part in sys.argv[2].split("-"))
+			with conn.cursor() as cur:
+				detached = detachPartitionsBefore(cur, year, month)
+			conn.commit()
+			logging.info(f"Detached {', '.join(detached) or 'nothing'}")
+		else:
+			logging.error(f"Unknown command {command}")
+	pool.closeall()
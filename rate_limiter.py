@@ -0,0 +1,94 @@
+from dotenv import load_dotenv
+import os
+import logging
+from time import sleep, time
+from local_state import getLocalState, recordRateLimit
+
+load_dotenv()
+REDDIT_RATE_LIMIT_RESERVE = float(os.environ.get('REDDIT_RATE_LIMIT_RESERVE', 0.05)) # fraction of the quota never used
+REDDIT_DEFAULT_REQUESTS_PER_SECOND = 1.0 # reddit's oauth quota is 600 requests per 10 minutes
+REDDIT_WINDOW_SECONDS = 600
+REDDIT_BURST = 5 # most requests that can be made back to back
+
+class RedditRateLimiter:
+	'''
+		Token bucket shared by every process on this machine that calls oauth.reddit.com,
+		stored in the `local_state` file. `update` refills it at whatever rate spends the
+		`X-Ratelimit-Remaining` requests evenly until `X-Ratelimit-Reset`, so several
+		faktory workers together use the whole quota without going over it.
+	'''
+	def acquire(self):
+		'''
+			Blocks until a request may be made, then takes a token for it.
+		'''
+		conn = getLocalState()
+		while True:
+			conn.execute("BEGIN IMMEDIATE") # serializes every process's read-modify-write
+			try:
+				now = time()
+				tokens, refill_per_second, refill_until = self._refill(conn, now)
+				if tokens >= 1:
+					tokens -= 1
+					wait = 0
+				else:
+					wait = (1 - tokens) / refill_per_second
+				self._save(conn, tokens, refill_per_second, refill_until, now)
+				conn.execute("COMMIT")
+			except BaseException:
+				conn.execute("ROLLBACK")
+				raise
+			if wait == 0:
+				return
+			sleep(min(wait, 5)) # someone else might have updated the rate in the meantime
+
+	def update(self, headers):
+		'''
+			params: `headers` (headers of a response from oauth.reddit.com)
+
+			Resets the bucket from Reddit's X-Ratelimit-Remaining/Reset headers.
+		'''
+		recordRateLimit(headers)
+		try:
+			remaining = float(headers['X-Ratelimit-Remaining'])
+			reset = max(float(headers['X-Ratelimit-Reset']), 1) # seconds until the window resets
+		except (KeyError, ValueError):
+			return
+		usable = remaining * (1 - REDDIT_RATE_LIMIT_RESERVE)
+		now = time()
+		conn = getLocalState()
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			if usable < 1:
+				logging.info(f"Reddit rate limit used up, waiting {reset:.0f}s for it to reset")
+				# first token arrives when the window resets
+				tokens, refill_per_second = 0.0, 1 / reset
+			else:
+				tokens = min(self._refill(conn, now)[0], usable)
+				refill_per_second = usable / reset
+			self._save(conn, tokens, refill_per_second, now + reset, now)
+			conn.execute("COMMIT")
+		except BaseException:
+			conn.execute("ROLLBACK")
+			raise
+
+	def _refill(self, conn, now: float):
+		'''
+			returns: tuple (tokens, refill_per_second, refill_until) as of `now`
+		'''
+		row = conn.execute("""SELECT tokens, refill_per_second, refill_until, updated_at
+							FROM reddit_token_bucket WHERE id = 0""").fetchone()
+		if row is None:
+			return float(REDDIT_BURST), REDDIT_DEFAULT_REQUESTS_PER_SECOND, now + REDDIT_WINDOW_SECONDS
+		tokens, refill_per_second, refill_until, updated_at = row
+		if now > refill_until:
+			# the window reset and nobody has heard from reddit since, so assume the default rate
+			tokens += max(0.0, refill_until - updated_at) * refill_per_second
+			updated_at = max(updated_at, refill_until)
+			refill_per_second = REDDIT_DEFAULT_REQUESTS_PER_SECOND
+			refill_until = now + REDDIT_WINDOW_SECONDS
+		tokens += (now - updated_at) * refill_per_second
+		return min(tokens, REDDIT_BURST), refill_per_second, refill_until
+
+	def _save(self, conn, tokens: float, refill_per_second: float, refill_until: float, now: float):
+		conn.execute("""INSERT OR REPLACE INTO reddit_token_bucket(id, tokens, refill_per_second, refill_until, updated_at)
+					VALUES (0, ?, ?, ?, ?)""", (tokens, refill_per_second, refill_until, now))
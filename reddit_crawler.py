@@ -3,11 +3,17 @@ import requests.auth
 from dotenv import load_dotenv
 import os
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
-from psycopg2.extras import execute_values
-from time import sleep
+from psycopg2.pool import ThreadedConnectionPool
 from faktory import Worker
 import logging
+import threading
+from multiprocessing.util import Finalize
+from time import perf_counter, sleep
+from bulk_ingest import BulkIngester, REDDIT_POSTS_COLUMNS, REDDIT_POSTS_CONFLICT, REDDIT_POST_META_COLUMNS
+from high_water_marks import HighWaterMarks
+from local_state import recordCrawl, recordCrawlFailed
+from rate_limiter import RedditRateLimiter
+import metrics
 
 
 load_dotenv()
@@ -28,105 +34,216 @@ DB_PASS = os.environ.get('DB_PASS')
 HEADERS = {"Authorization": f"bearer {REDDIT_API_KEY}", "User-Agent": USER_AGENT}
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
-REDDIT_BASE_URL = """https://oauth.reddit.com"""
+REDDIT_BASE_URL = os.environ.get('REDDIT_BASE_URL', "https://oauth.reddit.com") # overridden by bench_pipeline.py's stand-in API
+REDDIT_TOKEN_URL = os.environ.get('REDDIT_TOKEN_URL', "https://www.reddit.com/api/v1/access_token")
 #SUBREDDITS = os.environ.get('SUBREDDITS').split(',')
-SLEEP_LENGTH = 1.2
+# jobs run at once, as threads of this one process, so they share the OAuth key, `listing_cursors` and `high_water_marks`
+WORKER_CONCURRENCY = int(os.environ.get('REDDIT_WORKER_CONCURRENCY', 1))
+MAX_PAGES = int(os.environ.get('REDDIT_MAX_PAGES', 10)) # pages per listing per crawl (reddit stops listings at ~1000 items anyway)
+REDDIT_TIMEOUT = float(os.environ.get('REDDIT_TIMEOUT', 30)) # seconds
+FLUSH_CHECK_SECONDS = 0.5 # how often the flusher thread checks whether staged rows are due
+
+high_water_marks = HighWaterMarks() # newest stored post/comment per subreddit, updated whenever reddit_ingester commits
+listing_cursors = {} # (subreddit, listing) -> fullname of the newest item seen in that listing
+listing_gaps = {} # (subreddit, listing) -> times we couldn't page back to known data (so items were lost)
+rate_limiter = RedditRateLimiter() # paces every request to oauth.reddit.com, across every thread and process on this machine
+connection_pool = None
+connection_pool_pid = None
+flusher_pid = None
+
+def getConnectionPool() -> ThreadedConnectionPool:
+	'''
+		returns: this process's connection pool, with a connection for each of the
+		`WORKER_CONCURRENCY` job threads and the flusher thread (see `startFlusher`).
+		(Made on first use, in whichever process runs the jobs.)
+	'''
+	global connection_pool, connection_pool_pid
+	if connection_pool_pid != os.getpid():
+		connection_pool = ThreadedConnectionPool(1, WORKER_CONCURRENCY + 2, host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+		connection_pool_pid = os.getpid()
+	return connection_pool
+
+def startFlusher():
+	'''
+		Starts this process's flusher thread, which writes `reddit_ingester`'s staged rows
+		as soon as they're due instead of at the end of the process's next job, and flushes
+		whatever is left when the process exits. Does nothing if it's already running.
+	'''
+	global flusher_pid
+	if flusher_pid == os.getpid():
+		return
+	flusher_pid = os.getpid()
+	threading.Thread(target=flushPeriodically, daemon=True).start()
+	# runs at exit (unlike an atexit handler, also when a multiprocessing child exits)
+	Finalize(None, reddit_ingester.flush, exitpriority=10)
+
+def flushPeriodically():
+	while True:
+		sleep(FLUSH_CHECK_SECONDS)
+		try:
+			reddit_ingester.flushIfDue()
+		except Exception:
+			logging.exception("Failed to flush staged reddit posts")
 
 def main(subreddit: str, get_posts: bool, get_comments: bool):
+	metrics.startMetricsServer('reddit')
+	startFlusher()
+	connection_pool = getConnectionPool()
 	conn = connection_pool.getconn()
-	if get_posts:
-		# get posts AND comments 
-		# in general, more comments are made than original posts, so we want to get comments more often
+	try:
+		if get_posts:
+			# get posts AND comments 
+			# in general, more comments are made than original posts, so we want to get comments more often
 		
-		#first, get posts
-		new_posts_endpoint = f"r/{subreddit}/new.json?sort_new&limit=100"
-		response = requests.get(f"{REDDIT_BASE_URL}/{new_posts_endpoint}", headers=HEADERS)
-		if response.status_code == 200:
-			all_data = response.json()['data']
-			last_index_to_add = binarySearch(all_data['children'], all_data['dist'], subreddit, conn)
-			data_tuples = []
-			for i in range(last_index_to_add, -1, -1):
-				post = all_data['children'][i]['data']
-				body = post['title'] + "\n\n" + post['selftext']
-				if len(body) > 2500:
-					body = body[0:2500]
-				if body:
-					data_tuples.append((int(post['created_utc']),
-										subreddit,
-										post['name'], # already has t3_ prefix
-										post['name'],
-										body))
+			#first, get posts
+			new_posts = getNewListingItems(subreddit, "new", conn)
+			if new_posts:
+				data_tuples = []
+				meta_tuples = []
+				for child in reversed(new_posts):
+					post = child['data']
+					body = post['title'] + "\n\n" + post['selftext']
+					original_length = len(body)
+					if len(body) > 2500:
+						body = body[0:2500]
+					if body:
+						data_tuples.append((int(post['created_utc']),
+											subreddit,
+											post['name'], # already has t3_ prefix
+											post['name'],
+											body))
+						meta_tuples.append((post['name'], None, original_length)) # posts don't reply to anything
 			
-			#print(f"{data_tuples}")
-			sql = """INSERT INTO reddit_posts(timestamp, subreddit, post_id, comment_id, comment) VALUES %s 
-					ON CONFLICT (comment_id) DO NOTHING"""
-			with conn.cursor() as cur:
-				execute_values(cur, sql, data_tuples)
-				conn.commit()
-		elif response.status_code == 401:
-			logging.info("Need new OAuth key")
-			#logging.info(f"Old key: {REDDIT_API_KEY}")
-			updateOAuthKey()
-			#logging.info(f"New key: {REDDIT_API_KEY}")
-		else:
-			logging.info(f"Error {response.status_code}: Failed to get reddit posts for {subreddit}")
-			sleep(SLEEP_LENGTH)
-		
-		sleep(SLEEP_LENGTH) 
-	
-	if get_comments:
-		getCommentsAndAddToDB(subreddit, conn) 
+				#print(f"{data_tuples}")
+				reddit_meta_ingester.addMany(meta_tuples)
+				reddit_ingester.addMany(data_tuples)
 	
-	connection_pool.putconn(conn)
+		if get_comments:
+			getCommentsAndAddToDB(subreddit, conn)
+	finally:
+		connection_pool.putconn(conn) # the pool is shared by every job thread, so it must always come back
+	reddit_ingester.flushIfDue()
 
-def binarySearch(arr, size: int, subreddit: str,  conn) -> int:
+def getNewListingItems(subreddit: str, listing: str, conn):
 	'''
-		params: `arr` (list of reddit posts/comments as dicts); `size` (int, size of the list); 
-		`subreddit` (string, subreddit posts/comments are from); `conn` (database connection object returned by psycopg2)
+		params: `subreddit` (str); `listing` (str, "new" for posts or "comments"); 
+		`conn` (database connection object returned by psycopg2)
 
-		returns: int (index of the last element of the list to ADD to the db, 
-		i.e. the last element of the list that is NOT IN the db)
+		returns: list of new posts/comments as dicts (newest first), or None if the first request failed
 
-		Binary searches the given list to find the last element of the list that is not already in the database.  
-		Caller should then add the new content to the database. It is also the caller's job to properly 
-		open and close the database connection. 
+		Crawls the listing (see `pageThroughListing`) and records how it went, failed or not,
+		so faktory_reddit_client learns how busy the listing is and can queue it again.
+		It is the caller's job to properly open/close the database connection.
 	'''
-	def isInDB(comment_id: str, conn) -> bool:
-		'''
-			params:`comment_id` (str, key for reddit_posts table), `conn` (database connection object returned by psycopg2)
+	try:
+		new_children, pages = pageThroughListing(subreddit, listing, conn)
+	except Exception:
+		recordCrawlFailed(subreddit, listing)
+		raise
+	if new_children is None:
+		recordCrawlFailed(subreddit, listing)
+	else:
+		recordCrawl(subreddit, listing, len(new_children), pages)
+	return new_children
+
+def pageThroughListing(subreddit: str, listing: str, conn) -> tuple:
+	'''
+		params: `subreddit` (str); `listing` (str, "new" for posts or "comments"); 
+		`conn` (database connection object returned by psycopg2)
 
-			returns: bool (True if the row is in the table)
+		returns: tuple (new posts/comments as dicts (newest first), or None if the first
+		request failed; pages requested)
 
-			Checks the reddit_posts table for the row. Abstracted away for readability/simplicity.
-		'''
-		with conn.cursor() as cur:
-			sql = """SELECT EXISTS(SELECT 1 FROM reddit_posts 
-					WHERE comment_id=%s 
-					LIMIT 1)"""
-			cur.execute(sql, (comment_id,)) 
-			return cur.fetchone()[0]
-	
-	max_timestamp = 0
-	with conn.cursor() as cur:
-		cur.execute("""SELECT MAX(timestamp) FROM reddit_posts WHERE subreddit=%s""", (subreddit,))
-		max_timestamp = cur.fetchone()[0] if cur.rowcount > 0 else 0
-	if max_timestamp is None:
-		max_timestamp = 0
-	left = 0
-	right = size - 1
-	middle = 0
-	curr_post = None
-	while left < right:
-		middle = left + ((right - left) // 2)
-		curr_post = arr[middle]['data']
-		post_timestamp = int(curr_post['created_utc'])
-		if post_timestamp > max_timestamp or (post_timestamp == max_timestamp and not isInDB(curr_post['name'], conn)): 
-			left = middle + 1
-		else: 
-			right = middle - 1
-	curr_post = arr[left]['data']
-	return left - 1 if isInDB(curr_post['name'], conn) else left
+		Pages back through /r/`subreddit`/`listing`.json with `after=` until it reaches something
+		that's already stored or the listing's cursor (the newest item from the last crawl), so a
+		burst of more than 100 items between crawls isn't lost. Gives up after `MAX_PAGES` pages
+		and records a gap in `listing_gaps`. (`before=cursor` isn't used because it returns nothing 
+		once the cursor item is deleted or removed.) If a later page fails, the items found so
+		far are returned but the cursor isn't moved, so the next crawl pages back over the rest.
+		It is the caller's job to properly open/close the database connection.
+	'''
+	key = (subreddit, listing)
+	kind = "t3" if listing == "new" else "t1"
+	cursor = listing_cursors.get(key)
+	first_crawl = cursor is None and not high_water_marks.hasRedditListing(subreddit, kind)
+	new_children = []
+	newest = None
+	after = None
+	for page in range(MAX_PAGES):
+		url = f"{REDDIT_BASE_URL}/r/{subreddit}/{listing}.json?sort_new&limit=100"
+		if after:
+			url += f"&after={after}"
+		response = getListingPage(url, listing)
+		if response is not None and response.status_code == 401:
+			logging.info("Need new OAuth key")
+			updateOAuthKey()
+			response = getListingPage(url, listing)
+		if response is None or response.status_code != 200:
+			if response is not None:
+				logging.info(f"Error {response.status_code}: Failed to get reddit {listing} for {subreddit}")
+			return (new_children if page else None), page + 1
+
+		data = response.json()['data']
+		children = data['children']
+		if page == 0 and children:
+			newest = children[0]['data']['name']
+		new_items = findNewItems(children, subreddit, conn)
+		new_children.extend(new_items)
+		reached_known = len(new_items) < len(children) or any(child['data']['name'] == cursor for child in children)
+		after = data['after']
+		if reached_known or after is None or first_crawl:
+			break
+	else:
+		listing_gaps[key] = listing_gaps.get(key, 0) + 1
+		metrics.LISTING_GAPS.labels(subreddit, listing).inc()
+		logging.warning(f"Gap in r/{subreddit}/{listing}: {MAX_PAGES} pages of new items without reaching known data "
+						f"({listing_gaps[key]} gaps so far)")
+
+	if newest is not None:
+		listing_cursors[key] = newest
+	return new_children, page + 1
+
+def getListingPage(url: str, listing: str):
+	'''
+		returns: the response to GET `url` (paced by `rate_limiter`), or None if there was no response
+	'''
+	rate_limiter.acquire()
+	started = perf_counter()
+	try:
+		response = requests.get(url, headers=HEADERS, timeout=REDDIT_TIMEOUT)
+	except requests.RequestException as e:
+		metrics.observeRequest('reddit', listing, 'error', started)
+		logging.info(f"Request for {url} failed: {e!r}")
+		return None
+	metrics.observeRequest('reddit', listing, response.status_code, started)
+	rate_limiter.update(response.headers)
+	return response
+
+def findNewItems(children: list, subreddit: str, conn) -> list:
+	'''
+		params: `children` (list of reddit posts/comments as dicts); `subreddit` (string, subreddit
+		posts/comments are from); `conn` (database connection object returned by psycopg2)
+
+		returns: list of the `children` that are NOT IN the db, in listing order
 
+		Most items are sorted out by `high_water_marks` in memory. Whatever it can't vouch
+		for is looked up in a single `= ANY` query (an index-only scan of the comment_id key),
+		so the db cost is at most one round trip per listing wherever the overlap is, and
+		items Reddit returns out of `created_utc` order aren't skipped. 
+		It is the caller's job to properly open/close the database connection. 
+	'''
+	new_items, unknown_items = high_water_marks.splitRedditItems(subreddit, children)
+	if not unknown_items:
+		return new_items
+	with metrics.timeDb("reddit_find_new"), conn.cursor() as cur:
+		cur.execute("""SELECT comment_id FROM reddit_posts 
+					WHERE comment_id = ANY(%s)""", ([child['data']['name'] for child in unknown_items],))
+		stored = {row[0] for row in cur.fetchall()}
+	conn.rollback()
+	high_water_marks.markRedditStored(subreddit, [child['data'] for child in unknown_items if child['data']['name'] in stored])
+	new_names = {child['data']['name'] for child in new_items}
+	new_names.update(child['data']['name'] for child in unknown_items if child['data']['name'] not in stored)
+	return [child for child in children if child['data']['name'] in new_names]
 
 def getCommentsAndAddToDB(subreddit: str, conn) -> bool:
 	'''
@@ -134,21 +251,20 @@ def getCommentsAndAddToDB(subreddit: str, conn) -> bool:
 
 		returns: bool (successfully added to db, or failed to add)
 
-		Gets comments from a subreddit and adds them to the database connected to by `conn`.
-		This function will create and close a cursor for interacting with the database. 
+		Gets comments from a subreddit and stages the new ones in `reddit_ingester`, which
+		adds them to the database in bulk (with their parent and length in reddit_post_meta). `conn` is only used to find which comments are new. 
 		It is the caller's job to properly open/close the database connection and to
-		respect Reddit's API rate limits. Function commits the modifications.
+		respect Reddit's API rate limits.
 	'''
-	comments_endpoint = f"r/{subreddit}/comments.json?sort_new&limit=100"
-	response = requests.get(f"{REDDIT_BASE_URL}/{comments_endpoint}", headers=HEADERS)
-	if response.status_code == 200:
-		all_data = response.json()['data']
-		last_index_to_add = binarySearch(all_data['children'], all_data['dist'], subreddit, conn)
+	new_comments = getNewListingItems(subreddit, "comments", conn)
+	if new_comments is not None:
 		data_tuples = []
-		for i in range(last_index_to_add, -1, -1): # reverse order so max(created_utc) should be last in db
+		meta_tuples = []
+		for child in reversed(new_comments): # reverse order so max(created_utc) should be last in db
 			
-			comment = all_data['children'][i]['data']
+			comment = child['data']
 			body = comment['body']
+			original_length = len(body)
 			if len(body) > 2500:
 				body = body[0:2500]
 			if body:
@@ -157,37 +273,51 @@ def getCommentsAndAddToDB(subreddit: str, conn) -> bool:
 									comment['link_id'], # already has t3_ prefix
 									comment['name'], # already has t1_ prefix
 									body))
+				meta_tuples.append((comment['name'],
+									comment['parent_id'], # t3_ (top-level) or t1_ (reply to a comment)
+									original_length))
 
-		sql = """INSERT INTO reddit_posts(timestamp, subreddit, post_id, comment_id, comment) VALUES %s 
-				ON CONFLICT (comment_id) DO NOTHING"""
-		with conn.cursor() as cur:
-			execute_values(cur, sql, data_tuples)
-			conn.commit()
+		reddit_meta_ingester.addMany(meta_tuples)
+		reddit_ingester.addMany(data_tuples)
 
 		return True
-	elif response.status_code == 401:
-		updateOAuthKey()
 	else:
-		logging.info(f"Error {response.status_code}: Failed to get reddit comments for {subreddit}")
-		sleep(SLEEP_LENGTH)
 		return False
 
 def updateOAuthKey():
-	sleep(SLEEP_LENGTH)
 	client_auth = requests.auth.HTTPBasicAuth(REDDIT_CLIENT_ID, REDDIT_SECRET)
 	post_data = {"grant_type": "password", "username": REDDIT_USER, "password": {REDDIT_PASS}}
 	headers = {"User-Agent": USER_AGENT}
-	response = requests.post("https://www.reddit.com/api/v1/access_token", auth=client_auth, data=post_data, headers=headers)
+	started = perf_counter()
+	response = requests.post(REDDIT_TOKEN_URL, auth=client_auth, data=post_data, headers=headers, timeout=REDDIT_TIMEOUT)
+	metrics.observeRequest('reddit', 'access_token', response.status_code, started)
 	global REDDIT_API_KEY 
 	REDDIT_API_KEY = response.json()['access_token']
 	HEADERS['Authorization'] = f"bearer {REDDIT_API_KEY}"
-	sleep(SLEEP_LENGTH)
+
+def setUp():
+	'''
+		Seeds `high_water_marks` and creates the ingesters. Called once, before the faktory
+		worker starts.
+	'''
+	global reddit_meta_ingester, reddit_ingester
+	conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+	high_water_marks.seedReddit(conn)
+	conn.close()
+	reddit_meta_ingester = BulkIngester('reddit_post_meta', REDDIT_POST_META_COLUMNS, ('comment_id',), None, None)
+	reddit_ingester = BulkIngester('reddit_posts', REDDIT_POSTS_COLUMNS, REDDIT_POSTS_CONFLICT,
+								lambda: getConnectionPool().getconn(), lambda conn: getConnectionPool().putconn(conn),
+								on_flush=high_water_marks.redditRowsCommitted, companions=(reddit_meta_ingester,))
 
 if __name__ == '__main__':
-	connection_pool = SimpleConnectionPool(1, 4, host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
-	w = Worker(faktory=FAKTORY_URL, queues=['reddit'], concurrency=1)
+	setUp()
+	# use_threads: in forked worker processes, a new OAuth key, the listing cursors and the
+	# high-water marks would only be updated in the process whose job changed them
+	w = Worker(faktory=FAKTORY_URL, queues=['reddit'], concurrency=WORKER_CONCURRENCY, use_threads=True)
 	w.register('reddit_crawler', main)
 	w.register('reddit_newkey', updateOAuthKey)
 	logging.info("running reddit?")
-	w.run()
-	connection_pool.closeall()
+	try:
+		w.run()
+	finally:
+		reddit_ingester.flush() # anything staged by jobs that ran in this process
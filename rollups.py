@@ -0,0 +1,234 @@
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+import os
+import sys
+import logging
+from time import sleep, time
+from db_pool import createPool
+
+load_dotenv()
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+ROLLUP_REFRESH_SECONDS = float(os.environ.get('ROLLUP_REFRESH_SECONDS', 60)) # how often `python rollups.py` checks for dirty buckets
+ROLLUP_REFRESH_LIMIT = int(os.environ.get('ROLLUP_REFRESH_LIMIT', 5000)) # dirty marks taken per refresh transaction
+ROLLUP_LOCK_ID = 415416 # pg_try_advisory_xact_lock key, so only one refresh runs at a time
+PARTITION_CHECK_SECONDS = 3600 # how often `python rollups.py` makes sure the post tables' upcoming partitions exist
+HOUR = 3600
+DAY = 24 * HOUR
+HISTOGRAM_BINS = 10 # toxicity_rating histogram: [0, 0.1), [0.1, 0.2), ... [0.9, 1]
+MHS_SCORED_CLASSES = ('normal', 'flag') # 'ERROR'/'N/A' posts don't count towards the flag ratio
+
+# site -> (posts table, forum column)
+SITES = {
+	'reddit': ('reddit_posts', 'subreddit'),
+	'4chan': ('chan_posts', 'board'),
+}
+GRANULARITIES = {
+	'hour': 'toxicity_rollup_hourly',
+	'day': 'toxicity_rollup_daily',
+}
+
+def markingDirty(update_sql: str, site: str) -> str:
+	'''
+		params: `update_sql` (an `UPDATE {posts table} ... FROM (VALUES %s) ...` statement for
+		execute_values that sets scores), `site` (key of `SITES`)
+
+		returns: str (the same statement, also adding the (forum, hour) of every updated post
+		to rollup_dirty)
+
+		The marks are written in the analyzer's own transaction, so a bucket is marked dirty
+		if and only if its new scores are committed. A bucket has at most one mark: one
+		that's already there is locked instead (by a no-op update), so a refresh can't take
+		it and recompute the bucket without these scores until they're committed.
+	'''
+	table, forum_column = SITES[site]
+	# ordered, so concurrent analyzers lock marks they share in the same order and can't deadlock
+	return f"""WITH updated AS ({update_sql}
+				RETURNING {table}.{forum_column}, {table}.timestamp)
+			INSERT INTO rollup_dirty (site, forum, hour_start)
+			SELECT DISTINCT '{site}', {forum_column}, timestamp / {HOUR} * {HOUR}
+			FROM updated
+			ORDER BY 2, 3
+			ON CONFLICT (site, forum, hour_start) DO UPDATE SET hour_start = EXCLUDED.hour_start"""
+
+def markAllDirty(cur, site: str):
+	'''
+		Marks every (forum, hour) that has posts, so the next refreshes (re)build all of
+		`site`'s rollups. Scans the whole posts table.
+	'''
+	table, forum_column = SITES[site]
+	cur.execute(f"""INSERT INTO rollup_dirty (site, forum, hour_start)
+					SELECT DISTINCT '{site}', {forum_column}, timestamp / {HOUR} * {HOUR}
+					FROM {table}
+					ORDER BY 2, 3
+					ON CONFLICT DO NOTHING""")
+
+def refresh(conn, limit: int = ROLLUP_REFRESH_LIMIT) -> int:
+	'''
+		params: `conn` (database connection object returned by psycopg2), `limit` (max
+		dirty marks to take)
+
+		returns: int (number of dirty marks taken, 0 if another refresh is running)
+
+		Takes the oldest dirty marks and, in the same transaction, recomputes the hourly
+		rollups of those buckets from the posts tables and the daily rollups of their days
+		from the hourly ones. Marks committed by an analyzer while this runs aren't visible
+		to it, so they're left for the next refresh rather than lost.
+		It is the caller's job to properly open/close the database connection.
+	'''
+	with conn.cursor() as cur:
+		cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+		if not cur.fetchone()[0]:
+			conn.rollback()
+			return 0
+		cur.execute("""DELETE FROM rollup_dirty
+						WHERE id IN (SELECT id FROM rollup_dirty ORDER BY id LIMIT %s)
+						RETURNING site, forum, hour_start""", (limit,))
+		marks = cur.fetchall()
+		dirty = set(marks)
+		for site in SITES:
+			hours = sorted((forum, hour_start) for marked_site, forum, hour_start in dirty if marked_site == site)
+			if hours:
+				refreshHours(cur, site, hours)
+				refreshDays(cur, site, sorted({(forum, hour_start // DAY * DAY) for forum, hour_start in hours}))
+	conn.commit()
+	return len(marks)
+
+def refreshHours(cur, site: str, hours: list):
+	'''
+		params: `cur` (psycopg2 cursor), `site` (key of `SITES`), `hours` (list of (forum,
+		hour start) tuples)
+
+		Recomputes the hourly rollups of `hours` from the posts table. Hours without posts
+		end up without a row.
+	'''
+	table, forum_column = SITES[site]
+	histogram = ", ".join(f"count(*) FILTER (WHERE LEAST(width_bucket(p.toxicity_rating, 0, 1, {HISTOGRAM_BINS}), {HISTOGRAM_BINS}) = {i})"
+						for i in range(1, HISTOGRAM_BINS + 1))
+	mhs_scored = f"p.mhs_class IN ({', '.join(repr(name) for name in MHS_SCORED_CLASSES)})"
+	execute_values(cur, f"""DELETE FROM toxicity_rollup_hourly
+							WHERE
+								site = '{site}' AND
+								(forum, bucket_start) IN (VALUES %s)""", hours, template="(%s, %s::bigint)", page_size=len(hours))
+	execute_values(cur, f"""INSERT INTO toxicity_rollup_hourly (site, forum, bucket_start, posts, toxicity_count,
+								toxicity_sum, toxicity_histogram, mhs_count, mhs_flagged, mhs_confidence_sum)
+							SELECT
+								'{site}', d.forum, d.hour_start,
+								count(*),
+								count(p.toxicity_rating),
+								sum(p.toxicity_rating::double precision),
+								ARRAY[{histogram}],
+								count(*) FILTER (WHERE {mhs_scored}),
+								count(*) FILTER (WHERE p.mhs_class = 'flag'),
+								sum(p.mhs_confidence::double precision) FILTER (WHERE {mhs_scored})
+							FROM (VALUES %s) AS d (forum, hour_start)
+							JOIN {table} p ON
+								p.{forum_column} = d.forum AND
+								p.timestamp >= d.hour_start AND
+								p.timestamp < d.hour_start + {HOUR}
+							GROUP BY d.forum, d.hour_start""", hours, template="(%s, %s::bigint)", page_size=len(hours))
+
+def refreshDays(cur, site: str, days: list):
+	'''
+		params: `cur` (psycopg2 cursor), `site` (key of `SITES`), `days` (list of (forum,
+		day start) tuples)
+
+		Recomputes the daily rollups of `days` by adding up their hourly rollups.
+	'''
+	execute_values(cur, f"""DELETE FROM toxicity_rollup_daily
+							WHERE
+								site = '{site}' AND
+								(forum, bucket_start) IN (VALUES %s)""", days, template="(%s, %s::bigint)", page_size=len(days))
+	execute_values(cur, f"""WITH days (forum, day_start) AS (VALUES %s),
+							hours AS (
+								SELECT h.*, d.day_start
+								FROM days d
+								JOIN toxicity_rollup_hourly h ON
+									h.site = '{site}' AND
+									h.forum = d.forum AND
+									h.bucket_start >= d.day_start AND
+									h.bucket_start < d.day_start + {DAY}),
+							bins AS (
+								SELECT h.forum, h.day_start, bin.number, sum(bin.count) AS count
+								FROM hours h, unnest(h.toxicity_histogram) WITH ORDINALITY AS bin (count, number)
+								GROUP BY h.forum, h.day_start, bin.number)
+							INSERT INTO toxicity_rollup_daily (site, forum, bucket_start, posts, toxicity_count,
+								toxicity_sum, toxicity_histogram, mhs_count, mhs_flagged, mhs_confidence_sum)
+							SELECT
+								'{site}', h.forum, h.day_start,
+								sum(h.posts),
+								sum(h.toxicity_count),
+								sum(h.toxicity_sum),
+								(SELECT array_agg(b.count ORDER BY b.number)::integer[]
+									FROM bins b
+									WHERE b.forum = h.forum AND b.day_start = h.day_start),
+								sum(h.mhs_count),
+								sum(h.mhs_flagged),
+								sum(h.mhs_confidence_sum)
+							FROM hours h
+							GROUP BY h.forum, h.day_start""", days, template="(%s, %s::bigint)", page_size=len(days))
+
+def getRollups(conn, granularity: str, since: int, until: int, site: str = None) -> list:
+	'''
+		params: `conn` (database connection object returned by psycopg2), `granularity`
+		("hour" or "day"), `since`/`until` (unix time, bucket starts in [since, until)),
+		`site` (key of `SITES`, or None for both)
+
+		returns: list of (site, forum, bucket_start, posts, toxicity_mean, toxicity_histogram,
+		mhs_flag_ratio, mhs_confidence_mean) tuples, oldest first. Means and ratios are None
+		for buckets with nothing scored yet.
+		It is the caller's job to properly open/close the database connection.
+	'''
+	sql = f"""SELECT
+				site, forum, bucket_start, posts,
+				toxicity_sum / NULLIF(toxicity_count, 0),
+				toxicity_histogram,
+				mhs_flagged::double precision / NULLIF(mhs_count, 0),
+				mhs_confidence_sum / NULLIF(mhs_count, 0)
+			FROM {GRANULARITIES[granularity]}
+			WHERE
+				bucket_start >= %s AND
+				bucket_start < %s AND
+				(%s IS NULL OR site = %s)
+			ORDER BY bucket_start, site, forum"""
+	with conn.cursor() as cur:
+		cur.execute(sql, (since, until, site, site))
+		return cur.fetchall()
+
+if __name__ == '__main__':
+	# python rollups.py             keep the rollups up to date (refresh whenever there are dirty buckets),
+	#                               and the post tables' upcoming partitions created
+	# python rollups.py rebuild     mark every bucket dirty, so the running refresher rebuilds everything
+	pool = createPool(1, 1)
+	command = sys.argv[1] if len(sys.argv) > 1 else "refresh"
+	if command == "rebuild":
+		with pool.connection() as conn:
+			with conn.cursor() as cur:
+				for site in SITES:
+					markAllDirty(cur, site)
+			conn.commit()
+		logging.info("Marked every bucket dirty")
+	elif command == "refresh":
+		from migrations import maintainPartitions # migrations imports this module
+		last_partition_check = 0
+		while True:
+			started = time()
+			if started - last_partition_check > PARTITION_CHECK_SECONDS:
+				try:
+					with pool.connection() as conn:
+						maintainPartitions(conn)
+					last_partition_check = started
+				except Exception:
+					logging.exception("Failed to create upcoming partitions, will retry")
+			try:
+				with pool.connection() as conn:
+					taken = refresh(conn)
+			except Exception:
+				logging.exception("Failed to refresh rollups, will retry")
+				taken = 0
+			if taken:
+				logging.info(f"Refreshed rollups for {taken} dirty marks in {time() - started:.1f}s")
+			if taken < ROLLUP_REFRESH_LIMIT:
+				sleep(ROLLUP_REFRESH_SECONDS)
+	else:
+		logging.error(f"Unknown command {command}")
+	pool.closeall()
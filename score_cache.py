@@ -0,0 +1,161 @@
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+import os
+import hashlib
+import unicodedata
+import threading
+import logging
+from collections import OrderedDict
+from time import time
+
+load_dotenv()
+SCORE_CACHE_SIZE = int(os.environ.get('SCORE_CACHE_SIZE', 100000)) # texts remembered in memory, per analyzer process
+SCORE_CACHE_MAX_ROWS = int(os.environ.get('SCORE_CACHE_MAX_ROWS', 2000000)) # rows kept in the score_cache table
+SCORE_CACHE_MAX_LENGTH = int(os.environ.get('SCORE_CACHE_MAX_LENGTH', 500)) # longer texts aren't cached (copypastas fit, essays rarely repeat)
+PRUNE_SECONDS = 3600
+
+# texts MHS returns an error for instead of a score (case-sensitive, exact), see README
+MHS_FAILING_TEXTS = ("0", "Skill issue")
+
+def normalizeText(text: str) -> str:
+	'''
+		Unicode NFC, with runs of whitespace collapsed to one space and the ends stripped.
+		Case is kept, since both models (and MHS's failures) are case-sensitive.
+	'''
+	return " ".join(unicodedata.normalize('NFC', text).split())
+
+def textHash(text: str) -> bytes:
+	return hashlib.blake2b(normalizeText(text).encode('utf-8'), digest_size=16).digest()
+
+class ScoreCache:
+	'''
+		Remembers the score of each text, keyed by a hash of the normalized text, so posts
+		repeating something already scored ("Skill issue", "based", copypastas) don't need
+		the model or an API call. Scores are kept in the `score_cache` table (see migrations.py), shared by all
+		analyzers, with the most recently used `max_entries` also kept in memory (LRU).
+		The table is trimmed to the newest `SCORE_CACHE_MAX_ROWS` rows once in a while.
+
+		`columns` are the score_cache columns this cache's scores are stored in; a score is
+		a tuple with a value for each. `pinned` scores are always hits for exactly those texts,
+		without normalizing them (e.g. texts MHS is known to fail on). Thread safe.
+	'''
+	def __init__(self, columns: tuple, max_entries: int = SCORE_CACHE_SIZE, pinned: dict = None):
+		self.columns = columns
+		self.max_entries = max_entries
+		self.pinned = dict(pinned or {}) # text -> score
+		self.hits = 0 # lookups answered from memory or the table
+		self.db_hits = 0 # ... of which from the table
+		self.misses = 0
+		self._entries = OrderedDict() # text hash -> score, least recently used first
+		self._lock = threading.Lock()
+		self._last_prune = time()
+
+	def isCacheable(self, text: str) -> bool:
+		return len(text) <= SCORE_CACHE_MAX_LENGTH
+
+	def lookup(self, conn, texts: list) -> list:
+		'''
+			params: `conn` (database connection object returned by psycopg2), `texts` (list of str)
+
+			returns: list with the cached score of each of `texts`, or None if it isn't cached
+
+			Texts that aren't in memory are looked up in one `= ANY` query.
+			It is the caller's job to properly open/close the database connection.
+		'''
+		keys = [textHash(text) if self.isCacheable(text) and text not in self.pinned else None for text in texts]
+		found = {}
+		missing = set()
+		with self._lock:
+			for key in keys:
+				if key is None or key in found:
+					continue
+				if key in self._entries:
+					self._entries.move_to_end(key)
+					found[key] = self._entries[key]
+				else:
+					missing.add(key)
+		if missing:
+			sql = f"""SELECT text_hash, {', '.join(self.columns)}
+					FROM score_cache
+					WHERE
+						text_hash = ANY(%s) AND
+						{self.columns[0]} IS NOT NULL"""
+			with conn.cursor() as cur:
+				cur.execute(sql, (list(missing),))
+				rows = cur.fetchall()
+			with self._lock:
+				for row in rows:
+					key = bytes(row[0])
+					found[key] = tuple(row[1:])
+					self._remember(key, found[key])
+		scores = [found.get(key) if key is not None else self.pinned.get(text) for text, key in zip(texts, keys)]
+		with self._lock:
+			hits = sum(1 for score in scores if score is not None)
+			self.hits += hits
+			self.misses += len(texts) - hits
+			self.db_hits += sum(1 for key in keys if key in missing and key in found)
+		return scores
+
+	def store(self, conn, scores: dict):
+		'''
+			params: `conn` (database connection object returned by psycopg2), `scores` (dict
+			of text -> score, for texts that were just scored)
+
+			Adds the scores to the table as part of the caller's transaction, so they're
+			stored if and only if the caller commits.
+			It is the caller's job to properly open/close the database connection.
+		'''
+		rows = {}
+		for text, score in scores.items():
+			if self.isCacheable(text):
+				rows[textHash(text)] = score
+		if not rows:
+			return
+		with self._lock:
+			for key, score in rows.items():
+				self._remember(key, score)
+		updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in self.columns)
+		sql = f"""INSERT INTO score_cache (text_hash, {', '.join(self.columns)})
+				VALUES %s
+				ON CONFLICT (text_hash) DO UPDATE SET {updates}, stored_at = now()"""
+		with conn.cursor() as cur:
+			# sorted, so concurrent analyzers storing the same texts lock them in the same order
+			execute_values(cur, sql, [(key,) + tuple(rows[key]) for key in sorted(rows)], page_size=len(rows))
+		self.pruneIfDue(conn)
+
+	def pruneIfDue(self, conn):
+		'''
+			Deletes all but the newest `SCORE_CACHE_MAX_ROWS` rows, at most every `PRUNE_SECONDS`.
+		'''
+		if time() - self._last_prune < PRUNE_SECONDS:
+			return
+		self._last_prune = time()
+		sql = """DELETE FROM score_cache
+				WHERE stored_at < (SELECT stored_at FROM score_cache
+									ORDER BY stored_at DESC
+									OFFSET %s LIMIT 1)"""
+		with conn.cursor() as cur:
+			cur.execute(sql, (SCORE_CACHE_MAX_ROWS,))
+			if cur.rowcount:
+				logging.info(f"Pruned {cur.rowcount} old rows from score_cache")
+
+	def hitRate(self) -> float:
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+	def _remember(self, key: bytes, score: tuple):
+		self._entries[key] = score
+		self._entries.move_to_end(key)
+		if len(self._entries) > self.max_entries:
+			self._entries.popitem(last=False)
+
+def toxblockCache() -> ScoreCache:
+	return ScoreCache(('toxicity_rating',))
+
+def mhsCache() -> ScoreCache:
+	'''
+		Cache of (mhs_class, mhs_confidence). Texts MHS can't analyze ('ERROR'/'N/A') are
+		cached too, so they're never sent again. `MHS_FAILING_TEXTS` only fail verbatim, so
+		they're pinned as they are; variants like " 0 " are scored like any other text.
+	'''
+	return ScoreCache(('mhs_class', 'mhs_confidence'), pinned={text: ('ERROR', None) for text in MHS_FAILING_TEXTS})
@@ -0,0 +1,87 @@
+'''
+	cleanComment has to give exactly what lxml gives, whichever path a comment takes.
+
+	python -m unittest test_chan_comment    (or pytest)
+'''
+import unittest
+from chan_comment import cleanComment, parseComment, lxmlClean, _fastClean
+from bench_chan_comment import SYNTHETIC_COMMENTS
+
+EDGE_CASES = [
+	# entities
+	'&gt;&lt;&amp;&quot;&#039;&apos;',
+	'&nbsp;&eacute;&#x1F600;&#128514; &amp;amp',
+	'a&ampb without the semicolon',
+	'bare & ampersand',
+	'&notanentity; &#xD800; &#1114112; &#0; &#x0B;',
+	'&#xFEFF;after an encoded BOM',
+	# <wbr> in long words and links
+	'https://www.youtube.com/watch?v=dQw4w9<wbr>WgXcQ',
+	'aaaaaaaaaaaaaaaaaaaa<wbr>bbbbbbbbbbbbbbbbbbbb<wbr>cccc',
+	# quotelinks and greentext
+	'<a href="#p451234567" class="quotelink">&gt;&gt;451234567</a><br>Skill issue',
+	'<a href="/vg/thread/123#p456" class="quotelink">&gt;&gt;&gt;/vg/456</a> cross-board link',
+	'<span class="deadlink">&gt;&gt;123</span> (dead)',
+	'<span class="quote">&gt;be me</span><br><span class="quote">&gt;lose</span>',
+	# leading and trailing whitespace
+	' leading space',
+	'\nleading newline',
+	'\tleading tab<br>x',
+	'trailing space ',
+	'trailing newline\n',
+	'   ',
+	'<br> <br>',
+	'<b>bold</b> <u>underlined</u>',
+	# BOM
+	'\ufeffstarts with a BOM',
+	'\ufeff  BOM then spaces',
+	'\ufeff<br>BOM then a tag',
+	'BOM \ufeff in the middle',
+	'ends with a BOM\ufeff',
+	# <br> runs
+	'<br>',
+	'<br><br><br>',
+	'a<br><br><br>b',
+	'<br>starts with br',
+	'ends with br<br>',
+	'a<br/>b<br />c',
+	# things only lxml handles
+	'<!-- comment --> hidden',
+	'code: <pre class="prettyprint">int main() {<br>  return 0;<br>}</pre>',
+	'control \x01 character',
+	'carriage\r\nreturn',
+	'unclosed <span class="quote">greentext',
+	'stray > and < signs',
+]
+
+class CleanCommentTest(unittest.TestCase):
+	def test_matches_lxml(self):
+		for comment in EDGE_CASES + SYNTHETIC_COMMENTS:
+			with self.subTest(comment=comment):
+				self.assertEqual(cleanComment(comment), lxmlClean(comment))
+
+	def test_fast_path_matches_lxml(self):
+		# whenever the fast path answers, it has to be right (None means it deferred to lxml)
+		for comment in EDGE_CASES + SYNTHETIC_COMMENTS:
+			if not comment:
+				continue
+			with self.subTest(comment=comment):
+				text = _fastClean(comment)
+				if text is not None:
+					self.assertEqual(text, lxmlClean(comment))
+
+	def test_leading_bom_takes_lxml_path(self):
+		self.assertIsNone(_fastClean('\ufeffhello'))
+		self.assertEqual(cleanComment('\ufeff  hello'), 'hello')
+
+	def test_parse_comment(self):
+		comment = ('<a href="#p1" class="quotelink">&gt;&gt;1</a><br><a href="/vg/thread/2#p3" class="quotelink">&gt;&gt;&gt;/vg/3</a>'
+					'<br><span class="deadlink">&gt;&gt;4</span><br><span class="quote">&gt;green</span>')
+		text, quoted, greentext_lines = parseComment(comment)
+		self.assertEqual(text, lxmlClean(comment))
+		self.assertEqual(quoted, [(None, 1), ('vg', 3), (None, 4)])
+		self.assertEqual(greentext_lines, 1)
+		self.assertEqual(parseComment(''), ('', [], 0))
+
+if __name__ == '__main__':
+	unittest.main()
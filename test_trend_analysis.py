@@ -0,0 +1,92 @@
+'''
+	trend_analysis's statistics against values worked out by hand.
+
+	python -m unittest test_trend_analysis    (or pytest)
+'''
+import unittest
+import numpy as np
+from trend_analysis import PERCENTILE_BINS, percentiles, agreement, detectSpikes, rollingMean, cusum
+
+class PercentilesTest(unittest.TestCase):
+	def test_upper_bin_edges(self):
+		histogram = np.zeros(PERCENTILE_BINS, np.int64)
+		histogram[100] = 1 # a post in [0.100, 0.101)
+		histogram[500] = 2
+		histogram[900] = 1
+		# cumulative counts 1, 3, 4: the 25th percentile is the 1st post, the median the 2nd, the 90th the 4th
+		np.testing.assert_allclose(percentiles(histogram, [0.25, 0.5, 0.9, 1.0]), [0.101, 0.501, 0.901, 0.901])
+
+	def test_top_bin(self):
+		histogram = np.zeros(PERCENTILE_BINS, np.int64)
+		histogram[-1] = 3 # toxicity_rating 1.0 lands in the last bin
+		np.testing.assert_allclose(percentiles(histogram, [0.5]), [1.0])
+
+	def test_empty(self):
+		self.assertTrue(np.isnan(percentiles(np.zeros(PERCENTILE_BINS, np.int64), [0.5, 0.9])).all())
+
+class AgreementTest(unittest.TestCase):
+	def test_kappa(self):
+		# agree on 40 + 45 of 100; by chance 0.5 * 0.45 + 0.5 * 0.55 = 0.5, so kappa = (0.85 - 0.5) / (1 - 0.5)
+		observed, kappa = agreement(np.array([[40, 10], [5, 45]]))
+		self.assertAlmostEqual(observed, 0.85)
+		self.assertAlmostEqual(kappa, 0.7)
+
+	def test_no_better_than_chance(self):
+		# both say toxic half the time, independently of each other
+		observed, kappa = agreement(np.array([[25, 25], [25, 25]]))
+		self.assertAlmostEqual(observed, 0.5)
+		self.assertAlmostEqual(kappa, 0.0)
+
+	def test_degenerate(self):
+		observed, kappa = agreement(np.array([[10, 0], [0, 0]])) # chance agreement is 1
+		self.assertEqual(observed, 1.0)
+		self.assertTrue(np.isnan(kappa))
+		self.assertTrue(all(np.isnan(agreement(np.zeros((2, 2), np.int64)))))
+
+class DetectSpikesTest(unittest.TestCase):
+	def totals(self, scored, sums, squares):
+		return {'scored': np.array(scored, np.int64), 'toxicity_sum': np.array(sums, np.float64),
+				'toxicity_squares': np.array(squares, np.float64)}
+
+	def test_spike(self):
+		# 10 quiet hours of 10 posts, half 0.0 and half 0.2 (mean 0.1, variance 0.01), then an hour
+		# of 10 posts averaging 0.5: z = (0.5 - 0.1) / sqrt(0.01 / 10) = 4 * sqrt(10).
+		# the last hour averages 1.0 but has too few posts to count
+		totals = self.totals([10] * 10 + [10, 2], [1.0] * 10 + [5.0, 2.0], [0.2] * 10 + [2.5, 2.0])
+		hours, scores = detectSpikes(totals, window=10, z=4, min_posts=5)
+		self.assertEqual(list(hours), [10])
+		self.assertAlmostEqual(scores[0], 4 * np.sqrt(10))
+
+	def test_below_threshold(self):
+		totals = self.totals([10] * 11, [1.0] * 10 + [5.0], [0.2] * 10 + [2.5])
+		hours, _ = detectSpikes(totals, window=10, z=13, min_posts=5) # 4 * sqrt(10) is about 12.6
+		self.assertEqual(len(hours), 0)
+
+	def test_needs_a_baseline(self):
+		# the 2nd hour's baseline is the 1st hour's 10 posts, fewer than min_posts * 10
+		totals = self.totals([10, 10], [1.0, 5.0], [0.2, 2.5])
+		hours, _ = detectSpikes(totals, window=10, z=4, min_posts=5)
+		self.assertEqual(len(hours), 0)
+
+class RollingMeanTest(unittest.TestCase):
+	def test_weighted_by_posts(self):
+		# windows of 2 hours: 1/1, (1+2)/(1+1), (2+3)/(1+2), (3+0)/(2+0), then no posts at all
+		rolling = rollingMean(np.array([1.0, 2.0, 3.0, 0.0, 0.0]), np.array([1, 1, 2, 0, 0]), 2)
+		np.testing.assert_allclose(rolling, [1.0, 1.5, 5 / 3, 1.5, np.nan])
+
+class CusumTest(unittest.TestCase):
+	def test_step(self):
+		# day-to-day differences are 7 of +-1 each side of a +9 jump: noise scale 1.7023 around a
+		# median of 5.5. After the jump, S climbs 2.143, 4.874, 7.017 (> 5) by day 10. Before it the
+		# days are below the median, so the downward statistic passes 5 on day 2
+		values = [0, 1] * 4 + [10, 11] * 4
+		up, down = cusum(values)
+		self.assertEqual(list(up), [10])
+		self.assertEqual(list(down), [2])
+
+	def test_flat(self):
+		up, down = cusum([0.2] * 10 + [np.nan])
+		self.assertEqual((len(up), len(down)), (0, 0))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,115 +1,287 @@
 from tox_block.prediction import make_predictions
-import psycopg2
-from psycopg2.pool import SimpleConnectionPool
 from dotenv import load_dotenv
 import os
 from psycopg2.extras import execute_values
-#from faktory import Worker
 import logging
-from time import sleep
+import threading
+import multiprocessing
+import multiprocessing.connection
+from queue import Queue
+from time import sleep, time
+from db_pool import createPool
+import score_cache
+import rollups
+import metrics
 
 load_dotenv()
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 FAKTORY_URL = os.environ.get('FAKTORY_URL')
-DB_HOST = os.environ.get('DB_HOST')
-DB_NAME = os.environ.get('DB_NAME')
-DB_USER = os.environ.get('DB_USER')
-DB_PASS = os.environ.get('DB_PASS')
+WORKERS = int(os.environ.get('TOXICITY_WORKERS', 1)) # analyzer processes, each claiming its own batches
+# posts per model call (per worker). reddit and 4chan posts share a batch
+BATCH_SIZE = int(os.environ.get('TOXICITY_BATCH_SIZE', max(75, 32 * (os.cpu_count() or 1) // WORKERS)))
+PREFETCH_BATCHES = int(os.environ.get('TOXICITY_PREFETCH_BATCHES', 2)) # batches read ahead of the model
+IDLE_SLEEP = 10 # seconds to wait when there's nothing to analyze (or the model failed)
+MIN_RESTART_SECONDS = 1 # wait before restarting a dead worker, doubled while workers keep dying soon after starting
+MAX_RESTART_SECONDS = 300
+STABLE_SECONDS = 600 # a worker that ran this long before dying is restarted without waiting long
+REPORT_SECONDS = 60
+# posts waiting for the model; match the partial indexes (migrations.py), so counting them is cheap
+PENDING = {
+	'reddit_posts': "toxicity_rating IS NULL AND comment NOT LIKE ''",
+	'chan_posts': "toxicity_rating IS NULL AND post NOT LIKE ''",
+}
 
+# also marks the scored posts' hours dirty, for rollups.py. matching `timestamp` too lets
+# postgres skip all but the posts' monthly partitions (see DB_PARTITION_POSTS)
+REDDIT_UPDATE_SQL = rollups.markingDirty("""UPDATE reddit_posts
+					SET toxicity_rating = data.toxic
+					FROM (VALUES %s)
+					AS data (comment_id, timestamp, toxic)
+					WHERE
+						reddit_posts.comment_id = data.comment_id AND
+						reddit_posts.timestamp = data.timestamp""", 'reddit')
+CHAN_UPDATE_SQL = rollups.markingDirty("""UPDATE chan_posts
+					SET toxicity_rating = data.toxic
+					FROM (VALUES %s)
+					AS data (board, post_id, timestamp, toxic)
+					WHERE
+						chan_posts.board = data.board AND
+						chan_posts.post_id = data.post_id AND
+						chan_posts.timestamp = data.timestamp""", '4chan')
+
+scored = 0 # posts written since startup
+toxblock_cache = score_cache.toxblockCache() # scores of texts we've seen before, so duplicates skip the model
 
 def main():
-	conn = connection_pool.getconn()
-	reddit_posts = getUnanalyzedRedditPosts(conn)
-	chan_posts = getUnanalyzed4chanPosts(conn)
-
-	# list comprehension to extract the comment from the posts to be analyzed
-	reddit_analysis = [post[1] for post in reddit_posts]
-	chan_analysis = [post[2] for post in chan_posts]
-	
-	# do analysis. store it in the same variable since we don't need 
-	# the comments anymore. let the garbage collector do its magic.
-	# these each become a dict of dicts with original comment + the following probabilities: 
-	# 		toxic, severe_toxic, obscene, threat, insult, identity_hate
-	# if either are empty lists, they stay empty lists (which are falsy)
-	if reddit_analysis:
-		reddit_analysis = make_predictions(reddit_analysis)
-	if chan_analysis:
-		chan_analysis = make_predictions(chan_analysis)
+	'''
+		returns: none/never (infinite loop)
 
-	with conn.cursor() as cur:
-		# first, edit tuples
-		for i in range(len(reddit_posts)):
-			reddit_posts[i] = reddit_posts[i] + (reddit_analysis[i]['toxic'],) # comma to make it a tuple we can append
-		for i in range(len(chan_posts)):
-			chan_posts[i] = chan_posts[i] + (chan_analysis[i]['toxic'],)
-		
-		# then, update db
-		if reddit_analysis:
-			sql = """UPDATE reddit_posts 
-					SET toxicity_rating = data.toxic 
-					FROM (VALUES %s) 
-					AS data (comment_id, comment, toxic) 
-					WHERE 
-						reddit_posts.comment_id = data.comment_id"""
-			execute_values(cur, sql, reddit_posts)
-		if chan_analysis:
-			sql = """UPDATE chan_posts 
-					SET toxicity_rating = data.toxic 
-					FROM (VALUES %s) 
-					AS data (board, post_id, post, toxic) 
-					WHERE 
-						chan_posts.board = data.board AND 
-						chan_posts.post_id = data.post_id"""
-			execute_values(cur, sql, chan_posts)
-
-	conn.commit()
-	connection_pool.putconn(conn)
-
-def getUnanalyzedRedditPosts(conn) -> list:
+		Runs the analyzer as a pipeline: `claimPosts` keeps up to `PREFETCH_BATCHES` batches
+		of unanalyzed posts ready, this thread runs the model on them `BATCH_SIZE` at a time,
+		and `writeScores` writes the results, so the model never waits on the database.
+		It only sleeps when there's no backlog at all. Texts that are in `toxblock_cache`, or
+		repeated within the batch, are only run through the model once.
 	'''
-		params: `conn` (database connection object returned by psycopg2)
+	to_analyze = Queue(maxsize=PREFETCH_BATCHES)
+	to_write = Queue(maxsize=PREFETCH_BATCHES)
+	threading.Thread(target=claimPosts, args=(to_analyze,), daemon=True).start()
+	threading.Thread(target=writeScores, args=(to_write,), daemon=True).start()
+
+	last_report = time()
+	last_scored = 0
+	batch_seconds = 0.0
+	batches = 0
+	while True:
+		conn, posts = to_analyze.get()
 
-		returns: List of tuples of reddit posts, containing comment_id and comment
+		started = time()
+		texts = list(dict.fromkeys(post[2] for post in posts if post[3] is None))
+		new_scores = {}
+		if texts:
+			try:
+				# dict of dicts with original comment + the following probabilities:
+				# 		toxic, severe_toxic, obscene, threat, insult, identity_hate
+				analysis = make_predictions(texts)
+				new_scores = {text: (analysis[i]['toxic'],) for i, text in enumerate(texts)}
+			except Exception:
+				logging.exception(f"Failed to score a batch of {len(posts)} posts, they'll be claimed again")
+				connection_pool.putconn(conn) # rolls back, releasing the claim
+				sleep(IDLE_SLEEP)
+				continue
+			metrics.BATCH_SECONDS.labels('toxicity').observe(time() - started)
+		batch_seconds += time() - started
+		batches += 1
+		cached = sum(1 for post in posts if post[3] is not None)
+		metrics.POSTS_ANALYZED.labels('toxicity', 'cache').inc(cached)
+		metrics.POSTS_ANALYZED.labels('toxicity', 'model').inc(len(posts) - cached)
+
+		scores = [(post[3] or new_scores[post[2]])[0] for post in posts]
+		to_write.put((conn, posts, scores, new_scores))
+
+		if time() - last_report >= REPORT_SECONDS:
+			rate = (scored - last_scored) / (time() - last_report)
+			logging.info(f"worker {os.getpid()}: {rate:.1f} posts/s, {batch_seconds / batches:.2f}s per batch of up to {BATCH_SIZE}, "
+						f"{to_analyze.qsize()} batches waiting for the model, {to_write.qsize()} waiting to be written, "
+						f"score cache hit rate {toxblock_cache.hitRate():.1%}")
+			last_report = time()
+			last_scored = scored
+			batch_seconds = 0.0
+			batches = 0
+
+def claimPosts(to_analyze: Queue):
+	'''
+		params: `to_analyze` (queue the (connection, batch) tuples are put on)
 
+		returns: none/never (infinite loop)
+
+		Claims batches of unanalyzed reddit and 4chan posts. Each batch is up to half reddit
+		posts, topped up with 4chan posts. The rows are locked (`FOR UPDATE SKIP LOCKED`) in
+		a transaction that stays open on the batch's own connection until `writeScores`
+		commits the scores, so any number of analyzer processes can run without scoring
+		the same post twice. If a worker dies, its transactions roll back and its batches
+		are claimed again by someone else.
+	'''
+	while True:
+		conn = connection_pool.getconn()
+		try:
+			with metrics.timeDb("toxicity_claim"):
+				reddit_posts = getUnanalyzedRedditPosts(conn, BATCH_SIZE // 2)
+				chan_posts = getUnanalyzed4chanPosts(conn, BATCH_SIZE - len(reddit_posts))
+		except Exception:
+			logging.exception("Failed to claim posts to analyze")
+			connection_pool.putconn(conn)
+			sleep(IDLE_SLEEP)
+			continue
+
+		posts = [('reddit', (comment_id, timestamp), comment) for comment_id, timestamp, comment in reddit_posts]
+		posts += [('chan', (board, post_id, timestamp), post) for board, post_id, timestamp, post in chan_posts]
+		if posts:
+			try:
+				with metrics.timeDb("toxicity_cache_lookup"):
+					cached = toxblock_cache.lookup(conn, [post[2] for post in posts])
+			except Exception:
+				logging.exception("Failed to look up cached scores")
+				connection_pool.putconn(conn) # rolls back, releasing the claim
+				continue
+			posts = [post + (score,) for post, score in zip(posts, cached)]
+			to_analyze.put((conn, posts)) # blocks while the model is behind
+		else:
+			connection_pool.putconn(conn)
+			# we had no posts to analyze, so wait for a while for some to accumulate
+			sleep(IDLE_SLEEP)
+
+def writeScores(to_write: Queue):
+	'''
+		params: `to_write` (queue of (connection, posts, toxicity scores, newly scored texts)
+		tuples; the connection's transaction holds the posts' claim)
+
+		returns: none/never (infinite loop)
+	'''
+	global scored
+	while True:
+		conn, posts, scores, new_scores = to_write.get()
+		reddit_rows = []
+		chan_rows = []
+		for (site, key, _, _), toxic in zip(posts, scores):
+			if site == 'reddit':
+				reddit_rows.append(key + (toxic,))
+			else:
+				chan_rows.append(key + (toxic,))
+
+		try:
+			with metrics.timeDb("toxicity_write"):
+				with conn.cursor() as cur:
+					if reddit_rows:
+						execute_values(cur, REDDIT_UPDATE_SQL, reddit_rows, page_size=len(reddit_rows))
+					if chan_rows:
+						execute_values(cur, CHAN_UPDATE_SQL, chan_rows, page_size=len(chan_rows))
+				toxblock_cache.store(conn, new_scores)
+				conn.commit()
+			scored += len(posts)
+		except Exception:
+			logging.exception(f"Failed to write {len(posts)} toxicity scores, they'll be claimed again")
+			conn.rollback()
+		finally:
+			connection_pool.putconn(conn)
+
+def getUnanalyzedRedditPosts(conn, limit: int) -> list:
+	'''
+		params: `conn` (database connection object returned by psycopg2), `limit` (max posts)
+
+		returns: List of tuples of reddit posts, containing comment_id, timestamp and comment
+
+		The posts stay locked until the caller commits or rolls back `conn`; posts locked
+		by other analyzers are skipped.
 		It is the caller's job to properly open/close the database connection.
 	'''
-	sql = """SELECT comment_id, comment 
-			from reddit_posts 
-			WHERE 
+	# the WHERE clause has to imply reddit_posts_toxicity_pending's predicate (migrations.py)
+	sql = """SELECT comment_id, timestamp, comment
+			from reddit_posts
+			WHERE
 				toxicity_rating IS NULL AND
 				comment NOT LIKE ''
-			LIMIT 75"""
+			LIMIT %s
+			FOR UPDATE SKIP LOCKED"""
 	with conn.cursor() as cur:
-		cur.execute(sql)
+		cur.execute(sql, (limit,))
 		return cur.fetchall()
 
-def getUnanalyzed4chanPosts(conn) -> list:
+def getUnanalyzed4chanPosts(conn, limit: int) -> list:
 	'''
-		params: `conn` (database connection object returned by psycopg2)
+		params: `conn` (database connection object returned by psycopg2), `limit` (max posts)
 
-		returns: List of tuples of 4chan posts, containing board, post_id, and post
+		returns: List of tuples of 4chan posts, containing board, post_id, timestamp, and post
 
+		The posts stay locked until the caller commits or rolls back `conn`; posts locked
+		by other analyzers are skipped.
 		It is the caller's job to properly open/close the database connection.
 	'''
-	sql = """SELECT board, post_id, post 
-			from chan_posts 
-			WHERE 
+	# the WHERE clause has to imply chan_posts_toxicity_pending's predicate (migrations.py)
+	sql = """SELECT board, post_id, timestamp, post
+			from chan_posts
+			WHERE
 				toxicity_rating IS NULL AND
 				post NOT LIKE ''
-			LIMIT 75""" 
+			LIMIT %s
+			FOR UPDATE SKIP LOCKED"""
 	with conn.cursor() as cur:
-		cur.execute(sql)
+		cur.execute(sql, (limit,))
 		return cur.fetchall()
 
+def runWorker():
+	'''
+		returns: none/never (infinite loop)
 
-if __name__ == '__main__':
-	connection_pool = SimpleConnectionPool(1, 2, host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
-	#w = Worker(faktory=FAKTORY_URL, queues=['toxic'], concurrency=1)
-	#w.register('toxicity_analyzer', main)
-	logging.info("running toxicity analyzer?")
-	
+		Entry point of each analyzer process.
+	'''
+	global connection_pool
+	# every claimed batch holds a connection until it's written: the queues, the model,
+	# the writer and the reader's next claim, plus one to count the backlog
+	connection_pool = createPool(1, 2 * PREFETCH_BATCHES + 4)
+	metrics.startMetricsServer('toxicity')
+	metrics.reportBacklog(connection_pool.getconn, connection_pool.putconn, 'toxicity', PENDING)
+	make_predictions(["warming up"]) # load the model once, before we start claiming posts
+	main()
+
+def superviseWorkers(context):
+	'''
+		params: `context` (multiprocessing context to start the workers with)
+
+		returns: none/never (infinite loop)
+
+		Keeps `WORKERS` analyzer processes running, restarting any that dies (e.g. its
+		writer lost the database). Restarts wait `MIN_RESTART_SECONDS`, doubled (up to
+		`MAX_RESTART_SECONDS`) while workers keep dying within `STABLE_SECONDS` of starting,
+		so a worker that can't start doesn't spin.
+	'''
+	workers = [(context.Process(target=runWorker, daemon=True), time()) for _ in range(WORKERS)]
+	for worker, _ in workers:
+		worker.start()
+	backoff = 0
 	while True:
-		main()
-		sleep(10)
+		multiprocessing.connection.wait([worker.sentinel for worker, _ in workers])
+		for i, (worker, started) in enumerate(workers):
+			if worker.is_alive():
+				continue
+			lived = time() - started
+			backoff = MIN_RESTART_SECONDS if lived >= STABLE_SECONDS else min(MAX_RESTART_SECONDS, max(MIN_RESTART_SECONDS, backoff * 2))
+			logging.error(f"Analyzer worker {worker.pid} exited with code {worker.exitcode} after {lived:.0f}s, "
+						f"restarting it in {backoff}s")
+			sleep(backoff)
+			worker = context.Process(target=runWorker, daemon=True)
+			worker.start()
+			workers[i] = (worker, time())
 
-	#w.run()
-	connection_pool.closeall()
+
+if __name__ == '__main__':
+	logging.info(f"running toxicity analyzer? ({WORKERS} worker(s), batches of {BATCH_SIZE})")
+	if WORKERS == 1:
+		runWorker()
+	else:
+		# split the cores between workers instead of every worker's TensorFlow using all of them.
+		# set before spawning, so the workers have them when they import tox_block
+		threads = str(max(1, (os.cpu_count() or 1) // WORKERS))
+		os.environ.setdefault('TF_NUM_INTRAOP_THREADS', threads)
+		os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+		os.environ.setdefault('OMP_NUM_THREADS', threads)
+		superviseWorkers(multiprocessing.get_context('spawn')) # TensorFlow doesn't survive a fork
@@ -0,0 +1,305 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from dotenv import load_dotenv
+import os
+import sys
+import logging
+from datetime import datetime, timezone
+from time import time
+from export_posts import EXPORT_DIR, TABLES, dayName
+
+load_dotenv()
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+HOUR = 3600
+DAY = 24 * HOUR
+TOXIC_THRESHOLD = float(os.environ.get('TREND_TOXIC_THRESHOLD', 0.5)) # toxicity_rating at or above this counts as toxic (vs MHS's "flag")
+PERCENTILE_BINS = 1000 # toxicity_rating histogram resolution, so percentiles are exact to 0.001
+SPIKE_WINDOW_HOURS = int(os.environ.get('TREND_SPIKE_WINDOW_HOURS', 7 * 24)) # baseline an hour is compared to
+SPIKE_Z = float(os.environ.get('TREND_SPIKE_Z', 4)) # standard errors above the baseline that count as a spike
+SPIKE_MIN_POSTS = int(os.environ.get('TREND_SPIKE_MIN_POSTS', 20)) # hours with fewer scored posts are never spikes
+ROLLING_WINDOW_HOURS = int(os.environ.get('TREND_ROLLING_WINDOW_HOURS', 7 * 24)) # window of the rolling mean the trend compares
+CUSUM_K = 0.5 # CUSUM slack and threshold, in standard deviations of the daily means' noise
+CUSUM_H = 5.0
+SITE_PREFIXES = {'reddit_posts': "r/", 'chan_posts': "/"} # forum labels: r/gaming, /v/
+
+class TrendAccumulator:
+	'''
+		Per-forum totals of one pass over the score data, for [`start`, `start` + `hours` *
+		HOUR): per-hour post counts and toxicity sums (and sums of squares), MHS counts, a
+		toxicity_rating histogram, and the ToxBlock vs MHS agreement counts. Chunks are added
+		with `add`, so memory only depends on the number of forums and hours, not rows.
+	'''
+	def __init__(self, start: int, hours: int):
+		self.start = start
+		self.hours = hours
+		self.forums = {} # forum label -> dict of arrays
+
+	def _totals(self, forum: str) -> dict:
+		totals = self.forums.get(forum)
+		if totals is None:
+			totals = {
+				'posts': np.zeros(self.hours, np.int64),
+				'scored': np.zeros(self.hours, np.int64), # posts with a toxicity_rating
+				'toxicity_sum': np.zeros(self.hours),
+				'toxicity_squares': np.zeros(self.hours),
+				'mhs_scored': np.zeros(self.hours, np.int64), # posts MHS said were normal/flag
+				'mhs_flagged': np.zeros(self.hours, np.int64),
+				'mhs_confidence_sum': np.zeros(self.hours),
+				'histogram': np.zeros(PERCENTILE_BINS, np.int64),
+				'agreement': np.zeros((2, 2), np.int64), # [ToxBlock toxic][MHS flag], posts scored by both
+			}
+			self.forums[forum] = totals
+		return totals
+
+	def add(self, forum: str, timestamps, toxicity, mhs_flag, mhs_confidence):
+		'''
+			params: `forum` (label), `timestamps` (int64 array, unix time), `toxicity` (float
+			array, NaN if not scored), `mhs_flag` (int8 array: 1 flag, 0 normal, -1 anything
+			else), `mhs_confidence` (float array)
+		'''
+		hour = (timestamps - self.start) // HOUR
+		inside = (hour >= 0) & (hour < self.hours)
+		if not inside.all():
+			hour, toxicity, mhs_flag, mhs_confidence = hour[inside], toxicity[inside], mhs_flag[inside], mhs_confidence[inside]
+		totals = self._totals(forum)
+		n = self.hours
+		totals['posts'] += np.bincount(hour, minlength=n)
+
+		scored = ~np.isnan(toxicity)
+		scored_hour, scored_toxicity = hour[scored], toxicity[scored].astype(np.float64)
+		totals['scored'] += np.bincount(scored_hour, minlength=n)
+		totals['toxicity_sum'] += np.bincount(scored_hour, weights=scored_toxicity, minlength=n)
+		totals['toxicity_squares'] += np.bincount(scored_hour, weights=scored_toxicity * scored_toxicity, minlength=n)
+		bins = np.minimum((scored_toxicity * PERCENTILE_BINS).astype(np.int64), PERCENTILE_BINS - 1)
+		totals['histogram'] += np.bincount(bins, minlength=PERCENTILE_BINS)
+
+		classified = mhs_flag >= 0
+		classified_hour = hour[classified]
+		totals['mhs_scored'] += np.bincount(classified_hour, minlength=n)
+		totals['mhs_flagged'] += np.bincount(classified_hour, weights=mhs_flag[classified], minlength=n).astype(np.int64)
+		totals['mhs_confidence_sum'] += np.bincount(classified_hour, weights=np.nan_to_num(mhs_confidence[classified]), minlength=n)
+
+		both = scored & classified
+		cells = (toxicity[both] >= TOXIC_THRESHOLD).astype(np.int64) * 2 + mhs_flag[both]
+		totals['agreement'] += np.bincount(cells, minlength=4).reshape(2, 2)
+
+def exportedDays(tables: tuple = tuple(TABLES)) -> list:
+	'''
+		returns: sorted list of the UTC days (unix time) exported by export_posts.py
+	'''
+	days = set()
+	for table in tables:
+		try:
+			names = os.listdir(os.path.join(EXPORT_DIR, table))
+		except FileNotFoundError:
+			continue
+		for name in names:
+			if name.startswith("date="):
+				days.add(int(datetime.strptime(name[5:], '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()))
+	return sorted(days)
+
+def loadScores(accumulator: TrendAccumulator, tables: tuple = tuple(TABLES)) -> int:
+	'''
+		params: `accumulator` (TrendAccumulator; its time range picks the days that are read),
+		`tables` (keys of export_posts.TABLES)
+
+		returns: int (rows read)
+
+		Streams the score columns of the exported Parquet files into `accumulator`, one
+		record batch at a time, so data much bigger than memory can be analyzed. Each file
+		holds one forum's day (see export_posts.py), so the forum comes from its directory
+		and never has to be read.
+	'''
+	first_day = dayName(accumulator.start)
+	last_day = dayName(accumulator.start + accumulator.hours * HOUR - 1)
+	columns = ['timestamp', 'toxicity_rating', 'mhs_class', 'mhs_confidence']
+	rows = 0
+	for table in tables:
+		path = os.path.join(EXPORT_DIR, table)
+		if not os.path.isdir(path):
+			continue
+		forum_column = TABLES[table][0]
+		partitioning = ds.partitioning(pa.schema([('date', pa.string()), (forum_column, pa.string())]), flavor='hive')
+		dataset = ds.dataset(path, format='parquet', partitioning=partitioning)
+		in_range = (ds.field('date') >= first_day) & (ds.field('date') <= last_day)
+		for fragment in dataset.get_fragments(filter=in_range):
+			keys = ds.get_partition_keys(fragment.partition_expression)
+			forum = f"{SITE_PREFIXES[table]}{keys[forum_column]}{'/' if table == 'chan_posts' else ''}"
+			for batch in fragment.to_batches(columns=columns, batch_size=1 << 20):
+				mhs_class = batch.column(2).to_numpy(zero_copy_only=False)
+				mhs_flag = np.where(mhs_class == 'flag', 1, np.where(mhs_class == 'normal', 0, -1)).astype(np.int8)
+				accumulator.add(forum,
+								batch.column(0).to_numpy(),
+								batch.column(1).to_numpy(zero_copy_only=False).astype(np.float32), # nulls become NaN
+								mhs_flag,
+								batch.column(3).to_numpy(zero_copy_only=False).astype(np.float32))
+				rows += batch.num_rows
+	return rows
+
+def windowSums(values, window: int):
+	'''
+		returns: array of the sum of the `window` values before each position (not
+		including it), from a cumulative sum, so any window length costs the same
+	'''
+	cumulative = np.concatenate(([0], np.cumsum(values, dtype=np.float64)))
+	ends = np.arange(len(values))
+	return cumulative[ends] - cumulative[np.maximum(ends - window, 0)]
+
+def rollingMean(sums, counts, window: int):
+	'''
+		params: `sums`/`counts` (per-hour arrays, e.g. toxicity_sum/scored), `window` (hours)
+
+		returns: array of the mean over each hour and the `window` - 1 before it (NaN where
+		there's nothing in the window), weighted by post count
+	'''
+	window_sums = windowSums(sums, window - 1) + sums
+	window_counts = windowSums(counts, window - 1) + counts
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(window_counts > 0, window_sums / window_counts, np.nan)
+
+def percentiles(histogram, quantiles) -> np.ndarray:
+	'''
+		params: `histogram` (toxicity_rating counts in `PERCENTILE_BINS` bins), `quantiles`
+		(list of floats in [0, 1])
+
+		returns: array of toxicity_ratings (the upper edge of the bin each quantile falls in)
+	'''
+	cumulative = np.cumsum(histogram)
+	if cumulative[-1] == 0:
+		return np.full(len(quantiles), np.nan)
+	positions = np.searchsorted(cumulative, np.asarray(quantiles) * cumulative[-1], side='left')
+	return (np.minimum(positions, PERCENTILE_BINS - 1) + 1) / PERCENTILE_BINS
+
+def detectSpikes(totals: dict, window: int = SPIKE_WINDOW_HOURS, z: float = SPIKE_Z,
+				min_posts: int = SPIKE_MIN_POSTS):
+	'''
+		params: `totals` (one forum's TrendAccumulator totals)
+
+		returns: tuple of arrays (hour indexes, z-scores) of the hours whose mean toxicity is
+		more than `z` standard errors above the mean of the `window` hours before them
+
+		The baseline's per-post variance comes from the same window, so a quiet forum's
+		noisy hours aren't flagged just for being small.
+	'''
+	scored = totals['scored'].astype(np.float64)
+	baseline_counts = windowSums(scored, window)
+	baseline_sums = windowSums(totals['toxicity_sum'], window)
+	baseline_squares = windowSums(totals['toxicity_squares'], window)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		baseline_mean = baseline_sums / baseline_counts
+		baseline_variance = np.maximum(baseline_squares / baseline_counts - baseline_mean ** 2, 1e-6)
+		hour_mean = totals['toxicity_sum'] / scored
+		scores = (hour_mean - baseline_mean) / np.sqrt(baseline_variance / scored)
+	usable = (scored >= min_posts) & (baseline_counts >= min_posts * 10)
+	hours = np.flatnonzero(usable & (scores > z))
+	return hours, scores[hours]
+
+def cusum(values, k: float = CUSUM_K, h: float = CUSUM_H):
+	'''
+		params: `values` (series, e.g. daily mean toxicity; NaNs are skipped), `k`/`h`
+		(slack and alarm threshold, in standard deviations of the day-to-day noise)
+
+		returns: tuple of arrays (indexes where an upward shift is first detected, indexes
+		where a downward one is), for a two-sided tabular CUSUM
+
+		The recursion S[t] = max(0, S[t-1] + y[t]) equals C[t] - min(0, min(C[:t+1])) for
+		C = cumsum(y), which is vectorized with `np.minimum.accumulate`.
+	'''
+	values = np.asarray(values, dtype=np.float64)
+	valid = np.flatnonzero(~np.isnan(values))
+	# scaled by day-to-day noise rather than the overall spread, which a shift inflates
+	scale = np.std(np.diff(values[valid])) / np.sqrt(2) if len(valid) > 2 else 0
+	if scale == 0:
+		return np.array([], np.int64), np.array([], np.int64)
+	standardized = (values[valid] - np.median(values[valid])) / scale
+	alarms = []
+	for sign in (1, -1):
+		cumulative = np.cumsum(sign * standardized - k)
+		statistic = cumulative - np.minimum(np.minimum.accumulate(cumulative), 0)
+		alarm = statistic > h
+		starts = np.flatnonzero(alarm & ~np.concatenate(([False], alarm[:-1]))) # first day of each run of alarms
+		alarms.append(valid[starts])
+	return alarms[0], alarms[1]
+
+def agreement(matrix) -> tuple:
+	'''
+		params: `matrix` (2x2 counts [ToxBlock toxic][MHS flag])
+
+		returns: tuple (fraction of posts both agree on, Cohen's kappa), NaN if empty
+	'''
+	total = matrix.sum()
+	if total == 0:
+		return np.nan, np.nan
+	observed = np.trace(matrix) / total
+	expected = (matrix.sum(axis=1) @ matrix.sum(axis=0)) / total ** 2
+	kappa = (observed - expected) / (1 - expected) if expected < 1 else np.nan
+	return observed, kappa
+
+def dailyMeans(totals: dict, min_posts: int = SPIKE_MIN_POSTS):
+	'''
+		returns: array of each day's mean toxicity (NaN for days with fewer than `min_posts` scored)
+	'''
+	days = len(totals['scored']) // 24
+	scored = totals['scored'][:days * 24].reshape(days, 24).sum(axis=1)
+	sums = totals['toxicity_sum'][:days * 24].reshape(days, 24).sum(axis=1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return np.where(scored >= min_posts, sums / scored, np.nan)
+
+def report(accumulator: TrendAccumulator):
+	'''
+		Prints each forum's toxicity distribution, MHS flag ratio and agreement with
+		ToxBlock, then the same distribution over everything, and each forum's trend,
+		spikes and change points.
+	'''
+	hourName = lambda hour: datetime.fromtimestamp(accumulator.start + int(hour) * HOUR, timezone.utc).strftime('%Y-%m-%d %H:00')
+	dayLabel = lambda day: dayName(accumulator.start + int(day) * DAY)
+	quantiles = [0.5, 0.9, 0.99]
+	overall = np.zeros(PERCENTILE_BINS, np.int64)
+	print(f"{'forum':<24}{'posts':>12}{'mean':>8}{'p50':>8}{'p90':>8}{'p99':>8}{'flag%':>8}{'agree%':>8}{'kappa':>8}")
+	for forum in sorted(accumulator.forums, key=lambda forum: -accumulator.forums[forum]['posts'].sum()):
+		totals = accumulator.forums[forum]
+		overall += totals['histogram']
+		scored = totals['scored'].sum()
+		mean = totals['toxicity_sum'].sum() / scored if scored else np.nan
+		flag_ratio = totals['mhs_flagged'].sum() / totals['mhs_scored'].sum() if totals['mhs_scored'].sum() else np.nan
+		observed, kappa = agreement(totals['agreement'])
+		p50, p90, p99 = percentiles(totals['histogram'], quantiles)
+		print(f"{forum:<24}{totals['posts'].sum():>12}{mean:>8.3f}{p50:>8.3f}{p90:>8.3f}{p99:>8.3f}"
+			f"{flag_ratio * 100:>8.1f}{observed * 100:>8.1f}{kappa:>8.3f}")
+	print(f"{'overall':<24}{'':>12}{'':>8}" + "".join(f"{value:>8.3f}" for value in percentiles(overall, quantiles)))
+
+	print(f"\nTrend (mean toxicity over {ROLLING_WINDOW_HOURS} hours, at the start and end of the range):")
+	for forum, totals in sorted(accumulator.forums.items()):
+		rolling = rollingMean(totals['toxicity_sum'], totals['scored'], ROLLING_WINDOW_HOURS)[ROLLING_WINDOW_HOURS - 1:] # full windows only
+		rolling = rolling[~np.isnan(rolling)]
+		if len(rolling) > 1:
+			print(f"  {forum:<22} {rolling[0]:.3f} -> {rolling[-1]:.3f} ({rolling[-1] - rolling[0]:+.3f})")
+
+	print(f"\nSpikes (hour mean toxicity > {SPIKE_Z:g} standard errors above the previous {SPIKE_WINDOW_HOURS} hours):")
+	for forum, totals in sorted(accumulator.forums.items()):
+		hours, scores = detectSpikes(totals)
+		for hour, score in sorted(zip(hours, scores), key=lambda spike: -spike[1])[:5]:
+			print(f"  {forum:<22} {hourName(hour)}  z={score:.1f}  mean={totals['toxicity_sum'][hour] / totals['scored'][hour]:.3f}  n={totals['scored'][hour]}")
+
+	print("\nChange points (CUSUM over daily mean toxicity):")
+	for forum, totals in sorted(accumulator.forums.items()):
+		up, down = cusum(dailyMeans(totals))
+		if len(up) or len(down):
+			shifts = [f"up {dayLabel(day)}" for day in up] + [f"down {dayLabel(day)}" for day in down]
+			print(f"  {forum:<22} {', '.join(shifts)}")
+
+if __name__ == '__main__':
+	# python trend_analysis.py [YYYY-MM-DD [YYYY-MM-DD]]    analyze the exported days in that range (default: all)
+	days = exportedDays()
+	if not days:
+		logging.error(f"Nothing exported in {EXPORT_DIR}, run export_posts.py first")
+		sys.exit(1)
+	parse = lambda day: int(datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+	first = parse(sys.argv[1]) if len(sys.argv) > 1 else days[0]
+	last = parse(sys.argv[2]) if len(sys.argv) > 2 else days[-1]
+	accumulator = TrendAccumulator(first, (last - first) // HOUR + 24)
+	started = time()
+	rows = loadScores(accumulator)
+	logging.info(f"Read {rows} rows from {dayName(first)} to {dayName(last)} in {time() - started:.1f}s")
+	report(accumulator)